@@ -0,0 +1,228 @@
+"""
+Immutable result cache for closed time buckets.
+
+Hourly and daily breakdowns keep recomputing hours and days that closed long
+ago and can never change again. ``BucketCache`` splits a requested time range
+into:
+
+- fully closed buckets, served from an in-memory LRU and, behind it, a Mongo
+  cache collection; missing ones are computed once and stored permanently
+- the partial leading bucket and the still-open trailing bucket(s), which are
+  always computed live against raw data
+
+and stitches the pieces back together. Once warm, a 30-day query touches about
+as much raw data as a 1-hour query.
+
+If some ranges run out of query budget, the others are still returned and the
+request is marked partial; buckets that timed out are never cached.
+"""
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+import deadlines
+from deadlines import QueryTimeout
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+DAY = 86400
+
+# compute(range_start, range_end) -> {bucket_start: aggregated doc}
+BucketCompute = Callable[[float, float], Awaitable[Dict[int, Dict[str, Any]]]]
+
+# Marker for closed buckets that contain no data
+_EMPTY = object()
+
+
+class BucketCache:
+    """Two-tier (memory LRU + Mongo) cache of closed bucket aggregates"""
+
+    def __init__(self, repo, collection: str = "analytics_bucket_cache",
+                 max_entries: Optional[int] = None, settle_seconds: Optional[float] = None):
+        self.repo = repo
+        self.collection = collection
+        self.max_entries = max_entries or int(os.environ.get('ANALYTICS_BUCKET_CACHE_MAX_ENTRIES', '20000'))
+        # Buckets are only treated as closed once late messages had time to land
+        self.settle_seconds = settle_seconds if settle_seconds is not None else float(
+            os.environ.get('ANALYTICS_BUCKET_SETTLE_SECONDS', '120')
+        )
+        self._memory: "OrderedDict[Tuple[str, int, int], Any]" = OrderedDict()
+        self._index_ready = False
+        self._counters = {
+            "memory_hits": 0,
+            "mongo_hits": 0,
+            "computed": 0,
+            "live_ranges": 0,
+            "timed_out_ranges": 0,
+        }
+
+    def _remember(self, key: Tuple[str, int, int], doc: Any):
+        self._memory[key] = doc
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    async def _ensure_index(self):
+        if self._index_ready:
+            return
+        try:
+            await self.repo.run(
+                self.repo.db[self.collection].create_index,
+                [("namespace", 1), ("granularity", 1), ("bucket", 1)],
+                unique=True
+            )
+            self._index_ready = True
+        except Exception as e:
+            logger.warning("Could not create bucket cache index: %s", e)
+
+    async def _load_persisted(self, namespace: str, granularity: int,
+                              buckets: List[int]) -> Dict[int, Any]:
+        if not buckets:
+            return {}
+        try:
+            docs = await self.repo.find(self.collection, {
+                "namespace": namespace,
+                "granularity": granularity,
+                "bucket": {"$in": buckets}
+            }, {"_id": 0, "bucket": 1, "data": 1})
+        except Exception as e:
+            logger.warning("Bucket cache read failed, recomputing: %s", e)
+            return {}
+        return {doc["bucket"]: (doc["data"] if doc.get("data") is not None else _EMPTY) for doc in docs}
+
+    async def _persist(self, namespace: str, granularity: int, results: Dict[int, Any]):
+        await self._ensure_index()
+        operations = [
+            UpdateOne(
+                {"namespace": namespace, "granularity": granularity, "bucket": bucket},
+                {"$set": {
+                    "data": None if doc is _EMPTY else doc,
+                    "stored_at": time.time()
+                }},
+                upsert=True
+            )
+            for bucket, doc in results.items()
+        ]
+        if not operations:
+            return
+        try:
+            await self.repo.run(self.repo.db[self.collection].bulk_write, operations, ordered=False)
+        except Exception as e:
+            # The memory tier still has the results - persistence is best effort
+            logger.warning("Bucket cache write failed: %s", e)
+
+    async def _compute_range(self, compute: BucketCompute, start: float, end: float) -> Any:
+        """Run one range computation; a timeout is returned instead of raised"""
+        try:
+            return await compute(start, end)
+        except QueryTimeout as e:
+            self._counters["timed_out_ranges"] += 1
+            return e
+
+    @staticmethod
+    def _contiguous_runs(buckets: List[int], granularity: int) -> List[Tuple[int, int]]:
+        runs: List[Tuple[int, int]] = []
+        for bucket in sorted(buckets):
+            if runs and runs[-1][1] == bucket:
+                runs[-1] = (runs[-1][0], bucket + granularity)
+            else:
+                runs.append((bucket, bucket + granularity))
+        return runs
+
+    async def _closed_buckets(self, namespace: str, granularity: int, buckets: List[int],
+                              compute: BucketCompute) -> Dict[int, Any]:
+        results: Dict[int, Any] = {}
+        missing: List[int] = []
+        for bucket in buckets:
+            key = (namespace, granularity, bucket)
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                results[bucket] = self._memory[key]
+                self._counters["memory_hits"] += 1
+            else:
+                missing.append(bucket)
+
+        persisted = await self._load_persisted(namespace, granularity, missing)
+        for bucket, doc in persisted.items():
+            self._remember((namespace, granularity, bucket), doc)
+            results[bucket] = doc
+        self._counters["mongo_hits"] += len(persisted)
+
+        to_compute = [bucket for bucket in missing if bucket not in persisted]
+        if to_compute:
+            computed: Dict[int, Any] = {}
+            # One aggregation per contiguous run of missing buckets
+            runs = self._contiguous_runs(to_compute, granularity)
+            run_results = await asyncio.gather(*(self._compute_range(compute, start, end) for start, end in runs))
+            for (start, end), run_result in zip(runs, run_results):
+                if isinstance(run_result, QueryTimeout):
+                    results[start] = run_result
+                    continue
+                for bucket in range(start, end, granularity):
+                    computed[bucket] = run_result.get(bucket, _EMPTY)
+            for bucket, doc in computed.items():
+                self._remember((namespace, granularity, bucket), doc)
+                results[bucket] = doc
+            self._counters["computed"] += len(computed)
+            await self._persist(namespace, granularity, computed)
+
+        return results
+
+    async def get_range(self, namespace: str, granularity: int, start: float, end: float,
+                        compute: BucketCompute) -> List[Tuple[int, Dict[str, Any]]]:
+        """
+        Return ``[(bucket_start, doc), ...]`` in ascending order for every bucket
+        with data in ``[start, end)``. ``namespace`` must change whenever the
+        shape of ``compute``'s output changes.
+        """
+        closed_limit = math.floor((time.time() - self.settle_seconds) / granularity) * granularity
+        full_start = int(math.ceil(start / granularity) * granularity)
+        full_end = int(min(math.floor(end / granularity) * granularity, closed_limit))
+
+        live_ranges: List[Tuple[float, float]] = []
+        closed: List[int] = []
+        if full_end <= full_start:
+            live_ranges.append((start, end))
+        else:
+            if start < full_start:
+                live_ranges.append((start, full_start))
+            closed = list(range(full_start, full_end, granularity))
+            if full_end < end:
+                live_ranges.append((full_end, end))
+
+        self._counters["live_ranges"] += len(live_ranges)
+        live_results, closed_results = await asyncio.gather(
+            asyncio.gather(*(
+                self._compute_range(compute, range_start, range_end) for range_start, range_end in live_ranges
+            )),
+            self._closed_buckets(namespace, granularity, closed, compute)
+        )
+
+        timeouts = [r for r in list(live_results) + list(closed_results.values()) if isinstance(r, QueryTimeout)]
+        merged: Dict[int, Any] = {
+            bucket: doc for bucket, doc in closed_results.items() if not isinstance(doc, QueryTimeout)
+        }
+        for result in live_results:
+            if not isinstance(result, QueryTimeout):
+                merged.update(result)
+        if timeouts:
+            if not merged:
+                # Nothing came back - let the caller fall back or fail
+                raise timeouts[0]
+            deadlines.mark_partial()
+        return [(bucket, doc) for bucket, doc in sorted(merged.items()) if doc is not _EMPTY]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "memory_entries": len(self._memory),
+            "max_entries": self.max_entries,
+            "settle_seconds": self.settle_seconds,
+            **self._counters,
+        }
@@ -0,0 +1,249 @@
+"""
+Single-flight TTL response cache for analytics dashboard endpoints.
+
+Dashboards poll the same handful of aggregations from every open tab. Entries
+are keyed by endpoint name and normalized query parameters so Mongo load scales
+with the number of distinct queries rather than the number of viewers:
+
+- fresh entries (age < ttl) are served directly
+- stale entries (age < ttl + stale_ttl) are served immediately while one
+  background refresh recomputes them (stale-while-revalidate)
+- concurrent misses for the same key share one computation (single-flight)
+- the total number of entries is bounded with LRU eviction
+- the shared computation runs in its own task under the endpoint's default
+  budget; each waiter applies only its own deadline, so a tight or
+  disconnecting client cannot fail the others
+- when a waiter runs out of budget, an expired entry (if one is still in
+  memory) is served instead of an error; partial results are never stored
+  but are reported to every waiter
+"""
+import os
+import time
+import asyncio
+import contextvars
+import functools
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+import sentry_sdk
+
+import deadlines
+from deadlines import QueryTimeout
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ("value", "created_at", "ttl", "stale_ttl")
+
+    def __init__(self, value: Any, ttl: float, stale_ttl: float):
+        self.value = value
+        self.created_at = time.monotonic()
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+    def age(self) -> float:
+        return time.monotonic() - self.created_at
+
+
+class ResponseCache:
+    """Bounded LRU cache with per-endpoint TTLs and request coalescing"""
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self.max_entries = max_entries or int(os.environ.get('ANALYTICS_CACHE_MAX_ENTRIES', '256'))
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._counters = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "refreshes": 0,
+            "errors": 0,
+            "evictions": 0,
+            "timeout_fallbacks": 0,
+        }
+        self._endpoint_counters: Dict[str, Dict[str, int]] = {}
+
+    @staticmethod
+    def make_key(endpoint: str, params: Dict[str, Any]) -> Tuple:
+        """Normalize params so equivalent requests share one entry"""
+        return (endpoint,) + tuple(sorted((name, repr(value)) for name, value in params.items()))
+
+    def _count(self, endpoint: str, counter: str):
+        self._counters[counter] += 1
+        per_endpoint = self._endpoint_counters.setdefault(
+            endpoint, {name: 0 for name in self._counters}
+        )
+        per_endpoint[counter] += 1
+
+    def _store(self, key: Hashable, value: Any, ttl: float, stale_ttl: float):
+        self._entries[key] = _Entry(value, ttl, stale_ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    async def _compute(self, endpoint: str, key: Hashable, compute: Callable[[], Awaitable[Any]],
+                       ttl: float, stale_ttl: float) -> Tuple[Any, bool, bool]:
+        """Run one computation; returns (value, partial, stale) for every waiter to apply"""
+        try:
+            value = await compute()
+        except BaseException:
+            # Errors are never cached - the next request retries
+            self._count(endpoint, "errors")
+            raise
+        deadline = deadlines.current()
+        partial = bool(deadline and deadline.partial)
+        stale = bool(deadline and deadline.stale)
+        if not partial:
+            self._store(key, value, ttl, stale_ttl)
+        return value, partial, stale
+
+    async def _shared(self, endpoint: str, key: Hashable, compute: Callable[[], Awaitable[Any]],
+                      ttl: float, stale_ttl: float, deadline_endpoint: Optional[str]) -> Tuple[Any, bool, bool]:
+        """
+        Body of the detached task for a miss. It runs under the endpoint's own
+        budget without a disconnect check, so the tight X-Request-Timeout-Ms or
+        the disconnect of whichever client missed first cannot fail the others.
+        """
+        if deadline_endpoint is not None:
+            deadlines.begin(deadline_endpoint, deadlines.budget_for(deadline_endpoint, None))
+        return await self._compute(endpoint, key, compute, ttl, stale_ttl)
+
+    async def _refresh(self, endpoint: str, key: Hashable, compute: Callable[[], Awaitable[Any]],
+                       ttl: float, stale_ttl: float) -> Tuple[Any, bool, bool]:
+        """Background revalidation of a stale entry, detached from the request trace"""
+        deadlines.begin(f"cache.refresh:{endpoint}")
+        with sentry_sdk.start_transaction(op="cache.refresh", name=f"refresh {endpoint}"):
+            try:
+                return await self._compute(endpoint, key, compute, ttl, stale_ttl)
+            except Exception as e:
+                logger.warning("Background refresh of %s failed: %s", endpoint, e)
+                raise
+
+    def _start(self, key: Hashable, work: Awaitable[Tuple[Any, bool, bool]],
+               context: contextvars.Context) -> asyncio.Future:
+        """Run `work` as the one in-flight computation for `key`, owned by no request"""
+        task = context.run(asyncio.ensure_future, work)
+        self._inflight[key] = task
+        task.add_done_callback(lambda done: self._finished(key, done))
+        return task
+
+    def _finished(self, key: Hashable, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark retrieved so a failure nobody waited for does not log a warning
+        if not task.cancelled():
+            task.exception()
+
+    def _schedule_refresh(self, endpoint: str, key: Hashable, compute: Callable[[], Awaitable[Any]],
+                          ttl: float, stale_ttl: float):
+        self._count(endpoint, "refreshes")
+        # Run in an empty context so the refresh does not attach to (and
+        # outlive) the transaction of the request that noticed staleness
+        self._start(key, self._refresh(endpoint, key, compute, ttl, stale_ttl), contextvars.Context())
+
+    async def get_or_compute(self, endpoint: str, params: Dict[str, Any],
+                             compute: Callable[[], Awaitable[Any]],
+                             ttl: float, stale_ttl: float = 0) -> Any:
+        key = self.make_key(endpoint, params)
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            age = entry.age()
+            if age < entry.ttl:
+                self._entries.move_to_end(key)
+                self._count(endpoint, "hits")
+                return entry.value
+            if age < entry.ttl + entry.stale_ttl:
+                self._entries.move_to_end(key)
+                self._count(endpoint, "stale_hits")
+                if key not in self._inflight:
+                    self._schedule_refresh(endpoint, key, compute, ttl, stale_ttl)
+                return entry.value
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._count(endpoint, "coalesced")
+        else:
+            self._count(endpoint, "misses")
+            deadline = deadlines.current()
+            # A copy of the request's context keeps the work in its trace; the
+            # task then replaces the request's deadline with its own
+            inflight = self._start(
+                key,
+                self._shared(endpoint, key, compute, ttl, stale_ttl, deadline.endpoint if deadline else None),
+                contextvars.copy_context()
+            )
+        return await self._wait(endpoint, key, inflight)
+
+    async def _wait(self, endpoint: str, key: Hashable, inflight: asyncio.Future) -> Any:
+        """Wait for the shared computation, within this request's own deadline only"""
+        deadline = deadlines.current()
+        try:
+            # Shield so one cancelled waiter cannot cancel the shared work
+            if deadline is None:
+                value, partial, stale = await asyncio.shield(inflight)
+            else:
+                try:
+                    value, partial, stale = await asyncio.wait_for(
+                        asyncio.shield(inflight), timeout=deadline.remaining()
+                    )
+                except asyncio.TimeoutError:
+                    raise QueryTimeout(deadline.endpoint, f"cache.{endpoint}", "deadline")
+        except QueryTimeout as e:
+            return self._expired_or_raise(endpoint, key, e)
+        # Let X-Analytics-Result reach every waiter, not only the one that computed
+        if stale:
+            deadlines.mark_stale()
+        elif partial:
+            deadlines.mark_partial()
+        return value
+
+    def _expired_or_raise(self, endpoint: str, key: Hashable, error: QueryTimeout) -> Any:
+        """Out of budget: an expired answer beats no answer"""
+        expired = self._entries.get(key)
+        if expired is None:
+            raise error
+        self._count(endpoint, "timeout_fallbacks")
+        deadlines.mark_stale()
+        return expired.value
+
+    def cached(self, endpoint: str, ttl: float, stale_ttl: float = 0):
+        """
+        Decorator for FastAPI endpoints. TTLs can be overridden per endpoint with
+        ANALYTICS_CACHE_TTL_<ENDPOINT> and ANALYTICS_CACHE_STALE_TTL_<ENDPOINT>.
+        """
+        env_name = endpoint.upper().replace(".", "_").replace("-", "_")
+        ttl = float(os.environ.get(f'ANALYTICS_CACHE_TTL_{env_name}', ttl))
+        stale_ttl = float(os.environ.get(f'ANALYTICS_CACHE_STALE_TTL_{env_name}', stale_ttl))
+
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(**kwargs):
+                if ttl <= 0:
+                    return await func(**kwargs)
+                return await self.get_or_compute(
+                    endpoint, kwargs, lambda: func(**kwargs), ttl, stale_ttl
+                )
+            return wrapper
+        return decorator
+
+    def invalidate(self, endpoint: Optional[str] = None):
+        """Drop all entries, or only those of one endpoint"""
+        if endpoint is None:
+            self._entries.clear()
+            return
+        for key in [k for k in self._entries if k[0] == endpoint]:
+            del self._entries[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "inflight": len(self._inflight),
+            **self._counters,
+            "by_endpoint": self._endpoint_counters,
+        }
@@ -0,0 +1,253 @@
+"""
+Per-request query deadlines for the analytics service.
+
+Every API request gets a time budget: the per-endpoint default, or what is
+left of the gateway's budget (``X-Request-Timeout-Ms``) if that is tighter. ``DeadlineMiddleware`` stores the budget in a context variable and
+``AnalyticsRepository`` turns it into ``maxTimeMS`` on every query plus a
+client-side wait. When the budget runs out or the client disconnects, the
+repository gives up and kills the operation on the server instead of letting
+it keep occupying MongoDB.
+
+Endpoints that can degrade gracefully (stale cache entries, closed buckets
+without the live tail) mark the request as stale/partial; the middleware
+reports that in the ``X-Analytics-Result`` response header.
+"""
+import os
+import time
+import logging
+import threading
+import contextvars
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import anyio
+import sentry_sdk
+
+logger = logging.getLogger(__name__)
+
+HEADER = "x-request-timeout-ms"
+RESULT_HEADER = "X-Analytics-Result"
+
+DEFAULT_BUDGET_MS = int(os.environ.get('ANALYTICS_DEADLINE_MS', '10000'))
+# Kept back from the budget for serializing the response
+MARGIN_MS = int(os.environ.get('ANALYTICS_DEADLINE_MARGIN_MS', '50'))
+
+# Path prefix -> budget in ms, None = no deadline
+ENDPOINT_BUDGETS_MS: Dict[str, Optional[int]] = {
+    "/health": None,
+    "/ready": None,
+    "/api/v1/analytics/realtime/stream": None,
+    "/api/v1/analytics/games/export": None,
+    "/api/debug/slow-query": 15000,
+    "/api/v1/analytics/player-details-n1": 20000,
+}
+
+
+class QueryTimeout(Exception):
+    """A query was abandoned because of the request deadline or a disconnect"""
+
+    def __init__(self, endpoint: str, pipeline: str, reason: str):
+        super().__init__(f"{pipeline} abandoned ({reason}) for {endpoint}")
+        self.endpoint = endpoint
+        self.pipeline = pipeline
+        # deadline | max_time_ms | queued | disconnected
+        self.reason = reason
+
+
+class Deadline:
+    """Budget of one request, shared by every query it runs"""
+
+    __slots__ = ("endpoint", "budget_ms", "expires_at", "is_disconnected", "partial", "stale")
+
+    def __init__(self, endpoint: str, budget_ms: int,
+                 is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None):
+        self.endpoint = endpoint
+        self.budget_ms = budget_ms
+        self.expires_at = time.monotonic() + max(budget_ms - MARGIN_MS, 0) / 1000
+        self.is_disconnected = is_disconnected
+        self.partial = False
+        self.stale = False
+
+    def remaining(self) -> float:
+        """Seconds left, never negative"""
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def remaining_ms(self) -> int:
+        return int(self.remaining() * 1000)
+
+
+_current: "contextvars.ContextVar[Optional[Deadline]]" = contextvars.ContextVar(
+    "analytics_deadline", default=None
+)
+
+
+def current() -> Optional[Deadline]:
+    return _current.get()
+
+
+def begin(endpoint: str, budget_ms: Optional[int] = None,
+          is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None) -> contextvars.Token:
+    """Start a deadline for the current context (used for background work)"""
+    return _current.set(Deadline(endpoint, budget_ms or DEFAULT_BUDGET_MS, is_disconnected))
+
+
+def end(token: contextvars.Token):
+    _current.reset(token)
+
+
+def mark_partial():
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.partial = True
+
+
+def mark_stale():
+    """The response is an older complete result, which supersedes any partial one"""
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.stale = True
+        deadline.partial = False
+
+
+def is_partial() -> bool:
+    deadline = _current.get()
+    return bool(deadline and deadline.partial)
+
+
+def budget_for(path: str, header_value: Optional[str]) -> Optional[int]:
+    """Budget in ms for a request, or None when the endpoint has no deadline"""
+    budget = DEFAULT_BUDGET_MS
+    for prefix, endpoint_budget in ENDPOINT_BUDGETS_MS.items():
+        if path.startswith(prefix):
+            if endpoint_budget is None:
+                return None
+            budget = endpoint_budget
+            break
+    if header_value:
+        try:
+            # The caller gave up earlier than we would - no point running longer
+            budget = max(min(int(float(header_value)), budget), 0)
+        except ValueError:
+            logger.warning("Ignoring invalid %s header: %r", HEADER, header_value)
+    return budget
+
+
+class DeadlineMetrics:
+    """Timeout and kill counters by endpoint and pipeline"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timeouts: Dict[Tuple[str, str, str], int] = {}
+        self._counters = {
+            "kills_requested": 0,
+            "ops_killed": 0,
+            "kill_errors": 0,
+            "partial_responses": 0,
+            "stale_responses": 0,
+        }
+
+    def record_timeout(self, error: QueryTimeout):
+        with self._lock:
+            key = (error.endpoint, error.pipeline, error.reason)
+            self._timeouts[key] = self._timeouts.get(key, 0) + 1
+        sentry_sdk.set_tag("query.timeout", error.reason)
+        try:
+            from sentry_sdk import metrics as sentry_metrics
+            sentry_metrics.incr(
+                "analytics.query.timeout",
+                tags={"endpoint": error.endpoint, "pipeline": error.pipeline, "reason": error.reason}
+            )
+        except Exception:
+            # Metrics are optional (older SDKs, or not enabled)
+            pass
+
+    def count(self, counter: str, value: int = 1):
+        with self._lock:
+            self._counters[counter] += value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "default_budget_ms": DEFAULT_BUDGET_MS,
+                "endpoint_budgets_ms": ENDPOINT_BUDGETS_MS,
+                **self._counters,
+                "timeouts": [
+                    {"endpoint": endpoint, "pipeline": pipeline, "reason": reason, "count": count}
+                    for (endpoint, pipeline, reason), count in sorted(self._timeouts.items())
+                ]
+            }
+
+
+metrics = DeadlineMetrics()
+
+
+class _ReceiveTap:
+    """
+    Wraps the ASGI ``receive`` so the deadline can poll for a disconnect
+    without stealing messages from the endpoint (same non-blocking check as
+    ``Request.is_disconnected``, with anything received replayed to the app).
+    """
+
+    def __init__(self, receive):
+        self._receive = receive
+        self._pending = []
+        self.disconnected = False
+
+    async def __call__(self):
+        if self._pending:
+            return self._pending.pop(0)
+        message = await self._receive()
+        if message["type"] == "http.disconnect":
+            self.disconnected = True
+        return message
+
+    async def is_disconnected(self) -> bool:
+        if self.disconnected:
+            return True
+        message = None
+        with anyio.CancelScope() as scope:
+            scope.cancel()
+            message = await self._receive()
+        if message is not None:
+            self._pending.append(message)
+            if message["type"] == "http.disconnect":
+                self.disconnected = True
+        return self.disconnected
+
+
+class DeadlineMiddleware:
+    """ASGI middleware that starts a Deadline for every HTTP request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        header_value = None
+        for name, value in scope.get("headers", []):
+            if name.decode("latin-1").lower() == HEADER:
+                header_value = value.decode("latin-1")
+                break
+        budget_ms = budget_for(scope["path"], header_value)
+        if budget_ms is None:
+            return await self.app(scope, receive, send)
+
+        tap = _ReceiveTap(receive)
+        deadline = Deadline(scope["path"], budget_ms, tap.is_disconnected)
+        token = _current.set(deadline)
+
+        async def send_with_result(message):
+            if (message["type"] == "http.response.start" and message["status"] < 400
+                    and (deadline.partial or deadline.stale)):
+                result = "partial" if deadline.partial else "stale"
+                metrics.count(f"{result}_responses")
+                headers = list(message.get("headers", []))
+                headers.append((RESULT_HEADER.encode("latin-1"), result.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, tap, send_with_result)
+        finally:
+            _current.reset(token)
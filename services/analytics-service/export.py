@@ -0,0 +1,201 @@
+"""
+Streaming NDJSON export of raw game history.
+
+``GET /api/v1/analytics/games/export`` walks a MongoDB cursor in
+(timestamp, _id) order and streams one JSON object per line, never holding
+more than one batch in memory.
+
+The games collection deliberately has no timestamp index (the slow-query
+demos depend on it), so by default the cursor sorts with ``allowDiskUse``:
+the export works, but every request - resumes included - sorts its whole
+match to temporary files on the server before the first row comes back.
+ANALYTICS_EXPORT_INDEX=true creates a ``{timestamp: 1, _id: 1}`` index
+(``{ts: 1, _id: 1}`` in the time-series layout) at startup instead, so MongoDB
+walks the index and an ``after=`` resume starts at its position in it; the
+timestamp demos then stop scanning the whole collection.
+
+Cursor reads and serialization run on the repository thread pool, a batch at
+a time, so the event loop only moves bytes. The stream stops - and the
+server-side cursor is closed - as soon as the client goes away.
+
+Resuming: every line carries ``timestamp`` and ``_id``. Pass the last line's
+values back as ``after=<timestamp>:<_id>`` to continue right after it, e.g.
+after a dropped connection. Time-series dates only keep milliseconds; the
+exported timestamp is the stored value and ``after`` is truncated the same
+way (``game_store.to_date``), so rows sharing the boundary millisecond are
+told apart by ``_id`` and none are skipped.
+"""
+import os
+import json
+import time
+import zlib
+import asyncio
+import logging
+import itertools
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+from telemetry import batch_sizes
+
+logger = logging.getLogger(__name__)
+
+# Fields a caller may ask for; _id and timestamp are always included
+EXPORT_FIELDS = ("_id", "user_id", "bet", "win", "payout", "symbols", "timestamp")
+KEY_FIELDS = ("timestamp", "_id")
+SORT = [("timestamp", 1), ("_id", 1)]
+
+
+class ExportError(ValueError):
+    """Invalid export parameters"""
+
+
+def parse_after(token: str) -> Tuple[float, Any]:
+    """``<timestamp>:<_id>`` -> (timestamp, _id)"""
+    timestamp, sep, game_id = token.partition(":")
+    if not sep or not game_id:
+        raise ExportError("after must look like <timestamp>:<_id>")
+    try:
+        value = float(timestamp)
+    except ValueError:
+        raise ExportError(f"Invalid timestamp in after: {timestamp}")
+    return value, ObjectId(game_id) if ObjectId.is_valid(game_id) else game_id
+
+
+def parse_fields(fields: Optional[str]) -> List[str]:
+    if not fields:
+        return list(EXPORT_FIELDS)
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in EXPORT_FIELDS]
+    if unknown:
+        raise ExportError(f"Unknown fields: {', '.join(unknown)} (allowed: {', '.join(EXPORT_FIELDS)})")
+    return [f for f in EXPORT_FIELDS if f in requested or f in KEY_FIELDS]
+
+
+def build_filter(user_id: Optional[str] = None, start: Optional[float] = None,
+                 end: Optional[float] = None, after: Optional[Tuple[float, Any]] = None) -> Dict[str, Any]:
+    """Filter in the standard games layout (the GameStore translates it)"""
+    clauses: List[Dict[str, Any]] = []
+    if user_id:
+        clauses.append({"user_id": user_id})
+    time_range: Dict[str, Any] = {}
+    if start is not None:
+        time_range["$gte"] = start
+    if end is not None:
+        time_range["$lt"] = end
+    if time_range:
+        clauses.append({"timestamp": time_range})
+    if after is not None:
+        timestamp, game_id = after
+        # Keyset: strictly after (timestamp, _id) in sort order
+        clauses.append({"$or": [
+            {"timestamp": {"$gt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$gt": game_id}},
+        ]})
+    if not clauses:
+        return {}
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+class GamesExporter:
+    """Streams games matching a filter as NDJSON, one cursor batch at a time"""
+
+    def __init__(self, repo, batch_size: Optional[int] = None):
+        self.repo = repo
+        self.batch_size = batch_size or int(os.environ.get('ANALYTICS_EXPORT_BATCH_SIZE', '2000'))
+        self.max_batch_size = int(os.environ.get('ANALYTICS_EXPORT_MAX_BATCH_SIZE', '10000'))
+        self.active = 0
+        self.index_enabled = os.environ.get('ANALYTICS_EXPORT_INDEX', 'false').lower() in ('1', 'true', 'yes')
+        self._index_ready = False
+        self._counters = {
+            "exports": 0,
+            "completed": 0,
+            "disconnected": 0,
+            "failed": 0,
+            "rows": 0,
+            "bytes": 0,
+        }
+
+    @property
+    def index_ready(self) -> bool:
+        return self._index_ready
+
+    async def ensure_index(self):
+        """Create the index behind the export order when enabled; failures fall back to a disk sort"""
+        if self._index_ready or not self.index_enabled:
+            return
+        games = self.repo.games
+        try:
+            await self.repo.run(games.collection.create_index, games.translate_sort(SORT), name="export_order")
+            self._index_ready = True
+        except Exception as e:
+            logger.warning("Could not create the games export index, exports sort on disk: %s", e)
+
+    async def stream(self, filter: Dict[str, Any], fields: List[str], limit: Optional[int] = None,
+                     compress: bool = False, batch_size: Optional[int] = None,
+                     is_disconnected=None) -> AsyncIterator[bytes]:
+        batch_size = max(1, min(batch_size or self.batch_size, self.max_batch_size))
+        await self.ensure_index()
+        games = self.repo.games
+        cursor = games.collection.find(
+            games.translate_filter(filter),
+            games.translate_projection({field: 1 for field in fields}),
+            sort=games.translate_sort(SORT),
+            batch_size=batch_size,
+            # Without the index the sort is blocking and capped at 100MB in memory
+            allow_disk_use=not self._index_ready,
+        )
+        if limit:
+            cursor = cursor.limit(limit)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+        def next_chunk() -> Tuple[bytes, int]:
+            lines = []
+            for document in itertools.islice(cursor, batch_size):
+                record = games.from_document(document)
+                lines.append(json.dumps({field: record.get(field) for field in fields},
+                                        default=str, ensure_ascii=False, separators=(",", ":")))
+            if not lines:
+                return b"", 0
+            data = ("\n".join(lines) + "\n").encode("utf-8")
+            return (compressor.compress(data) if compressor else data), len(lines)
+
+        self.active += 1
+        self._counters["exports"] += 1
+        started = time.perf_counter()
+        rows = 0
+        outcome = "failed"
+        try:
+            while True:
+                if is_disconnected is not None and await is_disconnected():
+                    outcome = "disconnected"
+                    return
+                chunk, count = await self.repo.run(next_chunk)
+                if not count:
+                    break
+                rows += count
+                self._counters["rows"] += count
+                batch_sizes.observe("export_chunk", count)
+                if chunk:
+                    self._counters["bytes"] += len(chunk)
+                    yield chunk
+            if compressor:
+                tail = compressor.flush()
+                self._counters["bytes"] += len(tail)
+                yield tail
+            outcome = "completed"
+        except (asyncio.CancelledError, GeneratorExit):
+            # Starlette cancels the stream when the client disconnects
+            outcome = "disconnected"
+            raise
+        finally:
+            self.active -= 1
+            self._counters[outcome] += 1
+            # Frees the server-side cursor right away instead of after its idle timeout
+            asyncio.get_event_loop().run_in_executor(None, cursor.close)
+            logger.info("Games export %s: %d rows in %.1fs", outcome, rows, time.perf_counter() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"active": self.active, "batch_size": self.batch_size, "index_enabled": self.index_enabled,
+                "index_ready": self._index_ready,
+                **self._counters}
@@ -0,0 +1,251 @@
+"""
+Incremental windowed top-K players.
+
+Instead of grouping every player in the window and sorting all of them to
+return ten, the consumer keeps per-player accumulators for a sliding window of
+hour buckets and three sorted indexes (RTP, bet volume, net profit). Expiring a
+bucket only touches the players who played in it, and reading the top K is a
+slice of an already sorted list.
+
+The window is aligned to bucket boundaries: it covers the current bucket plus
+the ``window_buckets - 1`` buckets before it, so results match a ``$match`` on
+``timestamp >= window_start`` exactly.
+"""
+import os
+import math
+import time
+import bisect
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+METRICS = ("rtp", "bets", "net_profit")
+
+
+class _SortedIndex:
+    """Ascending list of (sort_key, user_id) plus each user's current key"""
+
+    def __init__(self):
+        self._entries: List[Tuple[float, str]] = []
+        self._keys: Dict[str, float] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def discard(self, user_id: str):
+        key = self._keys.pop(user_id, None)
+        if key is None:
+            return
+        entry = (key, user_id)
+        index = bisect.bisect_left(self._entries, entry)
+        if index < len(self._entries) and self._entries[index] == entry:
+            del self._entries[index]
+
+    def set(self, user_id: str, key: float):
+        if self._keys.get(user_id) == key:
+            return
+        self.discard(user_id)
+        self._keys[user_id] = key
+        bisect.insort(self._entries, (key, user_id))
+
+    def first(self, k: int) -> List[str]:
+        return [user_id for _, user_id in self._entries[:k]]
+
+
+class _Totals:
+    __slots__ = ("bets", "payouts", "games")
+
+    def __init__(self, bets: float = 0, payouts: float = 0, games: int = 0):
+        self.bets = bets
+        self.payouts = payouts
+        self.games = games
+
+
+class WindowedLeaderboard:
+    """Per-player window accumulators with RTP, bet volume and net profit rankings"""
+
+    def __init__(self, window_buckets: Optional[int] = None, bucket_seconds: int = 3600,
+                 min_bets: Optional[float] = None):
+        self.window_buckets = window_buckets or int(os.environ.get('LEADERBOARD_WINDOW_HOURS', '24'))
+        self.bucket_seconds = bucket_seconds
+        # Players below this bet volume are not ranked by RTP (one lucky spin is not a trend)
+        self.min_bets = min_bets if min_bets is not None else float(os.environ.get('LEADERBOARD_MIN_BETS', '0'))
+        self._lock = threading.Lock()
+        self._totals: Dict[str, _Totals] = {}
+        # bucket -> user_id -> contribution of that bucket
+        self._buckets: Dict[int, Dict[str, _Totals]] = {}
+        self._indexes = {metric: _SortedIndex() for metric in METRICS}
+        self._current_bucket = self._bucket_of(time.time())
+        self.seeded = False
+
+    def _bucket_of(self, timestamp: float) -> int:
+        return int(math.floor(timestamp / self.bucket_seconds) * self.bucket_seconds)
+
+    def window_start(self) -> int:
+        return self._current_bucket - (self.window_buckets - 1) * self.bucket_seconds
+
+    def aligned_start(self, hours: float, now: Optional[float] = None) -> int:
+        """Start of an ``hours`` window aligned the way the leaderboard's own window is"""
+        buckets = max(1, int(math.ceil(hours * 3600 / self.bucket_seconds)))
+        return self._bucket_of(now or time.time()) - (buckets - 1) * self.bucket_seconds
+
+    def window_hours(self) -> float:
+        return self.window_buckets * self.bucket_seconds / 3600
+
+    def _reindex(self, user_id: str):
+        totals = self._totals.get(user_id)
+        if totals is None or totals.games == 0:
+            self._totals.pop(user_id, None)
+            for index in self._indexes.values():
+                index.discard(user_id)
+            return
+        # Keys are negated so ascending order means best first
+        self._indexes["bets"].set(user_id, -totals.bets)
+        self._indexes["net_profit"].set(user_id, -(totals.payouts - totals.bets))
+        if totals.bets > 0 and totals.bets >= self.min_bets:
+            self._indexes["rtp"].set(user_id, -(totals.payouts / totals.bets * 100))
+        else:
+            self._indexes["rtp"].discard(user_id)
+
+    def _advance(self, bucket: int):
+        """Move the window forward and subtract every bucket that fell out"""
+        if bucket <= self._current_bucket:
+            return
+        self._current_bucket = bucket
+        window_start = self.window_start()
+        for expired in [b for b in self._buckets if b < window_start]:
+            for user_id, contribution in self._buckets.pop(expired).items():
+                totals = self._totals.get(user_id)
+                if totals is None:
+                    continue
+                totals.bets -= contribution.bets
+                totals.payouts -= contribution.payouts
+                totals.games -= contribution.games
+                self._reindex(user_id)
+
+    def _add(self, user_id: str, bucket: int, bets: float, payouts: float, games: int):
+        contribution = self._buckets.setdefault(bucket, {}).setdefault(user_id, _Totals())
+        contribution.bets += bets
+        contribution.payouts += payouts
+        contribution.games += games
+        totals = self._totals.setdefault(user_id, _Totals())
+        totals.bets += bets
+        totals.payouts += payouts
+        totals.games += games
+        self._reindex(user_id)
+
+    def record_game(self, game_data: Dict[str, Any]):
+        timestamp = game_data.get('timestamp') or time.time()
+        bucket = self._bucket_of(timestamp)
+        with self._lock:
+            self._advance(bucket)
+            if bucket < self.window_start():
+                # Too late for the window
+                return
+            self._add(
+                game_data.get('user_id'), bucket,
+                game_data.get('bet', 0), game_data.get('payout', 0), 1
+            )
+
+    def expire(self, now: Optional[float] = None):
+        """Advance the window on the clock even when no games arrive"""
+        with self._lock:
+            self._advance(self._bucket_of(now or time.time()))
+
+    def top(self, metric: str, k: int = 10) -> List[Dict[str, Any]]:
+        """Top K players for a metric, in the shape of the `by_player` aggregation"""
+        self.expire()
+        with self._lock:
+            result = []
+            for user_id in self._indexes[metric].first(k):
+                totals = self._totals[user_id]
+                result.append({
+                    "_id": user_id,
+                    "user_id": user_id,
+                    "total_bets": totals.bets,
+                    "total_payouts": totals.payouts,
+                    "game_count": totals.games,
+                    "net_profit": totals.payouts - totals.bets,
+                    "rtp": (totals.payouts / totals.bets * 100) if totals.bets > 0 else 0
+                })
+            return result
+
+    async def seed(self, repo):
+        """Load the current window from raw games once at startup"""
+        with self._lock:
+            self._advance(self._bucket_of(time.time()))
+            window_start = self.window_start()
+        rows = await repo.aggregate("games", [
+            {"$match": {"timestamp": {"$gte": window_start}}},
+            {
+                "$group": {
+                    "_id": {
+                        "user_id": "$user_id",
+                        "bucket": {"$subtract": ["$timestamp", {"$mod": ["$timestamp", self.bucket_seconds]}]}
+                    },
+                    "total_bets": {"$sum": "$bet"},
+                    "total_payouts": {"$sum": "$payout"},
+                    "game_count": {"$sum": 1}
+                }
+            }
+        ], heavy=True)
+        with self._lock:
+            for row in rows:
+                bucket = int(row["_id"]["bucket"])
+                if bucket >= self.window_start():
+                    self._add(row["_id"]["user_id"], bucket,
+                              row["total_bets"], row["total_payouts"], row["game_count"])
+            self.seeded = True
+        logger.info("Leaderboard seeded with %d player-buckets", len(rows))
+
+    def aggregation_pipeline(self, metric: str, k: int = 10, since: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Equivalent Mongo aggregation over the same aligned window (or from `since`),
+        for verification and for windows the leaderboard does not keep
+        """
+        sort_field = {"rtp": "rtp", "bets": "total_bets", "net_profit": "net_profit"}[metric]
+        pipeline: List[Dict[str, Any]] = [
+            {"$match": {"timestamp": {"$gte": self.window_start() if since is None else since}}},
+            {
+                "$group": {
+                    "_id": "$user_id",
+                    "total_bets": {"$sum": "$bet"},
+                    "total_payouts": {"$sum": "$payout"},
+                    "game_count": {"$sum": 1}
+                }
+            },
+            {
+                "$project": {
+                    "user_id": "$_id",
+                    "total_bets": 1,
+                    "total_payouts": 1,
+                    "game_count": 1,
+                    "net_profit": {"$subtract": ["$total_payouts", "$total_bets"]},
+                    "rtp": {
+                        "$cond": [
+                            {"$gt": ["$total_bets", 0]},
+                            {"$multiply": [{"$divide": ["$total_payouts", "$total_bets"]}, 100]},
+                            0
+                        ]
+                    }
+                }
+            }
+        ]
+        if metric == "rtp":
+            pipeline.append({"$match": {"total_bets": {"$gt": 0, "$gte": self.min_bets}}})
+        pipeline += [{"$sort": {sort_field: -1, "user_id": 1}}, {"$limit": k}]
+        return pipeline
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "seeded": self.seeded,
+                "players": len(self._totals),
+                "buckets": len(self._buckets),
+                "window_start": self.window_start(),
+                "window_hours": self.window_hours(),
+                "min_bets": self.min_bets,
+                "rtp_eligible": len(self._indexes["rtp"])
+            }
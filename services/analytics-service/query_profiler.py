@@ -0,0 +1,266 @@
+"""
+Shared MongoDB query instrumentation for Sentry POC services.
+
+Wraps pymongo calls to record duration and documents returned for every
+query. Queries slower than a threshold get an ``explain("executionStats")``
+in a background thread - rate limited globally and per query name - which adds
+documents examined, keys examined and the winning plan. The result is attached
+to the query's span and kept in a ring buffer for the ``slow-queries`` debug
+endpoints.
+
+Each service image only contains its own directory, so this file is copied
+into analytics-service/ and game-engine/ - keep the copies in sync.
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import sentry_sdk
+
+logger = logging.getLogger(__name__)
+
+# Call options that change the plan and so must be explained too
+_PLAN_OPTIONS = ("hint", "collation", "let")
+
+
+def _plan_stages(plan: Any) -> List[str]:
+    """Stage names of a winning plan, outermost first (e.g. FETCH > IXSCAN)"""
+    stages: List[str] = []
+    while isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        # Classic plans nest inputStage(s); SBE plans wrap them in queryPlan
+        plan = plan.get("queryPlan") or plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return stages
+
+
+def _find_key(doc: Any, key: str) -> Any:
+    """First value stored under ``key`` anywhere in an explain document"""
+    if isinstance(doc, dict):
+        if key in doc:
+            return doc[key]
+        values = doc.values()
+    elif isinstance(doc, list):
+        values = doc
+    else:
+        return None
+    for value in values:
+        found = _find_key(value, key)
+        if found is not None:
+            return found
+    return None
+
+
+def summarize_explain(explain: Dict[str, Any]) -> Dict[str, Any]:
+    """Pull the numbers worth looking at out of an explain document"""
+    stats = _find_key(explain, "executionStats") or {}
+    stages = _plan_stages(_find_key(explain, "winningPlan"))
+    return {
+        "docs_examined": stats.get("totalDocsExamined"),
+        "keys_examined": stats.get("totalKeysExamined"),
+        "n_returned": stats.get("nReturned"),
+        "execution_time_ms": stats.get("executionTimeMillis"),
+        "plan": " > ".join(stages) if stages else None,
+        "collection_scan": "COLLSCAN" in stages,
+    }
+
+
+class QueryProfiler:
+    """Times pymongo calls and explains the slow ones in the background"""
+
+    def __init__(self, db, service: str, threshold_ms: Optional[float] = None,
+                 explains_per_minute: Optional[int] = None, buffer_size: Optional[int] = None):
+        self.db = db
+        self.service = service
+        self.threshold_ms = threshold_ms or float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', '500'))
+        self.explains_per_minute = explains_per_minute or int(os.environ.get('SLOW_QUERY_EXPLAINS_PER_MINUTE', '6'))
+        # The same query is explained at most once per cooldown
+        self.explain_cooldown = float(os.environ.get('SLOW_QUERY_EXPLAIN_COOLDOWN_SECONDS', '60'))
+        self.explain_max_time_ms = int(os.environ.get('SLOW_QUERY_EXPLAIN_MAX_TIME_MS', '10000'))
+        self.enabled = os.environ.get('SLOW_QUERY_EXPLAIN', 'true').lower() in ('1', 'true', 'yes')
+        self._slow: deque = deque(maxlen=buffer_size or int(os.environ.get('SLOW_QUERY_BUFFER_SIZE', '50')))
+        self._lock = threading.Lock()
+        self._explain_times: deque = deque()
+        self._last_explained: Dict[str, float] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{service}-explain")
+        self._counters = {
+            "queries": 0,
+            "slow_queries": 0,
+            "explains": 0,
+            "explains_rate_limited": 0,
+            "explain_errors": 0,
+        }
+
+    # --- wrappers -------------------------------------------------------
+
+    def aggregate(self, collection, pipeline: List[Dict[str, Any]], name: Optional[str] = None,
+                  **kwargs) -> List[Dict[str, Any]]:
+        command = {"aggregate": collection.name, "pipeline": pipeline, "cursor": {}}
+        return self.profile(name or f"{collection.name}.aggregate", collection.name, "aggregate", command,
+                            lambda: list(collection.aggregate(pipeline, **kwargs)), kwargs)
+
+    def find(self, collection, filter: Optional[Dict[str, Any]] = None,
+             projection: Optional[Dict[str, Any]] = None, name: Optional[str] = None,
+             **kwargs) -> List[Dict[str, Any]]:
+        command = {"find": collection.name, "filter": filter or {}}
+        if projection:
+            command["projection"] = projection
+        return self.profile(name or f"{collection.name}.find", collection.name, "find", command,
+                            lambda: list(collection.find(filter, projection, **kwargs)), kwargs)
+
+    def find_one(self, collection, filter: Optional[Dict[str, Any]] = None, *args,
+                 name: Optional[str] = None, **kwargs) -> Optional[Dict[str, Any]]:
+        command = {"find": collection.name, "filter": filter or {}, "limit": 1}
+        return self.profile(name or f"{collection.name}.find_one", collection.name, "find_one", command,
+                            lambda: collection.find_one(filter, *args, **kwargs), kwargs)
+
+    def count_documents(self, collection, filter: Dict[str, Any], name: Optional[str] = None,
+                        **kwargs) -> int:
+        command = {"count": collection.name, "query": filter}
+        return self.profile(name or f"{collection.name}.count", collection.name, "count", command,
+                            lambda: collection.count_documents(filter, **kwargs), kwargs)
+
+    def distinct(self, collection, key: str, filter: Optional[Dict[str, Any]] = None,
+                 name: Optional[str] = None, **kwargs) -> List[Any]:
+        command = {"distinct": collection.name, "key": key, "query": filter or {}}
+        return self.profile(name or f"{collection.name}.distinct", collection.name, "distinct", command,
+                            lambda: collection.distinct(key, filter, **kwargs), kwargs)
+
+    def insert_one(self, collection, document: Dict[str, Any], name: Optional[str] = None, **kwargs):
+        # Inserts cannot be explained - they are only timed
+        return self.profile(name or f"{collection.name}.insert", collection.name, "insert", None,
+                            lambda: collection.insert_one(document, **kwargs), kwargs)
+
+    def insert_many(self, collection, documents: List[Dict[str, Any]], name: Optional[str] = None, **kwargs):
+        return self.profile(name or f"{collection.name}.insert_many", collection.name, "insert", None,
+                            lambda: collection.insert_many(documents, **kwargs), kwargs)
+
+    # --- core -----------------------------------------------------------
+
+    def profile(self, name: str, collection: str, operation: str,
+                command: Optional[Dict[str, Any]], call: Callable[[], Any],
+                options: Optional[Dict[str, Any]] = None) -> Any:
+        """Run ``call`` and record it; ``command`` is what gets explained if it is slow"""
+        started = time.perf_counter()
+        result = call()
+        duration_ms = (time.perf_counter() - started) * 1000
+
+        if isinstance(result, list):
+            docs_returned = len(result)
+        elif isinstance(result, dict):
+            docs_returned = 1
+        elif result is None and operation == "find_one":
+            docs_returned = 0
+        else:
+            docs_returned = None
+
+        span = sentry_sdk.get_current_span()
+        if span is not None:
+            span.set_data(f"db.query.{name}.duration_ms", round(duration_ms, 2))
+            if docs_returned is not None:
+                span.set_data(f"db.query.{name}.docs_returned", docs_returned)
+
+        with self._lock:
+            self._counters["queries"] += 1
+        if duration_ms >= self.threshold_ms:
+            self._record_slow(name, collection, operation, command, options or {},
+                              duration_ms, docs_returned, span)
+        return result
+
+    def _record_slow(self, name: str, collection: str, operation: str,
+                     command: Optional[Dict[str, Any]], options: Dict[str, Any],
+                     duration_ms: float, docs_returned: Optional[int], span):
+        entry: Dict[str, Any] = {
+            "timestamp": time.time(),
+            "service": self.service,
+            "name": name,
+            "collection": collection,
+            "operation": operation,
+            "duration_ms": round(duration_ms, 2),
+            "docs_returned": docs_returned,
+            "docs_examined": None,
+            "keys_examined": None,
+            "plan": None,
+            "explain": "pending" if command is not None else "not_supported",
+            "trace_id": getattr(span, "trace_id", None),
+        }
+        with self._lock:
+            self._counters["slow_queries"] += 1
+            self._slow.append(entry)
+            explain = command is not None and self._take_explain_slot(name)
+        if span is not None:
+            span.set_tag("db.slow_query", "true")
+            span.set_data(f"db.query.{name}.slow", True)
+        if not explain:
+            if entry["explain"] == "pending":
+                entry["explain"] = "rate_limited"
+            return
+
+        command = dict(command)
+        command.update({k: v for k, v in options.items() if k in _PLAN_OPTIONS})
+        command["maxTimeMS"] = self.explain_max_time_ms
+        self._executor.submit(self._explain, entry, command, span)
+
+    def _take_explain_slot(self, name: str) -> bool:
+        """Global per-minute budget plus a per-query cooldown (caller holds the lock)"""
+        now = time.monotonic()
+        if not self.enabled:
+            return False
+        if now - self._last_explained.get(name, float("-inf")) < self.explain_cooldown:
+            self._counters["explains_rate_limited"] += 1
+            return False
+        while self._explain_times and now - self._explain_times[0] > 60:
+            self._explain_times.popleft()
+        if len(self._explain_times) >= self.explains_per_minute:
+            self._counters["explains_rate_limited"] += 1
+            return False
+        self._explain_times.append(now)
+        self._last_explained[name] = now
+        return True
+
+    def _explain(self, entry: Dict[str, Any], command: Dict[str, Any], span):
+        try:
+            explain = self.db.command("explain", command, verbosity="executionStats")
+            summary = summarize_explain(explain)
+            entry.update(summary)
+            entry["explain"] = "done"
+            entry["winning_plan"] = _find_key(explain, "winningPlan")
+            with self._lock:
+                self._counters["explains"] += 1
+            if span is not None:
+                # Lands on the event as long as the transaction is still open
+                span.set_data("db.explain", {**summary, "query": entry["name"]})
+            logger.warning(
+                "Slow query %s (%.0f ms): plan=%s docs_examined=%s keys_examined=%s returned=%s",
+                entry["name"], entry["duration_ms"], summary["plan"],
+                summary["docs_examined"], summary["keys_examined"], entry["docs_returned"]
+            )
+        except Exception as e:
+            entry["explain"] = f"error: {e}"
+            with self._lock:
+                self._counters["explain_errors"] += 1
+            logger.warning("explain() for %s failed: %s", entry["name"], e)
+
+    def slow_queries(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """Most recent slow queries first"""
+        with self._lock:
+            entries = list(self._slow)
+        return [dict(entry) for entry in reversed(entries)][:limit]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "service": self.service,
+                "threshold_ms": self.threshold_ms,
+                "explains_per_minute": self.explains_per_minute,
+                "explain_enabled": self.enabled,
+                "buffered": len(self._slow),
+                **self._counters,
+            }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
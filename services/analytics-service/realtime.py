@@ -0,0 +1,270 @@
+"""
+In-memory realtime analytics pushed to dashboards over Server-Sent Events.
+
+``RealtimeState`` mirrors today's realtime summary and is updated by the
+RabbitMQ consumer thread as messages arrive. ``RealtimeBroadcaster`` snapshots
+it once per tick, encodes one coalesced delta and fans the same bytes out to
+every subscriber, so the cost per tick does not depend on the number of
+viewers. Each subscriber has a bounded queue; a client that falls behind has
+its backlog dropped and receives a full snapshot instead.
+"""
+import os
+import json
+import time
+import asyncio
+import calendar
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+GAME_FIELDS = ("total_games", "total_bets", "total_payouts", "total_wins")
+PAYMENT_FIELDS = ("total_credits", "credit_amount", "total_debits", "debit_amount")
+
+
+def _utc_date(timestamp: Optional[float] = None) -> str:
+    if timestamp is None:
+        timestamp = time.time()
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).date().isoformat()
+
+
+class RealtimeState:
+    """Thread-safe mirror of today's game and payment counters"""
+
+    def __init__(self, active_window: Optional[float] = None):
+        self.active_window = active_window or float(os.environ.get('REALTIME_ACTIVE_WINDOW_SECONDS', '3600'))
+        self._lock = threading.Lock()
+        self._date = _utc_date()
+        self._games = dict.fromkeys(GAME_FIELDS, 0)
+        self._payments = dict.fromkeys(PAYMENT_FIELDS, 0)
+        self._unique_players: Set[str] = set()
+        # user_id -> last game timestamp, oldest first
+        self._last_seen: "OrderedDict[str, float]" = OrderedDict()
+        self.version = 0
+        self.seeded = False
+
+    def _roll_day(self, date: str):
+        """Reset the daily counters when a message from a newer day arrives"""
+        if date > self._date:
+            self._date = date
+            self._games = dict.fromkeys(GAME_FIELDS, 0)
+            self._payments = dict.fromkeys(PAYMENT_FIELDS, 0)
+            self._unique_players = set()
+
+    def record_game(self, game_data: Dict[str, Any]):
+        timestamp = game_data.get('timestamp') or time.time()
+        user_id = game_data.get('user_id')
+        with self._lock:
+            date = _utc_date(timestamp)
+            self._roll_day(date)
+            if date == self._date:
+                self._games["total_games"] += 1
+                self._games["total_bets"] += game_data.get('bet', 0)
+                self._games["total_payouts"] += game_data.get('payout', 0)
+                self._games["total_wins"] += 1 if game_data.get('win') else 0
+                self._unique_players.add(user_id)
+            if timestamp >= self._last_seen.get(user_id, 0):
+                self._last_seen[user_id] = timestamp
+                self._last_seen.move_to_end(user_id)
+            self.version += 1
+
+    def record_payment(self, payment_data: Dict[str, Any], event_type: str):
+        with self._lock:
+            self._roll_day(_utc_date())
+            self._payments[f"total_{event_type}s"] = self._payments.get(f"total_{event_type}s", 0) + 1
+            self._payments[f"{event_type}_amount"] = (
+                self._payments.get(f"{event_type}_amount", 0) + payment_data.get('amount', 0)
+            )
+            self.version += 1
+
+    def _active_players(self, now: float) -> int:
+        """Count players seen in the active window, expiring the oldest first"""
+        cutoff = now - self.active_window
+        while self._last_seen:
+            user_id, last_seen = next(iter(self._last_seen.items()))
+            if last_seen >= cutoff:
+                break
+            self._last_seen.popitem(last=False)
+        return len(self._last_seen)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Summary in the shape of /realtime/summary"""
+        now = time.time()
+        with self._lock:
+            self._roll_day(_utc_date(now))
+            games = dict(self._games)
+            payments = dict(self._payments)
+            unique_players = len(self._unique_players)
+            active_players = self._active_players(now)
+            version = self.version
+            date = self._date
+
+        return {
+            "version": version,
+            "date": date,
+            "today": {
+                **games,
+                "win_rate": (games["total_wins"] / games["total_games"] * 100) if games["total_games"] > 0 else 0,
+                "unique_players": unique_players,
+                "active_players_1h": active_players
+            },
+            "payments": {
+                **payments,
+                "net_revenue": payments.get("debit_amount", 0) - payments.get("credit_amount", 0)
+            }
+        }
+
+    async def seed(self, repo):
+        """Load today's counters from the pre-aggregated collections once at startup"""
+        today = _utc_date()
+        cutoff = time.time() - self.active_window
+        daily_stats = await repo.find_one("daily_stats", {"date": today}) or {}
+        payment_stats = await repo.find_one("daily_payments", {"date": today}) or {}
+        recent_players = await repo.find(
+            "player_stats",
+            {"last_played": {"$gte": datetime.fromtimestamp(cutoff, tz=timezone.utc)}},
+            {"_id": 0, "user_id": 1, "last_played": 1}
+        )
+
+        with self._lock:
+            if today == self._date:
+                for field in GAME_FIELDS:
+                    self._games[field] += daily_stats.get(field, 0)
+                for field in PAYMENT_FIELDS:
+                    self._payments[field] += payment_stats.get(field, 0)
+                self._unique_players.update(daily_stats.get("unique_players", []))
+            seen = {}
+            for player in recent_players:
+                # pymongo returns naive UTC datetimes
+                seen[player["user_id"]] = calendar.timegm(player["last_played"].utctimetuple())
+            for user_id, last_seen in self._last_seen.items():
+                seen[user_id] = max(last_seen, seen.get(user_id, 0))
+            self._last_seen = OrderedDict(sorted(seen.items(), key=lambda item: item[1]))
+            self.version += 1
+            self.seeded = True
+        logger.info("Realtime state seeded for %s (%d active players)", today, len(recent_players))
+
+
+class _Subscriber:
+    __slots__ = ("queue", "needs_snapshot", "dropped")
+
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.needs_snapshot = True
+        self.dropped = 0
+
+
+def _encode(event: str, payload: Dict[str, Any]) -> str:
+    return f"id: {payload.get('version', 0)}\nevent: {event}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n"
+
+
+def _delta(previous: Dict[str, Any], current: Dict[str, Any]) -> Dict[str, Any]:
+    """Changed leaf values of the nested summary"""
+    changes: Dict[str, Any] = {}
+    for section in ("today", "payments"):
+        changed = {
+            key: value for key, value in current[section].items()
+            if previous.get(section, {}).get(key) != value
+        }
+        if changed:
+            changes[section] = changed
+    if previous.get("date") != current["date"]:
+        changes["date"] = current["date"]
+    return changes
+
+
+class RealtimeBroadcaster:
+    """Ticks at a fixed rate and fans one encoded delta out to every subscriber"""
+
+    def __init__(self, state: RealtimeState, tick_seconds: Optional[float] = None,
+                 queue_size: Optional[int] = None):
+        self.state = state
+        self.tick_seconds = tick_seconds or float(os.environ.get('REALTIME_TICK_SECONDS', '1.0'))
+        self.queue_size = queue_size or int(os.environ.get('REALTIME_CLIENT_QUEUE_SIZE', '16'))
+        self._subscribers: Set[_Subscriber] = set()
+        self._last: Dict[str, Any] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.ticks = 0
+        self.slow_consumer_resets = 0
+
+    def subscribe(self) -> _Subscriber:
+        subscriber = _Subscriber(self.queue_size)
+        self._subscribers.add(subscriber)
+        if self._last:
+            self._send_snapshot(subscriber, _encode("snapshot", self._last))
+        return subscriber
+
+    def unsubscribe(self, subscriber: _Subscriber):
+        self._subscribers.discard(subscriber)
+
+    def _send_snapshot(self, subscriber: _Subscriber, encoded: str):
+        # Anything still queued is superseded by the snapshot
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        subscriber.queue.put_nowait(encoded)
+        subscriber.needs_snapshot = False
+
+    def _tick(self):
+        if not self._subscribers:
+            return
+        current = self.state.snapshot()
+        snapshot_event = None
+        delta_event = None
+        if self._last:
+            changes = _delta(self._last, current)
+            if changes:
+                changes["version"] = current["version"]
+                delta_event = _encode("delta", changes)
+        self._last = current
+        self.ticks += 1
+
+        for subscriber in list(self._subscribers):
+            if subscriber.needs_snapshot:
+                snapshot_event = snapshot_event or _encode("snapshot", current)
+                self._send_snapshot(subscriber, snapshot_event)
+                continue
+            if delta_event is None:
+                continue
+            try:
+                subscriber.queue.put_nowait(delta_event)
+            except asyncio.QueueFull:
+                # Slow consumer: drop its backlog and resync with a snapshot
+                subscriber.dropped += subscriber.queue.qsize()
+                self.slow_consumer_resets += 1
+                snapshot_event = snapshot_event or _encode("snapshot", current)
+                self._send_snapshot(subscriber, snapshot_event)
+
+    async def _run(self):
+        while True:
+            try:
+                self._tick()
+            except Exception as e:
+                logger.error("Realtime broadcast tick failed: %s", e)
+            await asyncio.sleep(self.tick_seconds)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "subscribers": len(self._subscribers),
+            "tick_seconds": self.tick_seconds,
+            "queue_size": self.queue_size,
+            "ticks": self.ticks,
+            "slow_consumer_resets": self.slow_consumer_resets,
+            "state_version": self.state.version,
+            "state_seeded": self.state.seeded
+        }
@@ -0,0 +1,261 @@
+"""
+Async data-access layer for the analytics service.
+
+pymongo is synchronous, so calling it from an ``async def`` endpoint blocks the
+uvicorn event loop for the whole round trip. Every call made through
+``AnalyticsRepository`` is dispatched to a dedicated, bounded thread pool and
+awaited instead. Heavy aggregations (full scans, ``$facet``, ``$lookup``) also
+go through a separate semaphore so a burst of dashboard queries can never take
+every worker thread away from the cheap lookups.
+
+Queries run under the request deadline (see ``deadlines``): the remaining
+budget is sent as ``maxTimeMS`` and bounds the client-side wait. A query that
+outlives its budget, or whose client disconnected, is killed on the server
+through ``$currentOp``/``killOp`` using the comment it was tagged with.
+
+Every query goes through the shared ``QueryProfiler``, which times it and
+explains the slow ones in the background.
+
+Queries against ``"games"`` are written for the standard layout and are
+translated by ``GameStore`` when game records live in a time-series
+collection (GAMES_STORAGE=timeseries).
+"""
+import os
+import uuid
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from pymongo.errors import ExecutionTimeout
+
+import deadlines
+from deadlines import QueryTimeout
+from query_profiler import QueryProfiler
+from game_store import GameStore
+from stack_sampler import stack_sampler
+
+logger = logging.getLogger(__name__)
+
+
+class AnalyticsRepository:
+    """Awaitable wrapper around the synchronous pymongo database handle"""
+
+    def __init__(self, db, max_workers: Optional[int] = None, heavy_limit: Optional[int] = None,
+                 profiler: Optional[QueryProfiler] = None, games: Optional[GameStore] = None):
+        self.db = db
+        self.games = games or GameStore(db)
+        self.profiler = profiler or QueryProfiler(db, service="analytics-service")
+        self.max_workers = max_workers or int(os.environ.get('ANALYTICS_DB_POOL_SIZE', '16'))
+        # Keep at least one thread free for light queries
+        self.heavy_limit = min(
+            heavy_limit or int(os.environ.get('ANALYTICS_HEAVY_QUERY_LIMIT', '4')),
+            max(self.max_workers - 1, 1)
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="analytics-db"
+        )
+        # Created lazily so it binds to the loop uvicorn actually runs
+        self._heavy_semaphore: Optional[asyncio.Semaphore] = None
+        # Separate thread so kills are not stuck behind the queries they target
+        self._killer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analytics-db-kill")
+        # How often a running query checks whether its client went away
+        self.disconnect_poll_seconds = float(os.environ.get('ANALYTICS_DISCONNECT_POLL_SECONDS', '0.25'))
+
+    def _heavy(self) -> asyncio.Semaphore:
+        if self._heavy_semaphore is None:
+            self._heavy_semaphore = asyncio.Semaphore(self.heavy_limit)
+        return self._heavy_semaphore
+
+    @staticmethod
+    def _bind(fn: Callable, *args, **kwargs) -> Callable[[], Any]:
+        """
+        ``fn(*args, **kwargs)`` to run on a worker thread.
+
+        The current context is copied into the worker thread so Sentry spans
+        (including the PyMongo integration spans) stay attached to the
+        request transaction, and a running /api/debug/profile keeps counting
+        the worker's stack under the endpoint that submitted it.
+        """
+        ctx = contextvars.copy_context()
+        return functools.partial(stack_sampler.attributed, stack_sampler.capture_origin(), ctx.run, fn, *args, **kwargs)
+
+    async def run(self, fn: Callable, *args, heavy: bool = False, **kwargs) -> Any:
+        """Run a blocking callable on the repository thread pool"""
+        loop = asyncio.get_event_loop()
+        call = self._bind(fn, *args, **kwargs)
+        if heavy:
+            async with self._heavy():
+                return await loop.run_in_executor(self._executor, call)
+        return await loop.run_in_executor(self._executor, call)
+
+    async def _query(self, name: str, call: Callable[[Dict[str, Any]], Any],
+                     heavy: bool = False) -> Any:
+        """
+        Run ``call(options)`` under the current request deadline, if any.
+
+        ``options`` holds ``maxTimeMS`` and ``comment`` for the command. The
+        comment identifies the operation on the server so it can be killed.
+        """
+        deadline = deadlines.current()
+        if deadline is None:
+            return await self.run(call, {}, heavy=heavy)
+
+        comment = f"analytics:{name}:{uuid.uuid4().hex[:12]}"
+        loop = asyncio.get_event_loop()
+        try:
+            if heavy:
+                try:
+                    await asyncio.wait_for(self._heavy().acquire(), timeout=deadline.remaining())
+                except asyncio.TimeoutError:
+                    raise QueryTimeout(deadline.endpoint, name, "queued")
+            try:
+                max_time_ms = deadline.remaining_ms()
+                if max_time_ms <= 0:
+                    raise QueryTimeout(deadline.endpoint, name, "deadline")
+                options = {"maxTimeMS": max_time_ms, "comment": comment}
+                future = loop.run_in_executor(self._executor, self._bind(call, options))
+                try:
+                    reason = await self._wait(future, deadline)
+                except asyncio.CancelledError:
+                    self._kill(comment)
+                    raise
+                if reason is None:
+                    try:
+                        return future.result()
+                    except ExecutionTimeout:
+                        # The server enforced maxTimeMS itself - nothing to kill
+                        raise QueryTimeout(deadline.endpoint, name, "max_time_ms")
+                # Let the abandoned thread finish quietly once the op is killed
+                future.add_done_callback(lambda f: f.exception())
+                self._kill(comment)
+                raise QueryTimeout(deadline.endpoint, name, reason)
+            finally:
+                if heavy:
+                    self._heavy().release()
+        except QueryTimeout as e:
+            deadlines.metrics.record_timeout(e)
+            logger.warning("Query %s abandoned for %s: %s", name, deadline.endpoint, e.reason)
+            raise
+
+    async def _wait(self, future: asyncio.Future, deadline: "deadlines.Deadline") -> Optional[str]:
+        """Wait for a query; return None when done, else why it was abandoned"""
+        while True:
+            remaining = deadline.remaining()
+            if remaining <= 0:
+                return "deadline"
+            done, _ = await asyncio.wait({future}, timeout=min(remaining, self.disconnect_poll_seconds))
+            if done:
+                return None
+            if deadline.is_disconnected is not None and await deadline.is_disconnected():
+                return "disconnected"
+
+    def _kill(self, comment: str):
+        """Kill server operations tagged with ``comment`` in the background"""
+        deadlines.metrics.count("kills_requested")
+
+        def _kill_ops():
+            admin = self.db.client.admin
+            ops = admin.aggregate([
+                {"$currentOp": {"allUsers": True, "localOps": True}},
+                {"$match": {"$or": [
+                    {"command.comment": comment},
+                    {"cursor.originatingCommand.comment": comment}
+                ]}},
+                {"$project": {"opid": 1}}
+            ])
+            killed = 0
+            for op in ops:
+                admin.command("killOp", op=op["opid"])
+                killed += 1
+            return killed
+
+        def _done(future):
+            try:
+                deadlines.metrics.count("ops_killed", future.result())
+            except Exception as e:
+                deadlines.metrics.count("kill_errors")
+                logger.warning("Failed to kill operation %s: %s", comment, e)
+
+        self._killer.submit(_kill_ops).add_done_callback(_done)
+
+    async def aggregate(self, collection: str, pipeline: List[Dict[str, Any]],
+                        heavy: bool = False, name: Optional[str] = None,
+                        **kwargs) -> List[Dict[str, Any]]:
+        """Run an aggregation pipeline and return the materialized results"""
+        name = name or f"{collection}.aggregate"
+        if collection == "games":
+            collection, pipeline = self.games.collection_name, self.games.translate_pipeline(pipeline)
+        def _aggregate(options):
+            return self.profiler.aggregate(self.db[collection], pipeline, name=name, **options, **kwargs)
+        return await self._query(name, _aggregate, heavy=heavy)
+
+    async def count_documents(self, collection: str, filter: Dict[str, Any],
+                              name: Optional[str] = None, **kwargs) -> int:
+        name = name or f"{collection}.count"
+        if collection == "games":
+            collection, filter = self.games.collection_name, self.games.translate_filter(filter)
+        def _count(options):
+            return self.profiler.count_documents(self.db[collection], filter, name=name, **options, **kwargs)
+        return await self._query(name, _count)
+
+    async def distinct(self, collection: str, key: str,
+                       filter: Optional[Dict[str, Any]] = None,
+                       name: Optional[str] = None, **kwargs) -> List[Any]:
+        name = name or f"{collection}.distinct"
+        if collection == "games":
+            collection, key = self.games.collection_name, self.games.translate_field(key)
+            filter = self.games.translate_filter(filter)
+        def _distinct(options):
+            return self.profiler.distinct(self.db[collection], key, filter, name=name, **options, **kwargs)
+        return await self._query(name, _distinct)
+
+    async def find_one(self, collection: str, filter: Optional[Dict[str, Any]] = None,
+                       *args, name: Optional[str] = None, **kwargs) -> Optional[Dict[str, Any]]:
+        name = name or f"{collection}.find_one"
+        games = collection == "games"
+        if games:
+            collection, filter = self.games.collection_name, self.games.translate_filter(filter)
+            if "sort" in kwargs:
+                kwargs["sort"] = self.games.translate_sort(kwargs["sort"])
+        def _find_one(options):
+            document = self.profiler.find_one(self.db[collection], filter, *args, name=name,
+                                              **_find_options(options), **kwargs)
+            return self.games.from_document(document) if games else document
+        return await self._query(name, _find_one)
+
+    async def find(self, collection: str, filter: Optional[Dict[str, Any]] = None,
+                   projection: Optional[Dict[str, Any]] = None,
+                   name: Optional[str] = None, **kwargs) -> List[Dict[str, Any]]:
+        """Run a find and return the materialized results"""
+        name = name or f"{collection}.find"
+        games = collection == "games"
+        if games:
+            collection, filter = self.games.collection_name, self.games.translate_filter(filter)
+            projection = self.games.translate_projection(projection)
+            if "sort" in kwargs:
+                kwargs["sort"] = self.games.translate_sort(kwargs["sort"])
+        def _find(options):
+            documents = self.profiler.find(self.db[collection], filter, projection, name=name,
+                                           **_find_options(options), **kwargs)
+            return [self.games.from_document(d) for d in documents] if games else documents
+        return await self._query(name, _find)
+
+    def close(self):
+        """Stop accepting work; in-flight queries finish on their own"""
+        self._executor.shutdown(wait=False)
+        self._killer.shutdown(wait=False)
+        self.profiler.close()
+        logger.info("Analytics repository thread pool shut down")
+
+
+def _find_options(options: Dict[str, Any]) -> Dict[str, Any]:
+    """find() spells maxTimeMS as max_time_ms"""
+    if "maxTimeMS" not in options:
+        return options
+    options = dict(options)
+    options["max_time_ms"] = options.pop("maxTimeMS")
+    return options
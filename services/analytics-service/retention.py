@@ -0,0 +1,463 @@
+"""
+Tiered retention for game records.
+
+MongoDB only keeps a hot window of games (ANALYTICS_RETENTION_HOT_DAYS).
+Older games are moved, one time-ordered chunk at a time, into compressed
+columnar segment files (``numpy.savez_compressed``) under
+ANALYTICS_ARCHIVE_DIR, next to a small JSON index that lists every segment
+with its time range and totals.
+
+Archiving a chunk:
+
+1. read the chunk's games from Mongo, oldest first, ANALYTICS_ARCHIVE_READ_BATCH
+   at a time, packing each batch into column arrays
+2. write the segment to a temporary file, fsync and rename it into place
+3. record the segment in the index and advance the watermark (same atomic
+   rename) - everything below the watermark is now served from the archive
+4. delete the archived games from Mongo in small batches, so ingestion never
+   waits on a long delete, then mark the segment as deleted
+
+A crash at any point is resumed on the next pass: a segment that never made
+it into the index is simply rewritten, and a segment whose games were not
+fully deleted yet has its deletes replayed from the ``game_id`` column.
+Time-series collections (GAMES_STORAGE=timeseries) cannot delete single
+documents on MongoDB 5.0, so there the collection's ``expireAfterSeconds``
+drops games a grace period after they were archived.
+
+``HybridGamesReport`` answers long-range reports from both tiers: archive
+segments below the watermark, Mongo above it.
+"""
+import os
+import json
+import math
+import time
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from bson import ObjectId
+
+from game_store import GameStore
+from telemetry import batch_sizes
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+DAY = 86400
+
+INDEX_FILE = "index.json"
+INDEX_VERSION = 1
+
+# Columns stored in every segment
+COLUMNS = ("timestamp", "bet", "payout", "win", "user_idx", "users", "game_id", "symbols")
+# Columns needed for bucket aggregates
+SCAN_COLUMNS = ("timestamp", "bet", "payout", "win", "user_idx", "users")
+
+
+def retention_enabled() -> bool:
+    return os.environ.get('ANALYTICS_RETENTION_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+
+def _write_atomic(path: str, write):
+    """write(file) into path.tmp, fsync, then rename over path"""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _empty_totals() -> Dict[str, Any]:
+    return {"total_games": 0, "total_bets": 0.0, "total_payouts": 0.0, "total_wins": 0,
+            "max_payout": 0, "players": set()}
+
+
+class ArchiveStore:
+    """Segment files plus their index in one directory"""
+
+    def __init__(self, path: Optional[str] = None, cache_segments: Optional[int] = None):
+        self.path = path or os.environ.get('ANALYTICS_ARCHIVE_DIR', 'archive')
+        self.cache_segments = cache_segments or int(os.environ.get('ANALYTICS_ARCHIVE_CACHE_SEGMENTS', '16'))
+        self._lock = threading.Lock()
+        self._index: Dict[str, Any] = {"version": INDEX_VERSION, "watermark": None, "segments": []}
+        self._index_mtime: Optional[float] = None
+        self._segments: "OrderedDict[str, Dict[str, np.ndarray]]" = OrderedDict()
+
+    # --- index ----------------------------------------------------------
+
+    def index(self) -> Dict[str, Any]:
+        """Current index; reloaded when another process (the archiver) rewrote it"""
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with self._lock:
+            try:
+                mtime = os.stat(index_path).st_mtime
+            except FileNotFoundError:
+                return self._index
+            if mtime != self._index_mtime:
+                with open(index_path) as f:
+                    self._index = json.load(f)
+                self._index_mtime = mtime
+            return self._index
+
+    def save_index(self, index: Dict[str, Any]):
+        os.makedirs(self.path, exist_ok=True)
+        payload = json.dumps(index, indent=1).encode()
+        _write_atomic(os.path.join(self.path, INDEX_FILE), lambda f: f.write(payload))
+        with self._lock:
+            self._index = index
+            self._index_mtime = None
+
+    def watermark(self) -> Optional[float]:
+        """Games older than this are served from the archive"""
+        return self.index().get("watermark")
+
+    # --- segments -------------------------------------------------------
+
+    @staticmethod
+    def segment_name(start: float) -> str:
+        return f"games-{int(start)}.npz"
+
+    def write_segment(self, start: float, end: float,
+                      batches: Iterable[List[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+        """
+        Write batches of records (already in time order) as one segment; return its
+        index entry, or None when there were no records. Each batch is packed into
+        column arrays right away, so only the compact columns of the whole chunk
+        are held, never its records.
+        """
+        users: Dict[str, int] = {}
+        parts: Dict[str, List[np.ndarray]] = {column: [] for column in COLUMNS if column != "users"}
+        for records in batches:
+            parts["timestamp"].append(np.array([r["timestamp"] for r in records], dtype=np.float64))
+            parts["bet"].append(np.array([r.get("bet") or 0 for r in records], dtype=np.float64))
+            parts["payout"].append(np.array([r.get("payout") or 0 for r in records], dtype=np.float64))
+            parts["win"].append(np.array([bool(r.get("win")) for r in records], dtype=np.bool_))
+            # Dictionary-encoded: a few thousand players across millions of games
+            parts["user_idx"].append(np.array(
+                [users.setdefault(str(r.get("user_id")), len(users)) for r in records], dtype=np.int32
+            ))
+            parts["game_id"].append(np.array([str(r.get("game_id") or r["_id"]) for r in records]))
+            parts["symbols"].append(np.array(["".join(r.get("symbols") or []) for r in records]))
+        if not parts["timestamp"]:
+            return None
+
+        os.makedirs(self.path, exist_ok=True)
+        columns = {column: np.concatenate(arrays) for column, arrays in parts.items()}
+        parts.clear()
+        columns["users"] = np.array(list(users))
+        name = self.segment_name(start)
+        _write_atomic(os.path.join(self.path, name), lambda f: np.savez_compressed(f, **columns))
+        return {
+            "file": name,
+            "start": start,
+            "end": end,
+            "count": len(columns["timestamp"]),
+            "min_timestamp": float(columns["timestamp"].min()),
+            "max_timestamp": float(columns["timestamp"].max()),
+            "total_bets": float(columns["bet"].sum()),
+            "total_payouts": float(columns["payout"].sum()),
+            "total_wins": int(columns["win"].sum()),
+            "bytes": os.path.getsize(os.path.join(self.path, name)),
+            "deleted": False,
+        }
+
+    def load_segment(self, name: str, columns: Tuple[str, ...] = SCAN_COLUMNS) -> Dict[str, np.ndarray]:
+        """Decompress the requested columns of a segment (small LRU in front)"""
+        with self._lock:
+            cached = self._segments.get(name)
+            if cached is not None and all(column in cached for column in columns):
+                self._segments.move_to_end(name)
+                return cached
+        with np.load(os.path.join(self.path, name), allow_pickle=False) as npz:
+            loaded = dict(cached or {})
+            loaded.update({column: npz[column] for column in columns if column not in loaded})
+        with self._lock:
+            self._segments[name] = loaded
+            self._segments.move_to_end(name)
+            while len(self._segments) > self.cache_segments:
+                self._segments.popitem(last=False)
+        return loaded
+
+    # --- queries --------------------------------------------------------
+
+    def aggregate(self, start: float, end: float, granularity: int) -> Tuple[Dict[int, Dict[str, Any]], Dict[str, int]]:
+        """
+        Per-bucket totals of archived games in [start, end).
+
+        The index prunes segments outside the range; only overlapping ones are
+        decompressed. Buckets carry the set of players so they can be merged
+        exactly with buckets from other segments or from Mongo.
+        """
+        buckets: Dict[int, Dict[str, Any]] = {}
+        read = {"segments_read": 0, "segments_skipped": 0}
+        for segment in self.index().get("segments", []):
+            if segment["max_timestamp"] < start or segment["min_timestamp"] >= end:
+                read["segments_skipped"] += 1
+                continue
+            columns = self.load_segment(segment["file"], SCAN_COLUMNS)
+            timestamps = columns["timestamp"]
+            mask = (timestamps >= start) & (timestamps < end)
+            if not mask.any():
+                continue
+            read["segments_read"] += 1
+            keys, inverse = np.unique(np.floor(timestamps[mask] / granularity).astype(np.int64),
+                                      return_inverse=True)
+            payouts = columns["payout"][mask]
+            games = np.bincount(inverse, minlength=len(keys))
+            bets = np.bincount(inverse, weights=columns["bet"][mask], minlength=len(keys))
+            paid = np.bincount(inverse, weights=payouts, minlength=len(keys))
+            wins = np.bincount(inverse, weights=columns["win"][mask], minlength=len(keys))
+            max_payout = np.full(len(keys), -np.inf)
+            np.maximum.at(max_payout, inverse, payouts)
+            # Distinct (bucket, player) pairs
+            users = columns["users"]
+            pairs = np.unique(inverse.astype(np.int64) * len(users) + columns["user_idx"][mask])
+
+            for i, key in enumerate(keys):
+                totals = buckets.setdefault(int(key) * granularity, _empty_totals())
+                totals["total_games"] += int(games[i])
+                totals["total_bets"] += float(bets[i])
+                totals["total_payouts"] += float(paid[i])
+                totals["total_wins"] += int(wins[i])
+                totals["max_payout"] = max(totals["max_payout"], float(max_payout[i]))
+            for pair in pairs:
+                buckets[int(keys[pair // len(users)]) * granularity]["players"].add(str(users[pair % len(users)]))
+        return buckets, read
+
+    def stats(self) -> Dict[str, Any]:
+        index = self.index()
+        segments = index.get("segments", [])
+        return {
+            "path": self.path,
+            "watermark": index.get("watermark"),
+            "segments": len(segments),
+            "games": sum(s["count"] for s in segments),
+            "bytes": sum(s.get("bytes", 0) for s in segments),
+            "pending_deletes": sum(1 for s in segments if not s.get("deleted")),
+            "oldest": min((s["min_timestamp"] for s in segments), default=None),
+            "cached_segments": len(self._segments),
+        }
+
+
+class RetentionArchiver:
+    """Background thread that moves games older than the hot window into the archive"""
+
+    def __init__(self, db, archive: Optional[ArchiveStore] = None, games: Optional[GameStore] = None,
+                 hot_days: Optional[float] = None, chunk_seconds: Optional[int] = None,
+                 interval: Optional[float] = None):
+        self.db = db
+        self.archive = archive or ArchiveStore()
+        self.games = games or GameStore(db)
+        self.hot_seconds = (hot_days or float(os.environ.get('ANALYTICS_RETENTION_HOT_DAYS', '30'))) * DAY
+        self.chunk_seconds = chunk_seconds or int(os.environ.get('ANALYTICS_ARCHIVE_CHUNK_SECONDS', str(DAY)))
+        self.interval = interval or float(os.environ.get('ANALYTICS_ARCHIVE_INTERVAL_SECONDS', '600'))
+        self.read_batch = int(os.environ.get('ANALYTICS_ARCHIVE_READ_BATCH', '5000'))
+        self.delete_batch = int(os.environ.get('ANALYTICS_ARCHIVE_DELETE_BATCH', '1000'))
+        # Pause between delete batches so inserts are never queued behind them
+        self.delete_pause = float(os.environ.get('ANALYTICS_ARCHIVE_DELETE_PAUSE_SECONDS', '0.05'))
+        self.ttl_grace = float(os.environ.get('ANALYTICS_RETENTION_TTL_GRACE_HOURS', '48')) * HOUR
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._counters = {
+            "passes": 0,
+            "segments_written": 0,
+            "games_archived": 0,
+            "games_deleted": 0,
+            "errors": 0,
+        }
+        self.last_pass_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="analytics-retention", daemon=True)
+        self._thread.start()
+        logger.info("Retention archiver started: hot window %.1f days, chunks of %ds, archive in %s",
+                    self.hot_seconds / DAY, self.chunk_seconds, self.archive.path)
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                self._counters["errors"] += 1
+                self.last_error = str(e)
+                logger.error("Retention pass failed (resumes next pass): %s", e)
+            self._stop.wait(self.interval)
+
+    # --- one pass -------------------------------------------------------
+
+    def run_once(self) -> Dict[str, Any]:
+        """Replay unfinished deletes, then archive every chunk older than the hot window"""
+        self._counters["passes"] += 1
+        if self.games.timeseries:
+            self._ensure_ttl()
+        else:
+            self._finish_deletes()
+
+        cutoff = time.time() - self.hot_seconds
+        start = self._first_chunk_start()
+        archived = 0
+        while start is not None and start + self.chunk_seconds <= cutoff and not self._stop.is_set():
+            archived += self._archive_chunk(start, start + self.chunk_seconds)
+            start += self.chunk_seconds
+        self.last_pass_at = time.time()
+        return {"archived": archived, "watermark": self.archive.watermark()}
+
+    def _first_chunk_start(self) -> Optional[float]:
+        watermark = self.archive.watermark()
+        if watermark is not None:
+            return watermark
+        collection = self.games.collection
+        oldest = collection.find_one({}, sort=[(self.games.translate_field("timestamp"), 1)])
+        oldest = self.games.from_document(oldest)
+        if not oldest:
+            return None
+        return math.floor(oldest["timestamp"] / self.chunk_seconds) * self.chunk_seconds
+
+    def _archive_chunk(self, start: float, end: float) -> int:
+        cursor = self.games.collection.find(
+            self.games.translate_filter({"timestamp": {"$gte": start, "$lt": end}}),
+            sort=[(self.games.translate_field("timestamp"), 1)],
+            batch_size=self.read_batch,
+        )
+
+        def batches():
+            # read_batch games at a time instead of the whole chunk as dicts
+            while True:
+                batch = [self.games.from_document(document) for document in itertools.islice(cursor, self.read_batch)]
+                if not batch:
+                    return
+                batch_sizes.observe("retention_read", len(batch))
+                yield batch
+
+        try:
+            segment = self.archive.write_segment(start, end, batches())
+        finally:
+            cursor.close()
+
+        index = dict(self.archive.index())
+        segments = [s for s in index.get("segments", []) if s["start"] != start]
+        if segment is not None:
+            # Time-series games are dropped by the collection TTL, not by us
+            segment["deleted"] = self.games.timeseries
+            segments.append(segment)
+            self._counters["segments_written"] += 1
+            self._counters["games_archived"] += segment["count"]
+        index.update({"version": INDEX_VERSION, "watermark": end, "segments": segments})
+        # From here on the chunk is served from the archive
+        self.archive.save_index(index)
+
+        if segment is None:
+            return 0
+        if not self.games.timeseries:
+            self._delete(self.archive.load_segment(segment["file"], ("game_id",))["game_id"].tolist())
+            self._mark_deleted(start)
+        logger.info("Archived %d games in [%s, %s)", segment["count"], start, end)
+        return segment["count"]
+
+    def _delete(self, ids: List[Any]):
+        collection = self.games.collection
+        for offset in range(0, len(ids), self.delete_batch):
+            batch = [ObjectId(i) if isinstance(i, str) and ObjectId.is_valid(i) else i
+                     for i in ids[offset:offset + self.delete_batch]]
+            batch_sizes.observe("retention_delete", len(batch))
+            result = collection.delete_many({"_id": {"$in": batch}})
+            self._counters["games_deleted"] += result.deleted_count
+            if self.delete_pause:
+                time.sleep(self.delete_pause)
+
+    def _mark_deleted(self, start: float):
+        index = dict(self.archive.index())
+        index["segments"] = [dict(s, deleted=True) if s["start"] == start else s for s in index["segments"]]
+        self.archive.save_index(index)
+
+    def _finish_deletes(self):
+        """Delete games of segments that were archived but not fully deleted"""
+        for segment in self.archive.index().get("segments", []):
+            if segment.get("deleted"):
+                continue
+            ids = self.archive.load_segment(segment["file"], ("game_id",))["game_id"].tolist()
+            logger.info("Resuming deletes for %s (%d games)", segment["file"], len(ids))
+            self._delete(ids)
+            self._mark_deleted(segment["start"])
+
+    def _ensure_ttl(self):
+        """Time-series games expire a grace period after they leave the hot window"""
+        expire = int(self.hot_seconds + self.ttl_grace)
+        try:
+            self.db.command("collMod", self.games.collection_name, expireAfterSeconds=expire)
+        except Exception as e:
+            logger.warning("Could not set expireAfterSeconds on %s: %s", self.games.collection_name, e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": bool(self._thread and self._thread.is_alive()),
+            "hot_days": self.hot_seconds / DAY,
+            "chunk_seconds": self.chunk_seconds,
+            "last_pass_at": self.last_pass_at,
+            "last_error": self.last_error,
+            **self._counters,
+            "archive": self.archive.stats(),
+        }
+
+
+class HybridGamesReport:
+    """Bucketed game totals over any range, from the archive and Mongo combined"""
+
+    def __init__(self, repo, archive: ArchiveStore):
+        self.repo = repo
+        self.archive = archive
+
+    async def buckets(self, start: float, end: float, granularity: int,
+                      name: str = "reports.hot_buckets") -> Tuple[Dict[int, Dict[str, Any]], Dict[str, Any]]:
+        """
+        {bucket_start: totals} for games in [start, end), plus where they came from.
+
+        Totals match what a single aggregation over an unarchived collection
+        would return: games, bets, payouts, wins, unique players, max payout.
+        """
+        watermark = self.archive.watermark()
+        buckets: Dict[int, Dict[str, Any]] = {}
+        sources: Dict[str, Any] = {"watermark": watermark}
+
+        if watermark is not None and start < watermark:
+            archived, read = await self.repo.run(self.archive.aggregate, start, min(end, watermark), granularity)
+            buckets.update(archived)
+            sources["archive"] = {"buckets": len(archived), **read}
+
+        hot_start = max(start, watermark) if watermark is not None else start
+        if hot_start < end:
+            rows = await self.repo.aggregate("games", [
+                {"$match": {"timestamp": {"$gte": hot_start, "$lt": end}}},
+                {"$group": {
+                    "_id": {"$subtract": ["$timestamp", {"$mod": ["$timestamp", granularity]}]},
+                    "total_games": {"$sum": 1},
+                    "total_bets": {"$sum": "$bet"},
+                    "total_payouts": {"$sum": "$payout"},
+                    "total_wins": {"$sum": {"$cond": [{"$eq": ["$win", True]}, 1, 0]}},
+                    "players": {"$addToSet": "$user_id"},
+                    "max_payout": {"$max": "$payout"},
+                }},
+            ], heavy=True, name=name)
+            for row in rows:
+                totals = buckets.setdefault(int(row["_id"]), _empty_totals())
+                for field in ("total_games", "total_bets", "total_payouts", "total_wins"):
+                    totals[field] += row[field]
+                totals["max_payout"] = max(totals["max_payout"], row["max_payout"] or 0)
+                totals["players"].update(row["players"])
+            sources["hot"] = {"buckets": len(rows)}
+
+        for totals in buckets.values():
+            totals["unique_players"] = len(totals.pop("players"))
+        return buckets, sources
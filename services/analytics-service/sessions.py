@@ -0,0 +1,208 @@
+"""
+Live session tracker fed by the analytics consumer.
+
+Keeps one entry per active user (first game, last game, game count, bets,
+payouts) in an ordered map sorted by last activity, so expiring idle sessions
+only ever looks at the oldest entries. The duration histogram and the average
+multi-game session duration are maintained incrementally on every game and
+every expiry, which lets `/active-sessions` and `/sessions` answer in
+O(active sessions) without scanning `games`.
+
+A session ends after ``timeout`` seconds without a game. Its duration is the
+time between its first and last game.
+"""
+import os
+import time
+import heapq
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# (label, upper bound in seconds)
+DURATION_BUCKETS = (
+    ("0-5min", 5 * 60),
+    ("5-15min", 15 * 60),
+    ("15-30min", 30 * 60),
+    ("30min+", float("inf")),
+)
+
+
+def _duration_bucket(duration: float) -> str:
+    for label, upper in DURATION_BUCKETS:
+        if duration <= upper:
+            return label
+    return DURATION_BUCKETS[-1][0]
+
+
+class _Session:
+    __slots__ = ("user_id", "first_game", "last_game", "games", "bets", "payouts")
+
+    def __init__(self, user_id: str, timestamp: float):
+        self.user_id = user_id
+        self.first_game = timestamp
+        self.last_game = timestamp
+        self.games = 0
+        self.bets = 0
+        self.payouts = 0
+
+    @property
+    def duration(self) -> float:
+        return self.last_game - self.first_game
+
+
+class SessionTracker:
+    """Active sessions ordered by last activity, with an incremental duration histogram"""
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.timeout = timeout or float(os.environ.get('SESSION_TIMEOUT_SECONDS', '1800'))
+        self._lock = threading.Lock()
+        # user_id -> session, least recently active first
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._histogram = {label: 0 for label, _ in DURATION_BUCKETS}
+        # Running totals over sessions with more than one game
+        self._multi_game_sessions = 0
+        self._multi_game_duration = 0.0
+        self._started_at = time.time()
+        self.seeded = False
+
+    @property
+    def warm(self) -> bool:
+        """True once the tracker has seen (or been seeded with) a full timeout window"""
+        return self.seeded or time.time() - self._started_at >= self.timeout
+
+    def _unaccount(self, session: _Session):
+        self._histogram[_duration_bucket(session.duration)] -= 1
+        if session.games > 1:
+            self._multi_game_sessions -= 1
+            self._multi_game_duration -= session.duration
+
+    def _account(self, session: _Session):
+        self._histogram[_duration_bucket(session.duration)] += 1
+        if session.games > 1:
+            self._multi_game_sessions += 1
+            self._multi_game_duration += session.duration
+
+    def _expire(self, now: float):
+        cutoff = now - self.timeout
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_game >= cutoff:
+                break
+            self._sessions.popitem(last=False)
+            self._unaccount(session)
+
+    def _add(self, user_id: str, first_game: float, last_game: float,
+             games: int, bets: float, payouts: float):
+        session = self._sessions.get(user_id)
+        if session is not None and first_game - session.last_game > self.timeout:
+            # Idle for longer than the timeout: the old session is over
+            self._sessions.pop(user_id)
+            self._unaccount(session)
+            session = None
+        if session is None:
+            session = _Session(user_id, first_game)
+            self._sessions[user_id] = session
+        else:
+            self._unaccount(session)
+
+        session.first_game = min(session.first_game, first_game)
+        session.games += games
+        session.bets += bets
+        session.payouts += payouts
+        if last_game >= session.last_game:
+            session.last_game = last_game
+            self._sessions.move_to_end(user_id)
+        self._account(session)
+
+    def record_game(self, game_data: Dict[str, Any]):
+        timestamp = game_data.get('timestamp') or time.time()
+        with self._lock:
+            self._expire(time.time())
+            if timestamp < time.time() - self.timeout:
+                return
+            self._add(game_data.get('user_id'), timestamp, timestamp, 1,
+                      game_data.get('bet', 0), game_data.get('payout', 0))
+
+    def active_sessions(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            return [
+                {
+                    "user_id": s.user_id,
+                    "first_game": s.first_game,
+                    "last_game": s.last_game,
+                    "games_in_session": s.games,
+                    "session_bets": s.bets,
+                    "session_payouts": s.payouts,
+                    "session_duration": s.duration
+                }
+                for s in self._sessions.values()
+            ]
+
+    def summary(self, top: int = 10) -> Dict[str, Any]:
+        """Everything `/active-sessions` needs, in one pass over active sessions"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            sessions = list(self._sessions.values())
+            histogram = dict(self._histogram)
+            multi_game_sessions = self._multi_game_sessions
+            multi_game_duration = self._multi_game_duration
+
+        count = len(sessions)
+        total_games = sum(s.games for s in sessions)
+        return {
+            "active_sessions": count,
+            "total_active_bets": sum(s.bets for s in sessions),
+            "avg_games_per_session": total_games / count if count else 0,
+            "avg_duration": multi_game_duration / multi_game_sessions if multi_game_sessions else None,
+            "session_duration_distribution": histogram,
+            "top_sessions": [
+                {
+                    "user_id": s.user_id,
+                    "games_played": s.games,
+                    "total_bet": s.bets,
+                    "total_payout": s.payouts,
+                    "session_profit": s.bets - s.payouts,
+                    "duration_minutes": round(s.duration / 60, 1)
+                }
+                for s in heapq.nlargest(top, sessions, key=lambda s: s.bets)
+            ]
+        }
+
+    async def seed(self, repo):
+        """Rebuild sessions active within the timeout from raw games once at startup"""
+        cutoff = time.time() - self.timeout
+        rows = await repo.aggregate("games", [
+            {"$match": {"timestamp": {"$gte": cutoff}}},
+            {
+                "$group": {
+                    "_id": "$user_id",
+                    "first_game": {"$min": "$timestamp"},
+                    "last_game": {"$max": "$timestamp"},
+                    "games": {"$sum": 1},
+                    "bets": {"$sum": "$bet"},
+                    "payouts": {"$sum": "$payout"}
+                }
+            },
+            {"$sort": {"last_game": 1}}
+        ])
+        with self._lock:
+            for row in rows:
+                self._add(row["_id"], row["first_game"], row["last_game"],
+                          row["games"], row["bets"], row["payouts"])
+            self.seeded = True
+        logger.info("Session tracker seeded with %d active sessions", len(rows))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "warm": self.warm,
+                "seeded": self.seeded,
+                "active_sessions": len(self._sessions),
+                "timeout_seconds": self.timeout
+            }
@@ -0,0 +1,418 @@
+"""
+Unsampled local telemetry for the ``/metrics`` endpoint of the Python services.
+
+Sentry only sees sampled transactions; alerting on p99 needs every request.
+This module keeps, per process:
+
+- HDR-style latency histograms per route and per span op (log-linear buckets,
+  16 per power of two, so any quantile is within ~6% of the true value)
+- value histograms (batch sizes)
+- 60-second message rates
+- MongoDB connection pool state from a pymongo pool listener
+- process CPU, RSS, threads and open files from psutil
+
+Recording only indexes into preallocated ``array`` counters of the calling
+thread - no dicts, tuples or objects are created per observation and no lock
+is taken. Shards are merged when ``/metrics`` is scraped.
+
+Each service image only contains its own directory, so this file is copied
+into analytics-service/ and game-engine/ - keep the copies in sync.
+"""
+import time
+import logging
+import threading
+from array import array
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import sentry_sdk
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Values below 32 get a bucket each, above that 16 buckets per power of two
+_SUB_BUCKETS = 16
+_LINEAR = 2 * _SUB_BUCKETS
+_MAX_BITS = 40
+BUCKETS = _SUB_BUCKETS * (_MAX_BITS - 4) + _SUB_BUCKETS
+_SUM = BUCKETS  # extra slot holding the sum of recorded values
+
+# Exposed "le" bounds in seconds (snapped to the HDR bucket edges at or below)
+LATENCY_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.0075, 0.01, 0.015, 0.025, 0.05, 0.075, 0.1,
+                  0.15, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BOUNDS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucket_index(value: int) -> int:
+    if value < _LINEAR:
+        return value if value > 0 else 0
+    shift = value.bit_length() - 5
+    index = _SUB_BUCKETS * shift + (value >> shift)
+    return index if index < BUCKETS else BUCKETS - 1
+
+
+def bucket_upper(index: int) -> int:
+    """Smallest value that no longer falls into bucket ``index``"""
+    if index < _LINEAR:
+        return index + 1
+    shift = index // _SUB_BUCKETS - 1
+    return ((index - _SUB_BUCKETS * shift) + 1) << shift
+
+
+class Histogram:
+    """
+    HDR-style histograms keyed by one label (route, span op, ...).
+
+    Values are recorded as integers in units of ``1 / scale`` - microseconds
+    for latencies - into a per-thread ``array('q')`` per key.
+    """
+
+    def __init__(self, name: str, label: str, help: str, scale: float = 1e6,
+                 bounds: Tuple[float, ...] = LATENCY_BOUNDS, unit: str = "seconds"):
+        self.name = name
+        self.label = label
+        self.help = help
+        self.scale = scale
+        self.unit = unit
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: List[Dict[str, array]] = []
+        # Exposed bounds, as (le label, last HDR bucket included)
+        self._bounds: List[Tuple[str, int]] = []
+        for bound in bounds:
+            index = bucket_index(int(bound * scale))
+            # The bucket holding `bound` may reach past it - stop one before
+            if bucket_upper(index) > int(bound * scale) + 1:
+                index -= 1
+            self._bounds.append((_format(bucket_upper(index) / scale), index))
+
+    def _counts(self, key: str) -> array:
+        try:
+            return self._local.shard[key]
+        except AttributeError:
+            self._local.shard = {}
+            with self._lock:
+                self._shards.append(self._local.shard)
+        except KeyError:
+            pass
+        counts = self._local.shard[key] = array('q', bytes(8 * (BUCKETS + 1)))
+        return counts
+
+    def observe(self, key: str, value: float):
+        scaled = int(value * self.scale)
+        counts = self._counts(key)
+        counts[bucket_index(scaled)] += 1
+        counts[_SUM] += scaled
+
+    @contextmanager
+    def time(self, key: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(key, time.perf_counter() - started)
+
+    def merged(self) -> Dict[str, List[int]]:
+        with self._lock:
+            shards = list(self._shards)
+        merged: Dict[str, List[int]] = {}
+        for shard in shards:
+            for key, counts in list(shard.items()):
+                total = merged.get(key)
+                if total is None:
+                    merged[key] = counts.tolist()
+                else:
+                    merged[key] = [a + b for a, b in zip(total, counts)]
+        return merged
+
+    def quantile(self, counts: List[int], q: float) -> float:
+        total = sum(counts[:BUCKETS])
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for index in range(BUCKETS):
+            seen += counts[index]
+            if seen >= rank:
+                return bucket_upper(index) / self.scale
+        return bucket_upper(BUCKETS - 1) / self.scale
+
+    def render(self, lines: List[str]):
+        merged = self.merged()
+        if not merged:
+            return
+        name = f"{self.name}_{self.unit}" if self.unit else self.name
+        lines.append(f"# HELP {name} {self.help}")
+        lines.append(f"# TYPE {name} histogram")
+        quantiles: List[str] = []
+        for key in sorted(merged):
+            counts = merged[key]
+            label = f'{self.label}="{_escape(key)}"'
+            cumulative, position = 0, 0
+            for le, last in self._bounds:
+                while position <= last:
+                    cumulative += counts[position]
+                    position += 1
+                lines.append(f'{name}_bucket{{{label},le="{le}"}} {cumulative}')
+            total = sum(counts[:BUCKETS])
+            lines.append(f'{name}_bucket{{{label},le="+Inf"}} {total}')
+            lines.append(f"{name}_sum{{{label}}} {_format(counts[_SUM] / self.scale)}")
+            lines.append(f"{name}_count{{{label}}} {total}")
+            for q in QUANTILES:
+                quantiles.append(f'{name}_quantile{{{label},quantile="{q}"}} {_format(self.quantile(counts, q))}')
+        # Since process start, from the full-resolution buckets
+        lines.append(f"# TYPE {name}_quantile gauge")
+        lines.extend(quantiles)
+
+
+class RateMeter:
+    """Events per second over the last minute, keyed by one label"""
+
+    WINDOW = 60
+
+    def __init__(self, name: str, label: str, help: str):
+        self.name = name
+        self.label = label
+        self.help = help
+        self._lock = threading.Lock()
+        # key -> (second of each slot, count of each slot, total)
+        self._meters: Dict[str, Tuple[array, array, array]] = {}
+
+    def mark(self, key: str, count: int = 1):
+        meter = self._meters.get(key)
+        if meter is None:
+            with self._lock:
+                meter = self._meters.setdefault(
+                    key, (array('q', bytes(8 * self.WINDOW)), array('q', bytes(8 * self.WINDOW)), array('q', [0]))
+                )
+        stamps, counts, total = meter
+        second = int(time.monotonic())
+        slot = second % self.WINDOW
+        if stamps[slot] != second:
+            stamps[slot] = second
+            counts[slot] = 0
+        counts[slot] += count
+        total[0] += count
+
+    def rates(self) -> Dict[str, float]:
+        """Average per second over the last minute, by key"""
+        now = int(time.monotonic())
+        return {
+            key: round(sum(c for s, c in zip(stamps, counts) if now - self.WINDOW <= s < now) / self.WINDOW, 3)
+            for key, (stamps, counts, _) in sorted(self._meters.items())
+        }
+
+    def render(self, lines: List[str]):
+        if not self._meters:
+            return
+        now = int(time.monotonic())
+        lines.append(f"# HELP {self.name}_total {self.help}")
+        lines.append(f"# TYPE {self.name}_total counter")
+        rates = []
+        for key, (stamps, counts, total) in sorted(self._meters.items()):
+            label = f'{self.label}="{_escape(key)}"'
+            lines.append(f"{self.name}_total{{{label}}} {total[0]}")
+            # The current second is still filling up - use the 60 before it
+            recent = sum(c for s, c in zip(stamps, counts) if now - self.WINDOW <= s < now)
+            rates.append(f"{self.name}_per_second{{{label}}} {_format(recent / self.WINDOW)}")
+        lines.append(f"# TYPE {self.name}_per_second gauge")
+        lines.extend(rates)
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """pymongo connection pool events -> per-server gauges and a checkout wait histogram"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # address -> counters
+        self._servers: Dict[str, Dict[str, int]] = {}
+        self.checkout_wait = Histogram(
+            "mongodb_pool_checkout_wait", "server", "Time spent waiting for a pooled connection"
+        )
+
+    def _server(self, address) -> Dict[str, int]:
+        key = f"{address[0]}:{address[1]}" if isinstance(address, tuple) else str(address)
+        server = self._servers.get(key)
+        if server is None:
+            with self._lock:
+                server = self._servers.setdefault(key, {
+                    "open": 0, "checked_out": 0, "created": 0, "closed": 0,
+                    "checkout_failed": 0, "cleared": 0,
+                })
+        return server
+
+    def pool_created(self, event):
+        self._server(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._server(event.address)["cleared"] += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        server = self._server(event.address)
+        server["created"] += 1
+        server["open"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        server = self._server(event.address)
+        server["closed"] += 1
+        server["open"] -= 1
+
+    def connection_check_out_started(self, event):
+        # Started and checked_out/failed run on the same thread
+        self._local.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        self._server(event.address)["checkout_failed"] += 1
+
+    def connection_checked_out(self, event):
+        self._server(event.address)["checked_out"] += 1
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            self.checkout_wait.observe(
+                f"{event.address[0]}:{event.address[1]}" if isinstance(event.address, tuple) else str(event.address),
+                time.perf_counter() - started
+            )
+
+    def connection_checked_in(self, event):
+        self._server(event.address)["checked_out"] -= 1
+
+    def render(self, lines: List[str]):
+        gauges = {"open": "Open pooled connections", "checked_out": "Connections in use"}
+        counters = {"created": "Connections created", "closed": "Connections closed",
+                    "checkout_failed": "Failed connection checkouts", "cleared": "Pool clears"}
+        servers = sorted(self._servers.items())
+        if not servers:
+            return
+        for field, help in gauges.items():
+            lines.append(f"# HELP mongodb_pool_{field}_connections {help}")
+            lines.append(f"# TYPE mongodb_pool_{field}_connections gauge")
+            lines.extend(f'mongodb_pool_{field}_connections{{server="{key}"}} {values[field]}' for key, values in servers)
+        for field, help in counters.items():
+            lines.append(f"# HELP mongodb_pool_{field}_total {help}")
+            lines.append(f"# TYPE mongodb_pool_{field}_total counter")
+            lines.extend(f'mongodb_pool_{field}_total{{server="{key}"}} {values[field]}' for key, values in servers)
+        self.checkout_wait.render(lines)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(value: float) -> str:
+    return repr(round(value, 6)) if isinstance(value, float) else str(value)
+
+
+_process = None
+
+
+def render_process(lines: List[str]):
+    """Standard process_* metrics from psutil"""
+    global _process
+    try:
+        import psutil
+        if _process is None:
+            _process = psutil.Process()
+        with _process.oneshot():
+            cpu = _process.cpu_times()
+            memory = _process.memory_info()
+            threads = _process.num_threads()
+            try:
+                files = _process.num_fds()
+            except AttributeError:
+                files = len(_process.open_files())
+            started = _process.create_time()
+    except Exception as e:
+        logger.debug("Process metrics unavailable: %s", e)
+        return
+    lines.extend([
+        "# TYPE process_cpu_seconds_total counter",
+        f"process_cpu_seconds_total {_format(cpu.user + cpu.system)}",
+        "# TYPE process_resident_memory_bytes gauge",
+        f"process_resident_memory_bytes {memory.rss}",
+        "# TYPE process_virtual_memory_bytes gauge",
+        f"process_virtual_memory_bytes {memory.vms}",
+        "# TYPE process_threads gauge",
+        f"process_threads {threads}",
+        "# TYPE process_open_fds gauge",
+        f"process_open_fds {files}",
+        "# TYPE process_start_time_seconds gauge",
+        f"process_start_time_seconds {_format(started)}",
+    ])
+
+
+# One set per process, shared by the service code
+route_latency = Histogram("http_request_duration", "route", "Request latency by route template")
+span_latency = Histogram("span_duration", "op", "Duration of instrumented spans by op, sampled or not")
+batch_sizes = Histogram("batch_size", "kind", "Items per batch", scale=1, bounds=SIZE_BOUNDS, unit="items")
+message_rates = RateMeter("consumer_messages", "queue", "Messages handled by the RabbitMQ consumer")
+log_records = RateMeter("log_records", "level", "Log records written (see logging_setup.py)")
+log_dropped = RateMeter("log_records_dropped", "reason", "Log records rate limited or dropped on a full queue")
+pool_stats = PoolStats()
+
+
+@contextmanager
+def start_span(op: Optional[str] = None, **kwargs):
+    """``sentry_sdk.start_span`` that also records the span's duration locally"""
+    started = time.perf_counter()
+    try:
+        with sentry_sdk.start_span(op=op, **kwargs) as span:
+            yield span
+    finally:
+        span_latency.observe(op or "default", time.perf_counter() - started)
+
+
+# endpoint function -> route template, filled on first use
+_route_templates: Dict[object, str] = {}
+
+
+def route_template(scope) -> str:
+    """The template of the route an ASGI request matched (``/api/v1/games/{game_id}``)"""
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    template = _route_templates.get(endpoint)
+    if template is None:
+        for route in getattr(scope.get("app"), "routes", ()):
+            if getattr(route, "endpoint", None) is endpoint:
+                template = route.path
+                break
+        template = _route_templates[endpoint] = template or getattr(endpoint, "__name__", "unknown")
+    return template
+
+
+class RouteTimingMiddleware:
+    """ASGI middleware recording every HTTP request in ``route_latency`` by route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # The router has stored the matched endpoint in the scope by now
+            route_latency.observe(route_template(scope), time.perf_counter() - started)
+
+
+def render(*sections) -> str:
+    """Prometheus text for the local telemetry plus any extra pre-rendered sections"""
+    lines: List[str] = []
+    for item in (route_latency, span_latency, batch_sizes, message_rates, log_records, log_dropped, pool_stats):
+        item.render(lines)
+    render_process(lines)
+    text = "\n".join(lines) + "\n"
+    return "".join(section for section in sections if section) + text
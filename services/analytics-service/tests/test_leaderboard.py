@@ -0,0 +1,101 @@
+"""
+The incremental leaderboard must rank exactly like its Mongo aggregation.
+
+Runs against mongomock: ``pip install pytest mongomock`` and
+``python -m pytest tests`` from services/analytics-service.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+mongomock = pytest.importorskip("mongomock")
+
+from leaderboard import METRICS, WindowedLeaderboard  # noqa: E402
+
+HOUR = 3600
+VALUE_FIELDS = {"rtp": "rtp", "bets": "total_bets", "net_profit": "net_profit"}
+
+
+class _Repo:
+    """The slice of AnalyticsRepository that ``WindowedLeaderboard.seed`` uses"""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def aggregate(self, collection, pipeline, **kwargs):
+        return list(self.db[collection].aggregate(pipeline))
+
+
+def _games(count=600, hours=30, players=40, seed=7):
+    rng = random.Random(seed)
+    now = time.time()
+    games = []
+    for _ in range(count):
+        bet = rng.choice([1, 2, 5, 10, 25])
+        win = rng.random() < 0.3
+        games.append({
+            "user_id": f"player_{rng.randrange(players)}",
+            "bet": bet,
+            "win": win,
+            "payout": bet * rng.choice([2, 3, 4, 5, 10, 20]) if win else 0,
+            "timestamp": now - rng.uniform(0, hours * HOUR),
+        })
+    return sorted(games, key=lambda game: game["timestamp"])
+
+
+def _ranked(rows, metric):
+    # Ties may be ordered differently, so compare the ranked values
+    return [round(row[VALUE_FIELDS[metric]], 6) for row in rows]
+
+
+@pytest.fixture
+def db():
+    database = mongomock.MongoClient().db
+    database.games.insert_many(_games())
+    return database
+
+
+@pytest.mark.parametrize("min_bets", [0, 50])
+def test_recorded_games_match_aggregation(db, min_bets):
+    leaderboard = WindowedLeaderboard(window_buckets=24, min_bets=min_bets)
+    for game in db.games.find({}, {"_id": 0}):
+        leaderboard.record_game(game)
+
+    for metric in METRICS:
+        expected = list(db.games.aggregate(leaderboard.aggregation_pipeline(metric, 10)))
+        actual = leaderboard.top(metric, 10)
+        assert actual, metric
+        assert _ranked(actual, metric) == _ranked(expected, metric), metric
+
+
+def test_expired_buckets_leave_the_ranking(db):
+    leaderboard = WindowedLeaderboard(window_buckets=24)
+    asyncio.run(leaderboard.seed(_Repo(db)))
+    # Six hours later the oldest six buckets have expired
+    leaderboard.expire(time.time() + 6 * HOUR)
+
+    for metric in METRICS:
+        expected = list(db.games.aggregate(leaderboard.aggregation_pipeline(metric, 10)))
+        assert _ranked(leaderboard.top(metric, 10), metric) == _ranked(expected, metric), metric
+
+
+def test_seed_matches_aggregation(db):
+    leaderboard = WindowedLeaderboard(window_buckets=24, min_bets=20)
+    asyncio.run(leaderboard.seed(_Repo(db)))
+
+    assert leaderboard.seeded
+    for metric in METRICS:
+        expected = list(db.games.aggregate(leaderboard.aggregation_pipeline(metric, 10)))
+        assert _ranked(leaderboard.top(metric, 10), metric) == _ranked(expected, metric), metric
+
+
+def test_fallback_window_is_the_leaderboard_window():
+    leaderboard = WindowedLeaderboard(window_buckets=24)
+    leaderboard.expire()
+    assert leaderboard.aligned_start(leaderboard.window_hours()) == leaderboard.window_start()
@@ -2,6 +2,7 @@ package config
 
 import (
 	"os"
+	"strconv"
 )
 
 type Config struct {
@@ -11,6 +12,8 @@ type Config struct {
 	PaymentServiceURL string
 	WagerServiceURL  string
 	RedisURL         string
+	// Budget for analytics requests, forwarded as X-Request-Timeout-Ms
+	AnalyticsTimeoutMs int
 }
 
 func Load() *Config {
@@ -21,6 +24,7 @@ func Load() *Config {
 		PaymentServiceURL: getEnv("PAYMENT_SERVICE_URL", "http://payment-service:8083"),
 		WagerServiceURL:   getEnv("WAGER_SERVICE_URL", "http://wager-service:8085"),
 		RedisURL:          getEnv("REDIS_URL", "localhost:6379"),
+		AnalyticsTimeoutMs: getEnvInt("ANALYTICS_TIMEOUT_MS", 30000),
 	}
 }
 
@@ -29,4 +33,11 @@ func getEnv(key, defaultValue string) string {
 		return value
 	}
 	return defaultValue
-}
\ No newline at end of file
+}
+
+func getEnvInt(key string, defaultValue int) int {
+	if value, err := strconv.Atoi(os.Getenv(key)); err == nil && value > 0 {
+		return value
+	}
+	return defaultValue
+}
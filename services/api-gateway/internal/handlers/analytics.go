@@ -1,16 +1,39 @@
 package handlers
 
 import (
+	"context"
 	"fmt"
 	"io"
 	"net/http"
+	"strconv"
 	"strings"
+	"sync/atomic"
+	"time"
 
 	"github.com/getsentry/sentry-go"
 	"github.com/gin-gonic/gin"
 	"github.com/sentry-poc/api-gateway/internal/config"
 )
 
+// requestTimeoutHeader carries the remaining request budget in milliseconds
+const requestTimeoutHeader = "X-Request-Timeout-Ms"
+
+// streamingPaths are long-lived responses (SSE, bulk export) that must not
+// be cut off by the request budget; the analytics service exempts them too
+var streamingPaths = []string{
+	"analytics/realtime/stream",
+	"analytics/games/export",
+}
+
+func isStreamingPath(pathAfterV1 string) bool {
+	for _, prefix := range streamingPaths {
+		if strings.HasPrefix(pathAfterV1, prefix) {
+			return true
+		}
+	}
+	return false
+}
+
 // ProxyToAnalytics forwards requests to the analytics service
 func ProxyToAnalytics(cfg *config.Config) gin.HandlerFunc {
 	return func(c *gin.Context) {
@@ -42,8 +65,35 @@ func ProxyToAnalytics(cfg *config.Config) gin.HandlerFunc {
 		span.SetData("analytics.url", analyticsURL)
 		span.SetData("method", c.Request.Method)
 
+		// Deadline: our own budget, or the caller's if it is tighter. It only
+		// covers waiting for the response headers - the body is copied for as
+		// long as it takes. The context is also cancelled when the client
+		// disconnects, which lets the analytics service kill the queries it
+		// started for us.
+		streaming := isStreamingPath(pathAfterV1)
+		budget := time.Duration(cfg.AnalyticsTimeoutMs) * time.Millisecond
+		if value := c.GetHeader(requestTimeoutHeader); value != "" {
+			if ms, err := strconv.Atoi(value); err == nil && ms > 0 && time.Duration(ms)*time.Millisecond < budget {
+				budget = time.Duration(ms) * time.Millisecond
+			}
+		}
+		ctx, cancel := context.WithCancel(span.Context())
+		defer cancel()
+		var timedOut int32
+		var deadline time.Time
+		var timer *time.Timer
+		if !streaming {
+			deadline = time.Now().Add(budget)
+			timer = time.AfterFunc(budget, func() {
+				atomic.StoreInt32(&timedOut, 1)
+				cancel()
+			})
+			defer timer.Stop()
+			span.SetData("deadline.budget_ms", budget.Milliseconds())
+		}
+
 		// Create new request
-		req, err := http.NewRequestWithContext(span.Context(), c.Request.Method, analyticsURL, c.Request.Body)
+		req, err := http.NewRequestWithContext(ctx, c.Request.Method, analyticsURL, c.Request.Body)
 		if err != nil {
 			span.Status = sentry.SpanStatusInternalError
 			sentry.CaptureException(err)
@@ -67,10 +117,29 @@ func ProxyToAnalytics(cfg *config.Config) gin.HandlerFunc {
 			}
 		}
 
+		// Tell the analytics service how much of the budget is left
+		if streaming {
+			req.Header.Del(requestTimeoutHeader)
+		} else {
+			req.Header.Set(requestTimeoutHeader, strconv.FormatInt(time.Until(deadline).Milliseconds(), 10))
+		}
+
 		// Make request
 		client := &http.Client{}
 		resp, err := client.Do(req)
+		// Headers are in: the budget no longer applies to the body. If the
+		// timer won the race the context is already cancelled - treat it as
+		// a timeout rather than copying a truncated body.
+		if timer != nil && !timer.Stop() && err == nil {
+			resp.Body.Close()
+			err = context.Canceled
+		}
 		if err != nil {
+			if atomic.LoadInt32(&timedOut) == 1 {
+				span.Status = sentry.SpanStatusDeadlineExceeded
+				c.JSON(http.StatusGatewayTimeout, gin.H{"error": "Analytics service timed out"})
+				return
+			}
 			span.Status = sentry.SpanStatusInternalError
 			sentry.CaptureException(err)
 			c.JSON(http.StatusBadGateway, gin.H{"error": "Failed to reach analytics service"})
@@ -93,6 +162,23 @@ func ProxyToAnalytics(cfg *config.Config) gin.HandlerFunc {
 
 		// Copy response body
 		c.Status(resp.StatusCode)
-		io.Copy(c.Writer, resp.Body)
+		if !streaming {
+			io.Copy(c.Writer, resp.Body)
+			return
+		}
+		// Pass each chunk on as it arrives (SSE events, export lines)
+		buf := make([]byte, 32*1024)
+		for {
+			n, readErr := resp.Body.Read(buf)
+			if n > 0 {
+				if _, writeErr := c.Writer.Write(buf[:n]); writeErr != nil {
+					return
+				}
+				c.Writer.Flush()
+			}
+			if readErr != nil {
+				return
+			}
+		}
 	}
 }
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""
+Concurrency benchmark for the analytics service.
+
+Measures latency of the cheap endpoints (/health, /realtime/summary) on their
+own, then again while background clients keep the heavy endpoints
+(/daily-stats, /debug/slow-query) busy. With the async repository layer the
+two runs should show roughly the same latency; when pymongo or time.sleep
+block the event loop, the loaded run degrades by seconds.
+
+Usage:
+    python analytics_concurrency.py --url http://localhost:8084 --duration 20
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.request
+from typing import Dict, List
+
+PROBE_PATHS = [
+    "/health",
+    "/api/v1/analytics/realtime/summary",
+]
+
+LOAD_PATHS = [
+    "/api/v1/analytics/daily-stats?days=7",
+    "/api/debug/slow-query",
+]
+
+
+def _get(url: str, timeout: float) -> float:
+    """GET a URL and return the latency in milliseconds"""
+    start = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        response.read()
+    return (time.perf_counter() - start) * 1000
+
+
+def _percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(int(round(pct / 100.0 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def probe(base_url: str, duration: float, interval: float, timeout: float) -> Dict[str, Dict[str, float]]:
+    """Poll the probe endpoints sequentially for `duration` seconds"""
+    samples = {path: [] for path in PROBE_PATHS}
+    errors = {path: 0 for path in PROBE_PATHS}
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for path in PROBE_PATHS:
+            try:
+                samples[path].append(_get(base_url + path, timeout))
+            except Exception:
+                errors[path] += 1
+        time.sleep(interval)
+
+    return {
+        path: {
+            "requests": len(values),
+            "errors": errors[path],
+            "p50_ms": round(_percentile(values, 50), 2),
+            "p95_ms": round(_percentile(values, 95), 2),
+            "p99_ms": round(_percentile(values, 99), 2),
+            "max_ms": round(max(values), 2) if values else 0.0,
+            "mean_ms": round(statistics.mean(values), 2) if values else 0.0,
+        }
+        for path, values in samples.items()
+    }
+
+
+def _load_worker(base_url: str, path: str, stop: threading.Event, timeout: float, completed: List[int]):
+    while not stop.is_set():
+        try:
+            _get(base_url + path, timeout)
+            completed.append(1)
+        except Exception:
+            # Heavy endpoints may time out under load - keep hammering
+            time.sleep(0.1)
+
+
+def run(base_url: str, duration: float, load_clients: int, interval: float, timeout: float) -> Dict:
+    print(f"Baseline: probing {', '.join(PROBE_PATHS)} for {duration}s")
+    baseline = probe(base_url, duration, interval, timeout)
+
+    stop = threading.Event()
+    completed: List[int] = []
+    workers = []
+    for path in LOAD_PATHS:
+        for _ in range(load_clients):
+            worker = threading.Thread(
+                target=_load_worker,
+                args=(base_url, path, stop, timeout * 10, completed),
+                daemon=True
+            )
+            worker.start()
+            workers.append(worker)
+
+    print(f"Loaded: {load_clients} client(s) per heavy endpoint, probing for {duration}s")
+    try:
+        loaded = probe(base_url, duration, interval, timeout)
+    finally:
+        stop.set()
+
+    report = {
+        "base_url": base_url,
+        "duration_seconds": duration,
+        "load_clients_per_endpoint": load_clients,
+        "heavy_requests_completed": len(completed),
+        "baseline": baseline,
+        "loaded": loaded,
+    }
+
+    print()
+    print(f"{'endpoint':<40} {'p50 base':>10} {'p50 load':>10} {'p99 base':>10} {'p99 load':>10}")
+    for path in PROBE_PATHS:
+        print(
+            f"{path:<40} {baseline[path]['p50_ms']:>10} {loaded[path]['p50_ms']:>10} "
+            f"{baseline[path]['p99_ms']:>10} {loaded[path]['p99_ms']:>10}"
+        )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analytics service event-loop concurrency benchmark")
+    parser.add_argument("--url", default="http://localhost:8084", help="Analytics service base URL")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds per phase")
+    parser.add_argument("--load-clients", type=int, default=4, help="Concurrent clients per heavy endpoint")
+    parser.add_argument("--interval", type=float, default=0.05, help="Pause between probe rounds")
+    parser.add_argument("--timeout", type=float, default=10.0, help="Probe request timeout in seconds")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    result = run(args.url.rstrip("/"), args.duration, args.load_clients, args.interval, args.timeout)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"\nReport written to {args.output}")
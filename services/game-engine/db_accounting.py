@@ -0,0 +1,252 @@
+"""
+Per-request MongoDB cost accounting.
+
+A pymongo ``CommandListener`` adds every command to the ``RequestCost`` of
+the request it runs for, found through a contextvar. The cost follows the
+request into tasks it spawns and into repository threads, since both copy
+the context. Per request it counts:
+
+- commands (``getMore`` excluded) and round trips (every command sent)
+- time spent in the driver and documents returned in cursor batches
+- how often the same command hit the same collection, which exposes N+1
+  loops
+
+It is reported as a ``Server-Timing`` header (visible in the browser's
+network panel), as data on the Sentry transaction and as metrics. Requests
+that need more round trips than DB_ROUND_TRIP_BUDGET (per-route overrides in
+DB_ROUND_TRIP_BUDGETS as ``/api/v1/analytics/games/export=2000``) are
+flagged: a warning log, a ``db.round_trip_budget`` tag and the
+``db.round_trip_budget_exceeded`` counter.
+
+    client = MongoClient(url, event_listeners=[db_accounting.listener])
+"""
+import os
+import time
+import logging
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Tuple
+
+import sentry_sdk
+from pymongo import monitoring
+
+from metrics import aggregator
+from sampling import parse_budgets
+from telemetry import route_template
+
+logger = logging.getLogger(__name__)
+
+_current: "ContextVar[Optional[RequestCost]]" = ContextVar("db_request_cost", default=None)
+
+
+def _collection(event) -> Optional[str]:
+    value = event.command.get(event.command_name)
+    if isinstance(value, str):
+        return value
+    # getMore names the cursor id instead
+    return event.command.get("collection")
+
+
+def _docs_returned(reply: Any) -> int:
+    cursor = reply.get("cursor") if isinstance(reply, dict) else None
+    if isinstance(cursor, dict):
+        batch = cursor.get("firstBatch", cursor.get("nextBatch"))
+        if isinstance(batch, list):
+            return len(batch)
+    return 0
+
+
+class RequestCost:
+    """MongoDB commands issued on behalf of one request"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands = 0
+        self.round_trips = 0
+        self.duration_micros = 0
+        self.docs_returned = 0
+        self.failures = 0
+        # command name -> [round trips, micros]
+        self.by_command: Dict[str, list] = {}
+        # "find games" -> round trips
+        self.shapes: Counter = Counter()
+
+    def started(self, command: str, collection: Optional[str]):
+        with self._lock:
+            self.round_trips += 1
+            if command != "getMore":
+                self.commands += 1
+                self.shapes[f"{command} {collection}" if collection else command] += 1
+
+    def finished(self, command: str, micros: int, docs: int, failed: bool = False):
+        with self._lock:
+            self.duration_micros += micros
+            self.docs_returned += docs
+            if failed:
+                self.failures += 1
+            entry = self.by_command.get(command)
+            if entry is None:
+                entry = self.by_command[command] = [0, 0]
+            entry[0] += 1
+            entry[1] += micros
+
+    def most_repeated(self) -> Tuple[Optional[str], int]:
+        with self._lock:
+            if not self.shapes:
+                return None, 0
+            return self.shapes.most_common(1)[0]
+
+    def server_timing(self, budget: Optional[int] = None) -> str:
+        """``Server-Timing`` value: the total, then one entry per command name"""
+        with self._lock:
+            parts = [
+                f'db;dur={self.duration_micros / 1000:.2f};'
+                f'desc="{self.commands} cmds, {self.round_trips} round trips, {self.docs_returned} docs"'
+            ]
+            for command, (count, micros) in sorted(self.by_command.items(), key=lambda item: -item[1][1]):
+                parts.append(f'db-{command};dur={micros / 1000:.2f};desc="x{count}"')
+            if budget is not None and self.round_trips > budget:
+                parts.append(f'db-budget;desc="exceeded: {self.round_trips} of {budget} round trips"')
+        return ", ".join(parts)
+
+    def as_dict(self) -> Dict[str, Any]:
+        shape, repeats = self.most_repeated()
+        with self._lock:
+            return {
+                "commands": self.commands,
+                "round_trips": self.round_trips,
+                "duration_ms": round(self.duration_micros / 1000, 2),
+                "docs_returned": self.docs_returned,
+                "failures": self.failures,
+                "most_repeated": shape,
+                "most_repeated_count": repeats,
+            }
+
+
+class DbCommandListener(monitoring.CommandListener):
+    """Adds each command to the RequestCost of the current context, if any"""
+
+    def started(self, event):
+        cost = _current.get()
+        if cost is not None:
+            cost.started(event.command_name, _collection(event))
+
+    def succeeded(self, event):
+        cost = _current.get()
+        if cost is not None:
+            cost.finished(event.command_name, event.duration_micros, _docs_returned(event.reply))
+
+    def failed(self, event):
+        cost = _current.get()
+        if cost is not None:
+            cost.finished(event.command_name, event.duration_micros, 0, failed=True)
+
+
+def current() -> Optional[RequestCost]:
+    return _current.get()
+
+
+class DbAccounting:
+    """Starts and closes the per-request accounting and applies the round-trip budget"""
+
+    def __init__(self, budget: Optional[int] = None):
+        self.listener = DbCommandListener()
+        self.budget = budget or int(os.environ.get('DB_ROUND_TRIP_BUDGET', '25'))
+        self.budgets = {key: int(value) for key, value in parse_budgets(os.environ.get('DB_ROUND_TRIP_BUDGETS')).items()}
+        self.warn_interval = float(os.environ.get('DB_BUDGET_WARN_INTERVAL_SECONDS', '60'))
+        self._lock = threading.Lock()
+        self._warned: Dict[str, float] = {}
+        self.requests = 0
+        # route -> [flagged requests, worst round trips, most repeated command]
+        self.flagged: Dict[str, list] = {}
+
+    def budget_for(self, route: Optional[str]) -> int:
+        return self.budgets.get(route, self.budget) if route else self.budget
+
+    def begin(self):
+        """Start accounting for the current context; returns (cost, token)"""
+        cost = RequestCost()
+        return cost, _current.set(cost)
+
+    def finish(self, cost: RequestCost, route: str):
+        """Record the cost of a finished request and flag it if it ran over budget"""
+        if cost.round_trips == 0:
+            return
+        summary = cost.as_dict()
+        budget = self.budget_for(route)
+        exceeded = cost.round_trips > budget
+        with self._lock:
+            self.requests += 1
+        aggregator.distribution("db.round_trips_per_request", cost.round_trips, tags={"route": route})
+
+        span = sentry_sdk.get_current_span()
+        transaction = getattr(span, "containing_transaction", None) or span
+        if transaction is not None:
+            for key, value in summary.items():
+                if value is not None:
+                    transaction.set_data(f"db.{key}", value)
+            if exceeded:
+                transaction.set_tag("db.round_trip_budget", "exceeded")
+
+        if not exceeded:
+            return
+        aggregator.increment("db.round_trip_budget_exceeded", tags={"route": route})
+        now = time.monotonic()
+        with self._lock:
+            entry = self.flagged.get(route)
+            if entry is None:
+                entry = self.flagged[route] = [0, 0, None]
+            entry[0] += 1
+            if cost.round_trips > entry[1]:
+                entry[1], entry[2] = cost.round_trips, summary["most_repeated"]
+            warn = now - self._warned.get(route, 0.0) >= self.warn_interval
+            if warn:
+                self._warned[route] = now
+        if warn:
+            logger.warning(
+                "%s made %d MongoDB round trips (budget %d), %d x %s - likely an N+1 query pattern",
+                route, cost.round_trips, budget, summary["most_repeated_count"], summary["most_repeated"]
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "round_trip_budget": self.budget,
+                "route_budgets": self.budgets,
+                "requests_accounted": self.requests,
+                "over_budget": {
+                    route: {"requests": count, "worst_round_trips": worst, "most_repeated": shape}
+                    for route, (count, worst, shape) in self.flagged.items()
+                },
+            }
+
+
+db_accounting = DbAccounting()
+
+
+class DbAccountingMiddleware:
+    """ASGI middleware: per-request accounting, reported in a ``Server-Timing`` header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        cost, token = db_accounting.begin()
+
+        async def send_with_timing(message):
+            # Streaming responses keep querying after this; the header covers what ran before
+            if message["type"] == "http.response.start" and cost.round_trips:
+                headers = list(message.get("headers", []))
+                value = cost.server_timing(db_accounting.budget_for(route_template(scope)))
+                headers.append((b"server-timing", value.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            db_accounting.finish(cost, route_template(scope))
+            _current.reset(token)
@@ -0,0 +1,207 @@
+"""
+Storage layout of game records for Sentry POC services.
+
+GAMES_STORAGE selects where game records live:
+
+- ``standard`` (default): the plain ``games`` collection, one document per
+  game with a float ``timestamp`` (unix seconds) and a top-level ``user_id``
+- ``timeseries``: a MongoDB time-series collection (GAMES_TS_COLLECTION,
+  default ``games_ts``) with ``ts`` as a real date in ``timeField`` and
+  ``meta: {user_id, game_id}`` as ``metaField``. Games are stored in
+  compressed buckets per player and time span, and range queries on ``ts``
+  skip whole buckets.
+
+Queries are written once, against the standard layout. ``GameStore``
+translates them: leading ``$match`` stages are rewritten to ``ts``/``meta``
+so range filters still reach the storage engine, and a normalizing
+``$addFields`` stage restores ``timestamp``/``user_id``/``game_id`` for the
+rest of the pipeline.
+
+Each service image only contains its own directory, so this file is copied
+into analytics-service/ and game-engine/ - keep the copies in sync.
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+STANDARD = "standard"
+TIMESERIES = "timeseries"
+
+# pymongo hands out naive UTC datetimes, so the epoch is naive too
+EPOCH = datetime(1970, 1, 1)
+
+# Standard field -> time-series field
+_FIELD_MAP = {
+    "timestamp": "ts",
+    "user_id": "meta.user_id",
+    "game_id": "meta.game_id",
+}
+
+NORMALIZE_STAGE = {
+    "$addFields": {
+        "user_id": "$meta.user_id",
+        "game_id": "$meta.game_id",
+        "timestamp": {"$divide": [{"$subtract": ["$ts", EPOCH]}, 1000]},
+    }
+}
+
+
+def to_date(timestamp: float) -> datetime:
+    """Float seconds -> the millisecond-precision date MongoDB stores"""
+    # Round to microseconds first: 0.123 * 1000 may land just below 123
+    milliseconds = int(round(timestamp * 1_000_000)) // 1000
+    return EPOCH + timedelta(milliseconds=milliseconds)
+
+
+def _translate_time(value: Any) -> Any:
+    """Float seconds (or operators over them) -> dates"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return to_date(value)
+    if isinstance(value, dict):
+        return {op: _translate_time(operand) for op, operand in value.items()}
+    if isinstance(value, list):
+        return [_translate_time(item) for item in value]
+    return value
+
+
+class GameStore:
+    """Where game records are written and how queries against them are shaped"""
+
+    def __init__(self, db, mode: Optional[str] = None, collection: Optional[str] = None):
+        self.db = db
+        self.mode = (mode or os.environ.get('GAMES_STORAGE', STANDARD)).lower()
+        if self.mode not in (STANDARD, TIMESERIES):
+            raise ValueError(f"Unknown GAMES_STORAGE mode: {self.mode}")
+        self.collection_name = collection or (
+            os.environ.get('GAMES_TS_COLLECTION', 'games_ts') if self.timeseries else "games"
+        )
+        self.granularity = os.environ.get('GAMES_TS_GRANULARITY', 'seconds')
+
+    @property
+    def timeseries(self) -> bool:
+        return self.mode == TIMESERIES
+
+    @property
+    def collection(self):
+        return self.db[self.collection_name]
+
+    def ensure_collection(self):
+        """Create the time-series collection and its meta/time index if missing"""
+        if not self.timeseries:
+            return
+        if self.collection_name not in self.db.list_collection_names():
+            self.db.create_collection(
+                self.collection_name,
+                timeseries={"timeField": "ts", "metaField": "meta", "granularity": self.granularity}
+            )
+            logger.info("Created time-series collection %s", self.collection_name)
+        # Per-player lookups; time ranges are served by the bucket bounds
+        self.collection.create_index([("meta.user_id", 1), ("ts", -1)])
+
+    # --- writes ---------------------------------------------------------
+
+    def to_document(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        """Game record in the standard layout -> document for this store"""
+        if not self.timeseries:
+            return record
+        game_id = record.get("_id") or ObjectId()
+        document = {
+            key: value for key, value in record.items()
+            if key not in ("_id", "timestamp", "user_id", "game_id")
+        }
+        document["_id"] = game_id
+        document["ts"] = to_date(record["timestamp"])
+        document["meta"] = {"user_id": record.get("user_id"), "game_id": str(game_id)}
+        return document
+
+    def from_document(self, document: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Document from this store -> game record in the standard layout"""
+        if document is None or not self.timeseries:
+            return document
+        record = {key: value for key, value in document.items() if key not in ("ts", "meta")}
+        meta = document.get("meta") or {}
+        if "user_id" in meta:
+            record["user_id"] = meta["user_id"]
+        if "game_id" in meta:
+            record["game_id"] = meta["game_id"]
+        if "ts" in document:
+            record["timestamp"] = (document["ts"].replace(tzinfo=None) - EPOCH).total_seconds()
+        return record
+
+    def insert(self, record: Dict[str, Any]):
+        return self.collection.insert_one(self.to_document(record))
+
+    # --- reads ----------------------------------------------------------
+
+    def translate_filter(self, filter: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if not filter or not self.timeseries:
+            return filter
+        translated: Dict[str, Any] = {}
+        for key, value in filter.items():
+            if key in ("$and", "$or", "$nor"):
+                translated[key] = [self.translate_filter(clause) for clause in value]
+            elif key == "timestamp":
+                translated["ts"] = _translate_time(value)
+            else:
+                translated[_FIELD_MAP.get(key, key)] = value
+        return translated
+
+    def translate_field(self, field: str) -> str:
+        return _FIELD_MAP.get(field, field) if self.timeseries else field
+
+    def translate_projection(self, projection: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if not projection or not self.timeseries:
+            return projection
+        translated: Dict[str, Any] = {}
+        for key, value in projection.items():
+            target = _FIELD_MAP.get(key, key)
+            # meta.* lives under one field - project the whole subdocument
+            translated["meta" if target.startswith("meta.") else target] = value
+        return translated
+
+    def translate_sort(self, sort: Optional[Sequence[Tuple[str, int]]]) -> Optional[List[Tuple[str, int]]]:
+        if not sort or not self.timeseries:
+            return sort
+        return [(self.translate_field(key), direction) for key, direction in sort]
+
+    def translate_pipeline(self, pipeline: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Pipeline written for the standard layout -> pipeline for this store.
+
+        Leading ``$match`` stages are pushed down in the time-series layout;
+        ``$expr`` filters reference document fields, so they stay after the
+        normalizing stage like every other stage.
+        """
+        if not self.timeseries:
+            return pipeline
+        translated: List[Dict[str, Any]] = []
+        index = 0
+        while index < len(pipeline):
+            stage = pipeline[index]
+            if "$match" not in stage or "$expr" in stage["$match"]:
+                break
+            translated.append({"$match": self.translate_filter(stage["$match"])})
+            index += 1
+        translated.append(NORMALIZE_STAGE)
+        for stage in pipeline[index:]:
+            translated.append(self._translate_lookup(stage) if "$lookup" in stage else stage)
+        return translated
+
+    def _translate_lookup(self, stage: Dict[str, Any]) -> Dict[str, Any]:
+        lookup = dict(stage["$lookup"])
+        if lookup.get("from") != "games":
+            return stage
+        lookup["from"] = self.collection_name
+        if "foreignField" in lookup:
+            lookup["foreignField"] = self.translate_field(lookup["foreignField"])
+        if "pipeline" in lookup:
+            lookup["pipeline"] = self.translate_pipeline(lookup["pipeline"])
+        return {"$lookup": lookup}
+
+    def stats(self) -> Dict[str, Any]:
+        return {"mode": self.mode, "collection": self.collection_name}
@@ -0,0 +1,136 @@
+"""
+Idempotency-Key handling for /calculate.
+
+When the gateway retries a /calculate that timed out, the retry carries the
+same ``Idempotency-Key`` header and gets the original spin back instead of a
+new one - no RNG, no second game record, no second event.
+
+- Successful results are kept in a bounded LRU (IDEMPOTENCY_CACHE_SIZE)
+  for IDEMPOTENCY_TTL_SECONDS.
+- A duplicate that arrives while the first request is still running waits
+  for it rather than spinning in parallel. If the first one fails, one of
+  the waiters takes over.
+- A key reused with a different body is rejected (``IdempotencyConflict``).
+- IDEMPOTENCY_UNIQUE_INDEX=true also stores the key on the game record
+  behind a unique index, which covers retries that land on another
+  instance or after a restart. Time-series collections cannot have unique
+  indexes; there only the in-memory cache applies.
+"""
+import os
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from tornado.concurrent import Future
+
+from metrics import aggregator
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = "idempotency_key_unique"
+
+
+class IdempotencyConflict(ValueError):
+    """The key was already used for a request with a different body"""
+
+
+def fingerprint(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class IdempotencyCache:
+    """Results by Idempotency-Key, plus the requests still computing one (IOLoop thread only)"""
+
+    def __init__(self, size: Optional[int] = None, ttl: Optional[float] = None):
+        self.size = size or int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '10000'))
+        self.ttl = ttl or float(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '300'))
+        self.max_key_length = int(os.environ.get('IDEMPOTENCY_KEY_MAX_LENGTH', '255'))
+        self.index = os.environ.get('IDEMPOTENCY_UNIQUE_INDEX', 'false').lower() in ('1', 'true', 'yes')
+        # key -> (expires at, body fingerprint, response)
+        self._results: "OrderedDict[str, Tuple[float, str, Dict[str, Any]]]" = OrderedDict()
+        # key -> (body fingerprint, resolved when the owner completes or gives up)
+        self._in_flight: Dict[str, Tuple[str, Future]] = {}
+        self.counts = {"miss": 0, "hit": 0, "waited": 0, "conflict": 0, "stored": 0}
+
+    def ensure_index(self, store):
+        """Create the unique index on the games collection when IDEMPOTENCY_UNIQUE_INDEX is set"""
+        if not self.index:
+            return
+        if store.timeseries:
+            logger.warning("Time-series %s cannot have a unique index, Idempotency-Key uses the in-memory cache only",
+                           store.collection_name)
+            self.index = False
+            return
+        store.collection.create_index(
+            "idempotency_key", name=INDEX_NAME, unique=True,
+            partialFilterExpression={"idempotency_key": {"$exists": True}}
+        )
+
+    def _get(self, key: str) -> Optional[Tuple[float, str, Dict[str, Any]]]:
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._results[key]
+            return None
+        self._results.move_to_end(key)
+        return entry
+
+    def _count(self, result: str):
+        self.counts[result] += 1
+        aggregator.increment("game.calculate.idempotency", tags={"result": result})
+
+    async def claim(self, key: str, body_fingerprint: str) -> Optional[Dict[str, Any]]:
+        """
+        The stored response for `key`, or None when the caller now owns the computation
+        and must call `complete` or `abandon` when done.
+        """
+        waited = False
+        while True:
+            entry = self._get(key)
+            if entry is not None:
+                if entry[1] != body_fingerprint:
+                    self._count("conflict")
+                    raise IdempotencyConflict("Idempotency-Key was already used with a different request body")
+                self._count("waited" if waited else "hit")
+                return entry[2]
+            pending = self._in_flight.get(key)
+            if pending is None:
+                self._in_flight[key] = (body_fingerprint, Future())
+                self._count("miss")
+                return None
+            if pending[0] != body_fingerprint:
+                self._count("conflict")
+                raise IdempotencyConflict("Idempotency-Key is in use by a request with a different body")
+            waited = True
+            await pending[1]
+
+    def complete(self, key: str, body_fingerprint: str, response: Dict[str, Any]):
+        """Store the owner's response and hand it to the requests waiting on it"""
+        self._results[key] = (time.monotonic() + self.ttl, body_fingerprint, response)
+        self._results.move_to_end(key)
+        while len(self._results) > self.size:
+            self._results.popitem(last=False)
+        self.counts["stored"] += 1
+        self._release(key)
+
+    def abandon(self, key: str):
+        """The owner failed: nothing is stored and one waiter retries the computation"""
+        self._release(key)
+
+    def _release(self, key: str):
+        pending = self._in_flight.pop(key, None)
+        if pending is not None and not pending[1].done():
+            pending[1].set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.size,
+            "ttl_seconds": self.ttl,
+            "unique_index": self.index,
+            "cached": len(self._results),
+            "in_flight": len(self._in_flight),
+            **self.counts,
+        }
@@ -0,0 +1,197 @@
+"""
+IOLoop lag monitoring and admission control for the game engine.
+
+``LoopLagMonitor`` schedules a callback every LOOP_LAG_INTERVAL_MS and
+records how late it ran - the time ready callbacks spent waiting for the
+loop. A watchdog thread notices when the loop stops ticking altogether and,
+once the stall passes LOOP_STALL_THRESHOLD_MS, captures the loop thread's
+stack, which points at the blocking frame (a CPU-bound spin, a synchronous
+pymongo call, ``time.sleep``...).
+
+``AdmissionController`` turns /calculate away with 503 + Retry-After while
+recent lag or the number of requests in flight is over its limit, so an
+overloaded process sheds the excess quickly instead of queueing everything
+until the gateway times out.
+"""
+import os
+import sys
+import time
+import logging
+import threading
+import traceback
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import sentry_sdk
+from tornado import ioloop
+
+from metrics import aggregator
+from telemetry import Histogram
+
+logger = logging.getLogger(__name__)
+
+loop_lag = Histogram("event_loop_lag", "loop", "How late scheduled IOLoop callbacks ran")
+
+
+class LoopLagMonitor:
+    """Measures IOLoop scheduling delay and captures the stack of long stalls"""
+
+    def __init__(self, interval_ms: Optional[float] = None, stall_threshold_ms: Optional[float] = None,
+                 on_lag=None):
+        self.interval = (interval_ms or float(os.environ.get('LOOP_LAG_INTERVAL_MS', '50'))) / 1000
+        self.stall_threshold = (stall_threshold_ms or float(os.environ.get('LOOP_STALL_THRESHOLD_MS', '200'))) / 1000
+        self.report_interval = float(os.environ.get('LOOP_STALL_REPORT_INTERVAL_SECONDS', '60'))
+        # Called on every tick with the worst lag of the last second, in ms
+        self.on_lag = on_lag
+        self.loop: Optional[ioloop.IOLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.last_tick = time.monotonic()
+        self._expected = 0.0
+        # Lag of the last second of ticks, for admission decisions
+        self._recent: deque = deque(maxlen=max(int(1 / self.interval), 1))
+        self._stalls: deque = deque(maxlen=int(os.environ.get('LOOP_STALL_BUFFER_SIZE', '20')))
+        self._current_stall: Optional[Dict[str, Any]] = None
+        self._last_reported = 0.0
+        self._stop = threading.Event()
+        self.ticks = 0
+        self.stalls_total = 0
+
+    def start(self, loop: Optional[ioloop.IOLoop] = None):
+        """Call from the loop's thread, before or after it starts"""
+        self.loop = loop or ioloop.IOLoop.current()
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self._expected = self.last_tick + self.interval
+        self.loop.call_later(self.interval, self._tick)
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _tick(self):
+        now = time.monotonic()
+        lag = max(now - self._expected, 0.0)
+        self.last_tick = now
+        self.ticks += 1
+        loop_lag.observe("ioloop", lag)
+        self._recent.append(lag)
+        if self.on_lag is not None:
+            self.on_lag(self.recent_lag_ms())
+        stall = self._current_stall
+        if stall is not None:
+            # The loop is back - the stall lasted as long as this tick was late
+            stall["duration_ms"] = round(lag * 1000, 1)
+            self._current_stall = None
+            logger.warning("IOLoop was blocked for %.0f ms", lag * 1000)
+        if not self._stop.is_set():
+            self._expected = now + self.interval
+            self.loop.call_later(self.interval, self._tick)
+
+    def _watchdog(self):
+        while not self._stop.wait(self.stall_threshold / 4):
+            blocked = time.monotonic() - self.last_tick - self.interval
+            if blocked < self.stall_threshold or self._current_stall is not None:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.format_stack(frame)
+            stall = {
+                "detected_at": time.time(),
+                "blocked_ms_at_capture": round(blocked * 1000, 1),
+                "duration_ms": None,
+                # Innermost frame last, like a traceback
+                "stack": [line.rstrip() for line in stack[-25:]],
+            }
+            self._current_stall = stall
+            self._stalls.append(stall)
+            self.stalls_total += 1
+            aggregator.increment("game.loop.stalls")
+            self._report(stall)
+
+    def _report(self, stall: Dict[str, Any]):
+        logger.warning("IOLoop blocked for %.0f ms in:\n%s", stall["blocked_ms_at_capture"], "\n".join(stall["stack"][-6:]))
+        now = time.monotonic()
+        if now - self._last_reported < self.report_interval:
+            return
+        self._last_reported = now
+        with sentry_sdk.push_scope() as scope:
+            scope.set_tag("loop.stall", "true")
+            scope.set_extra("blocked_ms", stall["blocked_ms_at_capture"])
+            scope.set_extra("stack", "\n".join(stall["stack"]))
+            scope.fingerprint = ["ioloop-stall", stall["stack"][-1] if stall["stack"] else "unknown"]
+            sentry_sdk.capture_message(
+                f"IOLoop blocked for over {int(self.stall_threshold * 1000)} ms", level="warning"
+            )
+
+    def blocked_ms(self) -> float:
+        """How long the loop has gone without ticking beyond its interval"""
+        return max(time.monotonic() - self.last_tick - self.interval, 0.0) * 1000
+
+    def recent_lag_ms(self) -> float:
+        """Worst lag of about the last second"""
+        return max(self._recent, default=0.0) * 1000
+
+    def stalls(self, limit: int = 20) -> List[Dict[str, Any]]:
+        return list(self._stalls)[-limit:][::-1]
+
+    def stats(self) -> Dict[str, Any]:
+        counts = loop_lag.merged().get("ioloop")
+        return {
+            "interval_ms": self.interval * 1000,
+            "stall_threshold_ms": self.stall_threshold * 1000,
+            "ticks": self.ticks,
+            "recent_lag_ms": round(self.recent_lag_ms(), 1),
+            "lag_ms": {
+                f"p{str(q * 100).rstrip('0').rstrip('.')}": round(loop_lag.quantile(counts, q) * 1000, 2)
+                for q in (0.5, 0.9, 0.99, 0.999)
+            } if counts else None,
+            "stalls_total": self.stalls_total,
+        }
+
+
+class AdmissionController:
+    """Rejects work while the loop is lagging or too many requests are in flight"""
+
+    def __init__(self, monitor: LoopLagMonitor, max_in_flight: Optional[int] = None,
+                 max_lag_ms: Optional[float] = None, retry_after: Optional[int] = None):
+        self.monitor = monitor
+        self.max_in_flight = max_in_flight or int(os.environ.get('CALCULATE_MAX_IN_FLIGHT', '64'))
+        self.max_lag_ms = max_lag_ms or float(os.environ.get('CALCULATE_MAX_LOOP_LAG_MS', '250'))
+        self.retry_after = retry_after or int(os.environ.get('CALCULATE_RETRY_AFTER_SECONDS', '1'))
+        self.enabled = os.environ.get('CALCULATE_ADMISSION_CONTROL', 'true').lower() in ('1', 'true', 'yes')
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = {"loop_lag": 0, "in_flight": 0}
+
+    def admit(self) -> Optional[str]:
+        """None when the request may run, otherwise the reason it is shed"""
+        if not self.enabled:
+            self.in_flight += 1
+            return None
+        reason = None
+        if self.in_flight >= self.max_in_flight:
+            reason = "in_flight"
+        elif self.monitor.recent_lag_ms() > self.max_lag_ms:
+            reason = "loop_lag"
+        if reason is None:
+            self.in_flight += 1
+            self.admitted += 1
+            return None
+        self.shed[reason] += 1
+        aggregator.increment("game.calculate.shed", tags={"reason": reason})
+        return reason
+
+    def release(self):
+        self.in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "max_in_flight": self.max_in_flight,
+            "max_loop_lag_ms": self.max_lag_ms,
+            "retry_after_seconds": self.retry_after,
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "shed": dict(self.shed),
+        }
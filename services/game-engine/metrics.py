@@ -1,10 +1,249 @@
 """
 Shared business metrics definitions and helpers for Sentry POC
 """
+import os
+import re
+import math
 import time
-from typing import Dict, Any, Optional
+import bisect
+import logging
+import threading
+from typing import Dict, Any, List, Optional, Tuple
 import sentry_sdk
 
+logger = logging.getLogger(__name__)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+DISTRIBUTION = "distribution"
+
+# Upper bounds of distribution buckets, by unit (+Inf is implicit)
+_BUCKETS = {
+    "percent": (10, 20, 30, 40, 50, 60, 70, 80, 85, 90, 95, 98, 100, 110, 150, 200),
+    "default": (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 100000),
+}
+
+
+def _tag_key(tags: Optional[Dict[str, Any]]) -> Tuple[Tuple[str, str], ...]:
+    if not tags:
+        return ()
+    return tuple(sorted((str(k), str(v)) for k, v in tags.items()))
+
+
+def _prometheus_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+
+
+def _prometheus_labels(tags: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(tags) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = ('{}="{}"'.format(_prometheus_name(k), v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for k, v in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+class MetricAggregator:
+    """
+    In-process pre-aggregation of counters, gauges and distributions.
+
+    Every thread records into its own shard (a plain dict reached through
+    ``threading.local``), so recording never takes a lock: a call is one dict
+    lookup and a few in-place updates. Shard values are cumulative; a
+    background thread merges the shards every METRICS_FLUSH_INTERVAL_SECONDS
+    and sends the deltas since the previous flush to Sentry. ``prometheus()``
+    renders the merged cumulative values for a local ``/metrics`` endpoint.
+
+    Values are per process - each uvicorn or consumer worker reports its own.
+    """
+
+    def __init__(self, flush_interval: Optional[float] = None):
+        self.flush_interval = flush_interval or float(os.environ.get('METRICS_FLUSH_INTERVAL_SECONDS', '10'))
+        self._local = threading.local()
+        self._shards: List[Dict[Tuple, Any]] = []
+        self._register_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._previous: Dict[Tuple, Any] = {}
+        self._flusher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.flushes = 0
+        self.flush_errors = 0
+        self.last_flush_at: Optional[float] = None
+
+    # --- recording ------------------------------------------------------
+
+    def _shard(self) -> Dict[Tuple, Any]:
+        try:
+            return self._local.values
+        except AttributeError:
+            values: Dict[Tuple, Any] = {}
+            with self._register_lock:
+                self._shards.append(values)
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+                    self._flusher.start()
+            self._local.values = values
+            return values
+
+    def increment(self, name: str, value: float = 1, unit: str = "none", tags: Optional[Dict[str, Any]] = None):
+        values = self._shard()
+        key = (COUNTER, name, unit, _tag_key(tags))
+        values[key] = values.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, unit: str = "none", tags: Optional[Dict[str, Any]] = None):
+        values = self._shard()
+        key = (GAUGE, name, unit, _tag_key(tags))
+        state = values.get(key)
+        if state is None:
+            values[key] = [value, time.time(), value, 1]
+        else:
+            state[0] = value
+            state[1] = time.time()
+            state[2] += value
+            state[3] += 1
+
+    def distribution(self, name: str, value: float, unit: str = "none", tags: Optional[Dict[str, Any]] = None):
+        values = self._shard()
+        key = (DISTRIBUTION, name, unit, _tag_key(tags))
+        state = values.get(key)
+        if state is None:
+            # [count, sum, bucket counts...]
+            state = values[key] = [0, 0.0] + [0] * (len(_BUCKETS.get(unit, _BUCKETS["default"])) + 1)
+        state[0] += 1
+        state[1] += value
+        state[2 + bisect.bisect_left(_BUCKETS.get(unit, _BUCKETS["default"]), value)] += 1
+
+    # --- reading --------------------------------------------------------
+
+    def snapshot(self) -> Dict[Tuple, Any]:
+        """Cumulative values merged across every thread's shard"""
+        with self._register_lock:
+            shards = list(self._shards)
+        merged: Dict[Tuple, Any] = {}
+        for shard in shards:
+            # dict.copy() runs without releasing the GIL, so it never sees a half-inserted key
+            for key, value in shard.copy().items():
+                kind = key[0]
+                if kind == COUNTER:
+                    merged[key] = merged.get(key, 0) + value
+                elif kind == GAUGE:
+                    last = merged.get(key)
+                    if last is None:
+                        merged[key] = list(value)
+                    else:
+                        if value[1] >= last[1]:
+                            last[0], last[1] = value[0], value[1]
+                        last[2] += value[2]
+                        last[3] += value[3]
+                else:
+                    current = merged.get(key)
+                    merged[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+        return merged
+
+    def flush(self) -> int:
+        """Send what changed since the last flush to Sentry; returns the number of series sent"""
+        with self._flush_lock:
+            snapshot = self.snapshot()
+            sent = 0
+            try:
+                from sentry_sdk import metrics as sentry_metrics
+            except ImportError:
+                sentry_metrics = None
+            for key, value in snapshot.items():
+                kind, name, unit, tags = key
+                previous = self._previous.get(key)
+                tag_dict = dict(tags)
+                try:
+                    if kind == COUNTER:
+                        delta = value - (previous or 0)
+                        if delta and sentry_metrics:
+                            sentry_metrics.incr(name, delta, unit=unit, tags=tag_dict)
+                            sent += 1
+                    elif kind == GAUGE:
+                        if value[3] != (previous[3] if previous else 0) and sentry_metrics:
+                            sentry_metrics.gauge(name, value[0], unit=unit, tags=tag_dict)
+                            sent += 1
+                    else:
+                        count = value[0] - (previous[0] if previous else 0)
+                        total = value[1] - (previous[1] if previous else 0.0)
+                        if count and sentry_metrics:
+                            # Pre-aggregated: one interval average plus count and sum
+                            sentry_metrics.gauge(name, total / count, unit=unit, tags=tag_dict)
+                            sentry_metrics.incr(f"{name}.count", count, tags=tag_dict)
+                            sentry_metrics.incr(f"{name}.sum", total, unit=unit, tags=tag_dict)
+                            sent += 1
+                except Exception as e:
+                    if not self.flush_errors:
+                        logger.warning("Metric flush of %s failed, business metrics only reach /metrics: %s", name, e)
+                    self.flush_errors += 1
+            self._previous = snapshot
+            self.flushes += 1
+            self.last_flush_at = time.time()
+            return sent
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning("Metric flush failed: %s", e)
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def prometheus(self) -> str:
+        """Cumulative values in the Prometheus text exposition format"""
+        by_name: Dict[Tuple[str, str], List[Tuple[Tuple, Any]]] = {}
+        for key, value in sorted(self.snapshot().items(), key=lambda item: (item[0][1], item[0][3])):
+            by_name.setdefault((key[0], key[1]), []).append((key, value))
+
+        lines: List[str] = []
+        for (kind, name), series in sorted(by_name.items(), key=lambda item: item[0][1]):
+            metric = _prometheus_name(name)
+            if kind == COUNTER:
+                lines.append(f"# TYPE {metric}_total counter")
+                lines.extend(f"{metric}_total{_prometheus_labels(key[3])} {value}" for key, value in series)
+            elif kind == GAUGE:
+                lines.append(f"# TYPE {metric} gauge")
+                lines.extend(f"{metric}{_prometheus_labels(key[3])} {value[0]}" for key, value in series)
+            else:
+                lines.append(f"# TYPE {metric} histogram")
+                for key, value in series:
+                    bounds = _BUCKETS.get(key[2], _BUCKETS["default"])
+                    cumulative = 0
+                    for bound, count in zip(list(bounds) + ["+Inf"], value[2:]):
+                        cumulative += count
+                        lines.append(f"{metric}_bucket{_prometheus_labels(key[3], ('le', str(bound)))} {cumulative}")
+                    lines.append(f"{metric}_sum{_prometheus_labels(key[3])} {value[1]}")
+                    lines.append(f"{metric}_count{_prometheus_labels(key[3])} {value[0]}")
+        return "\n".join(lines) + "\n"
+
+    def stats(self) -> Dict[str, Any]:
+        with self._register_lock:
+            shards = len(self._shards)
+        return {
+            "series": len(self.snapshot()),
+            "shards": shards,
+            "flush_interval_seconds": self.flush_interval,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "last_flush_at": self.last_flush_at,
+        }
+
+
+# One aggregator per process, shared by every BusinessMetrics call
+aggregator = MetricAggregator()
+
+# Metrics reported as the latest value rather than a distribution of values
+_GAUGES = {"business.active_sessions", "business.rtp.rolling_24h"}
+
+
+def _direct_enabled() -> bool:
+    """BUSINESS_METRICS_DIRECT=true also attaches every value to the current transaction (old behaviour)"""
+    return os.environ.get('BUSINESS_METRICS_DIRECT', 'false').lower() in ('1', 'true', 'yes')
+
+
 class BusinessMetrics:
     """Business metric constants and helpers"""
     
@@ -33,11 +272,21 @@ class BusinessMetrics:
     
     @staticmethod
     def track_metric(name: str, value: float, unit: str = "none", tags: Optional[Dict[str, str]] = None):
-        """Track a business metric in Sentry"""
-        sentry_sdk.set_measurement(name, value, unit)
-        if tags:
-            for tag_name, tag_value in tags.items():
-                sentry_sdk.set_tag(f"metric.{tag_name}", tag_value)
+        """Track a business metric (aggregated in-process, flushed to Sentry periodically)"""
+        if name in _GAUGES:
+            aggregator.gauge(name, value, unit, tags)
+        else:
+            aggregator.distribution(name, value, unit, tags)
+        if _direct_enabled():
+            sentry_sdk.set_measurement(name, value, unit)
+            if tags:
+                for tag_name, tag_value in tags.items():
+                    sentry_sdk.set_tag(f"metric.{tag_name}", tag_value)
+    
+    @staticmethod
+    def increment(name: str, value: float = 1, unit: str = "none", tags: Optional[Dict[str, str]] = None):
+        """Count an event (aggregated like track_metric)"""
+        aggregator.increment(name, value, unit, tags)
     
     @staticmethod
     def track_rtp(total_bets: float, total_payouts: float, period: str = "current"):
@@ -73,38 +322,285 @@ class BusinessMetrics:
         return transaction
 
 
+# Detector tuning (shared by every metric)
+EWMA_ALPHA = float(os.environ.get('ANOMALY_EWMA_ALPHA', '0.02'))
+WARMUP_SAMPLES = int(os.environ.get('ANOMALY_WARMUP_SAMPLES', '50'))
+Z_ENTER = float(os.environ.get('ANOMALY_Z_ENTER', '4'))
+Z_EXIT = float(os.environ.get('ANOMALY_Z_EXIT', '2'))
+CUSUM_SLACK = float(os.environ.get('ANOMALY_CUSUM_SLACK', '0.5'))
+CUSUM_LIMIT = float(os.environ.get('ANOMALY_CUSUM_LIMIT', '8'))
+EXIT_SAMPLES = int(os.environ.get('ANOMALY_EXIT_SAMPLES', '20'))
+# Standard deviation of a single spin's return, in RTP percent, used to widen
+# the RTP bounds for small samples (the slot math gives about 250%)
+RTP_SPIN_STDDEV = float(os.environ.get('ANOMALY_RTP_SPIN_STDDEV', '250'))
+RTP_CONFIDENCE_Z = float(os.environ.get('ANOMALY_RTP_CONFIDENCE_Z', '3'))
+ALERT_COOLDOWN_SECONDS = float(os.environ.get('ANOMALY_ALERT_COOLDOWN_SECONDS', '600'))
+ALERTS_PER_MINUTE = int(os.environ.get('ANOMALY_ALERTS_PER_MINUTE', '10'))
+
+
+class _MetricStream:
+    """
+    Streaming state of one metric: EWMA mean/variance and a two-sided CUSUM,
+    all updated in O(1) per observation.
+    """
+
+    __slots__ = ("alpha", "min_stddev", "count", "mean", "variance", "cusum_high", "cusum_low",
+                 "anomalous", "direction", "quiet", "last_value", "lock")
+
+    def __init__(self, alpha: float, min_stddev: float):
+        self.alpha = alpha
+        self.min_stddev = min_stddev
+        self.count = 0
+        self.mean = 0.0
+        self.variance = 0.0
+        self.cusum_high = 0.0
+        self.cusum_low = 0.0
+        # Hysteresis: once anomalous, stays so until `quiet` normal observations in a row
+        self.anomalous = False
+        self.direction: Optional[str] = None
+        self.quiet = 0
+        self.last_value: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def stddev(self) -> float:
+        return max(math.sqrt(self.variance), self.min_stddev)
+
+    def update(self, value: float) -> Tuple[float, float, float]:
+        """Add an observation; returns (z-score, CUSUM high, CUSUM low) against the state before it"""
+        self.last_value = value
+        self.count += 1
+        if self.count == 1:
+            self.mean = value
+            return 0.0, 0.0, 0.0
+        stddev = self.stddev()
+        deviation = value - self.mean
+        z = deviation / stddev
+        # CUSUM in units of sigma, with a slack of CUSUM_SLACK sigma per observation
+        self.cusum_high = max(0.0, self.cusum_high + z - CUSUM_SLACK)
+        self.cusum_low = max(0.0, self.cusum_low - z - CUSUM_SLACK)
+        # EWMA mean and variance (West's incremental form)
+        increment = self.alpha * deviation
+        self.mean += increment
+        self.variance = (1 - self.alpha) * (self.variance + deviation * increment)
+        return z, self.cusum_high, self.cusum_low
+
+    def reset_cusum(self):
+        self.cusum_high = 0.0
+        self.cusum_low = 0.0
+
+
+# Tags that tell series of one metric apart - RTP over 1h and over 7 days are
+# different signals. Other tags only annotate an observation.
+SERIES_TAGS = ("period", "scenario")
+
+
+def _series(tags: Optional[Dict[str, Any]]) -> Tuple[Tuple[str, str], ...]:
+    """Normalized series tags of an observation"""
+    if not tags:
+        return ()
+    return tuple(sorted((name, str(tags[name])) for name in SERIES_TAGS if name in tags))
+
+
+def _series_name(metric_name: str, series: Tuple[Tuple[str, str], ...]) -> str:
+    """``business.rtp{period=24h}``"""
+    if not series:
+        return metric_name
+    return metric_name + "{" + ",".join(f"{name}={value}" for name, value in series) + "}"
+
+
+class _AlertLimiter:
+    """Deduplicates alerts per (series, direction) within a cooldown and caps the overall alert rate"""
+
+    def __init__(self, cooldown: float, per_minute: int):
+        self.cooldown = cooldown
+        self.per_minute = per_minute
+        self._lock = threading.Lock()
+        self._last_sent: Dict[Tuple[str, str], float] = {}
+        self._suppressed: Dict[Tuple[str, str], int] = {}
+        self._tokens = float(per_minute)
+        self._refilled_at = time.monotonic()
+        self.sent = 0
+        self.deduplicated = 0
+        self.rate_limited = 0
+
+    def acquire(self, key: Tuple[str, str]) -> Optional[int]:
+        """Number of alerts suppressed for `key` since the last one sent, or None to drop this one"""
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_sent.get(key)
+            if last is not None and now - last < self.cooldown:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                self.deduplicated += 1
+                return None
+            self._tokens = min(float(self.per_minute), self._tokens + (now - self._refilled_at) * self.per_minute / 60)
+            self._refilled_at = now
+            if self._tokens < 1:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                self.rate_limited += 1
+                return None
+            self._tokens -= 1
+            self._last_sent[key] = now
+            self.sent += 1
+            return self._suppressed.pop(key, 0)
+
+
 class MetricAnomalyDetector:
-    """Simple anomaly detection for business metrics"""
-    
+    """
+    Streaming anomaly detection for business metrics.
+
+    Instances are cheap views over state shared by the whole process, so a
+    detector created per request still sees every earlier observation. A
+    metric is anomalous when it leaves its fixed bounds (widened by a
+    confidence interval for RTP computed over few games), or, after a warm-up,
+    when its EWMA z-score or CUSUM crosses the entry limits. It only returns
+    to normal after EXIT_SAMPLES observations back inside the exit limits.
+    Each metric keeps one state per series (its SERIES_TAGS, e.g. ``period``),
+    so windows of different lengths are never mixed into one baseline.
+    Alerts are sent on entering the anomalous state, deduplicated per series
+    and direction and rate-limited overall.
+    """
+
+    _streams: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], _MetricStream] = {}
+    _streams_lock = threading.Lock()
+    _limiter = _AlertLimiter(ALERT_COOLDOWN_SECONDS, ALERTS_PER_MINUTE)
+
+    # Normal range of each metric; RTP ones get wider for small samples
+    thresholds = {
+        BusinessMetrics.RTP: {"min": 85, "max": 98, "min_stddev": 0.5},  # RTP should be 85-98%
+        BusinessMetrics.RTP_ROLLING: {"min": 85, "max": 98, "min_stddev": 0.5},
+        BusinessMetrics.WIN_RATE: {"min": 20, "max": 50, "min_stddev": 1.0},  # Win rate 20-50%
+        BusinessMetrics.PAYMENT_SUCCESS_RATE: {"min": 95, "max": 100, "min_stddev": 0.5},  # Payment success >95%
+    }
+    _RTP_METRICS = (BusinessMetrics.RTP, BusinessMetrics.RTP_ROLLING)
+
     def __init__(self):
-        self.thresholds = {
-            BusinessMetrics.RTP: {"min": 85, "max": 98},  # RTP should be 85-98%
-            BusinessMetrics.WIN_RATE: {"min": 20, "max": 50},  # Win rate 20-50%
-            BusinessMetrics.PAYMENT_SUCCESS_RATE: {"min": 95, "max": 100},  # Payment success >95%
-        }
-    
-    def check_anomaly(self, metric_name: str, value: float) -> Optional[str]:
-        """Check if a metric value is anomalous"""
-        if metric_name in self.thresholds:
-            threshold = self.thresholds[metric_name]
-            if value < threshold["min"]:
-                return f"{metric_name} too low: {value:.2f} (expected >= {threshold['min']})"
-            elif value > threshold["max"]:
-                return f"{metric_name} too high: {value:.2f} (expected <= {threshold['max']})"
-        return None
-    
-    def track_with_anomaly_detection(self, metric_name: str, value: float, **kwargs):
+        self.thresholds = MetricAnomalyDetector.thresholds
+
+    def _stream(self, metric_name: str, series: Tuple[Tuple[str, str], ...] = ()) -> _MetricStream:
+        key = (metric_name, series)
+        stream = self._streams.get(key)
+        if stream is None:
+            with self._streams_lock:
+                stream = self._streams.get(key)
+                if stream is None:
+                    min_stddev = self.thresholds.get(metric_name, {}).get("min_stddev", 1e-9)
+                    stream = self._streams[key] = _MetricStream(EWMA_ALPHA, min_stddev)
+        return stream
+
+    def bounds(self, metric_name: str, sample_size: Optional[int] = None) -> Optional[Tuple[float, float]]:
+        """Fixed bounds of a metric, widened by the RTP confidence interval for `sample_size` games"""
+        threshold = self.thresholds.get(metric_name)
+        if threshold is None:
+            return None
+        low, high = threshold["min"], threshold["max"]
+        if sample_size and metric_name in self._RTP_METRICS:
+            margin = RTP_CONFIDENCE_Z * RTP_SPIN_STDDEV / math.sqrt(sample_size)
+            low, high = low - margin, high + margin
+        return low, high
+
+    def _evaluate(self, metric_name: str, value: float, sample_size: Optional[int],
+                  series: Tuple[Tuple[str, str], ...] = ()) -> Tuple[Optional[str], bool]:
+        """Update the series' stream; returns (description if anomalous, whether it just became so)"""
+        stream = self._stream(metric_name, series)
+        bounds = self.bounds(metric_name, sample_size)
+        name = _series_name(metric_name, series)
+        with stream.lock:
+            z, cusum_high, cusum_low = stream.update(value)
+            warmed_up = stream.count > WARMUP_SAMPLES
+
+            reason, direction = None, None
+            if bounds is not None and value < bounds[0]:
+                reason, direction = f"{name} too low: {value:.2f} (expected >= {bounds[0]:.2f})", "low"
+            elif bounds is not None and value > bounds[1]:
+                reason, direction = f"{name} too high: {value:.2f} (expected <= {bounds[1]:.2f})", "high"
+            elif warmed_up and abs(z) >= Z_ENTER:
+                direction = "high" if z > 0 else "low"
+                reason = f"{name} jumped {direction}: {value:.2f} is {z:+.1f} sigma from {stream.mean:.2f}"
+            elif warmed_up and max(cusum_high, cusum_low) >= CUSUM_LIMIT:
+                direction = "high" if cusum_high >= cusum_low else "low"
+                reason = f"{name} drifting {direction}: {value:.2f} (mean {stream.mean:.2f})"
+                stream.reset_cusum()
+
+            if reason is not None:
+                entered = not stream.anomalous or stream.direction != direction
+                stream.anomalous, stream.direction, stream.quiet = True, direction, 0
+                return reason, entered
+
+            if stream.anomalous:
+                inside = bounds is None or (bounds[0] + self._hysteresis(bounds) <= value <= bounds[1] - self._hysteresis(bounds))
+                if inside and abs(z) < Z_EXIT:
+                    stream.quiet += 1
+                else:
+                    stream.quiet = 0
+                if stream.quiet < EXIT_SAMPLES:
+                    return f"{name} still anomalous ({stream.direction}): {value:.2f}", False
+                logger.info("Business metric %s back to normal at %.2f", name, value)
+                stream.anomalous, stream.direction, stream.quiet = False, None, 0
+            return None, False
+
+    @staticmethod
+    def _hysteresis(bounds: Tuple[float, float]) -> float:
+        # Re-entering the band needs a margin of 10% of its width
+        return (bounds[1] - bounds[0]) * 0.1
+
+    def check_anomaly(self, metric_name: str, value: float, sample_size: Optional[int] = None,
+                      tags: Optional[Dict[str, str]] = None) -> Optional[str]:
+        """Record a value and describe the anomaly if its series is in one"""
+        anomaly, _ = self._evaluate(metric_name, value, sample_size, _series(tags))
+        return anomaly
+
+    def track_with_anomaly_detection(self, metric_name: str, value: float, sample_size: Optional[int] = None, **kwargs):
         """Track metric and detect anomalies"""
         BusinessMetrics.track_metric(metric_name, value, **kwargs)
         
-        anomaly = self.check_anomaly(metric_name, value)
-        if anomaly:
-            sentry_sdk.capture_message(
-                f"Business Metric Anomaly: {anomaly}",
-                level="warning",
-                tags={
-                    "anomaly.type": "business_metric",
-                    "anomaly.metric": metric_name,
-                    "anomaly.value": value
+        series = _series(kwargs.get("tags"))
+        anomaly, entered = self._evaluate(metric_name, value, sample_size, series)
+        if not entered:
+            return
+        stream = self._stream(metric_name, series)
+        name = _series_name(metric_name, series)
+        suppressed = self._limiter.acquire((name, stream.direction))
+        if suppressed is None:
+            return
+        sentry_sdk.capture_message(
+            f"Business Metric Anomaly: {anomaly}",
+            level="warning",
+            tags={
+                "anomaly.type": "business_metric",
+                "anomaly.metric": metric_name,
+                "anomaly.series": name,
+                "anomaly.direction": stream.direction,
+                "anomaly.value": value
+            },
+            extras={
+                "ewma_mean": stream.mean,
+                "ewma_stddev": stream.stddev(),
+                "observations": stream.count,
+                "sample_size": sample_size,
+                "suppressed_since_last_alert": suppressed
+            },
+            # One issue per series and direction, however the value moves
+            fingerprint=["business-metric-anomaly", name, stream.direction]
+        )
+
+    @classmethod
+    def stats(cls) -> Dict[str, Any]:
+        return {
+            "metrics": {
+                name: {
+                    "observations": stream.count,
+                    "last_value": stream.last_value,
+                    "ewma_mean": round(stream.mean, 4),
+                    "ewma_stddev": round(stream.stddev(), 4),
+                    "cusum_high": round(stream.cusum_high, 2),
+                    "cusum_low": round(stream.cusum_low, 2),
+                    "anomalous": stream.anomalous,
+                    "direction": stream.direction
                 }
-            )
\ No newline at end of file
+                for (metric_name, series), stream in list(cls._streams.items())
+                for name in (_series_name(metric_name, series),)
+            },
+            "alerts_sent": cls._limiter.sent,
+            "alerts_deduplicated": cls._limiter.deduplicated,
+            "alerts_rate_limited": cls._limiter.rate_limited
+        }
@@ -3,7 +3,7 @@ import json
 import logging
 import pika
 import sentry_sdk
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from threading import Lock
 
 logger = logging.getLogger(__name__)
@@ -59,6 +59,15 @@ class GameResultPublisher:
             game_data: Game result data
             trace_headers: Sentry trace headers for distributed tracing
         """
+        self.publish_game_results([(game_data, trace_headers)])
+    
+    def publish_game_results(self, results: List[Tuple[Dict[str, Any], Dict[str, str]]]):
+        """
+        Publish a batch of game results under one lock and connection check
+        
+        Args:
+            results: (game data, trace headers) pairs, published in order
+        """
         with self.lock:
             try:
                 # Ensure connection is alive
@@ -69,28 +78,29 @@ class GameResultPublisher:
                     logger.error("No RabbitMQ channel available")
                     return
                 
-                # Prepare message with trace context
-                message = {
-                    'data': game_data,
-                    'trace': trace_headers,
-                    'timestamp': game_data.get('timestamp')
-                }
-                
-                # Publish with persistence
-                self.channel.basic_publish(
-                    exchange='gaming',
-                    routing_key='game.result',
-                    body=json.dumps(message),
-                    properties=pika.BasicProperties(
-                        delivery_mode=2,  # Make message persistent
-                        headers=trace_headers  # Include trace headers
+                for game_data, trace_headers in results:
+                    # Prepare message with trace context
+                    message = {
+                        'data': game_data,
+                        'trace': trace_headers,
+                        'timestamp': game_data.get('timestamp')
+                    }
+                    
+                    # Publish with persistence
+                    self.channel.basic_publish(
+                        exchange='gaming',
+                        routing_key='game.result',
+                        body=json.dumps(message),
+                        properties=pika.BasicProperties(
+                            delivery_mode=2,  # Make message persistent
+                            headers=trace_headers  # Include trace headers
+                        )
                     )
-                )
-                
-                logger.info(f"Published game result for user {game_data.get('user_id')}")
+                    
+                    logger.info("Published game result for user %s", game_data.get('user_id'))
                 
             except Exception as e:
-                logger.error(f"Failed to publish game result: {e}")
+                logger.error("Failed to publish game result: %s", e)
                 sentry_sdk.capture_exception(e)
                 # Try to reconnect on next publish
                 self.connection = None
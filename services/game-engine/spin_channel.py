@@ -0,0 +1,145 @@
+"""
+Persistent WebSocket spin channel for high-frequency players and bots (/ws/spin).
+
+Autoplay clients that POST /calculate several times a second pay header
+parsing, trace continuation and a JSON envelope on every spin. On the
+channel they connect once (``/ws/spin?userId=...``; the upgrade is refused
+with a 400 without a userId) and exchange compact frames:
+
+    -> {"id": 7, "bet": 10}
+    <- {"id": 7, "w": 1, "p": 20, "s": ["🍒", "🍒", "🍒"], "g": "<game id>"}
+    <- {"id": 8, "e": "rate_limited", "retry_ms": 40}
+
+- Results come back in the order the spins were sent, each once its game
+  record is stored. A client may pipeline up to SPIN_CHANNEL_MAX_PIPELINE
+  spins; beyond that the socket is not read until the oldest is answered,
+  so a fast client is slowed down instead of queueing without bound.
+- ``SpinWriter`` stores and publishes the records of all connections in
+  batches - one insert_many and one publisher lock per batch instead of a
+  round trip per spin (SPIN_WRITE_BATCH_SIZE, SPIN_WRITE_FLUSH_MS).
+- Each connection has a token bucket (SPIN_CHANNEL_RATE_PER_SECOND,
+  SPIN_CHANNEL_BURST); spins over it are answered with ``rate_limited``.
+- The handshake continues the upstream trace once. Every spin is its own
+  transaction, carrying the connection's trace and span id as data.
+"""
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import sentry_sdk
+from tornado import ioloop
+from tornado.concurrent import Future
+
+from telemetry import Histogram, batch_sizes
+
+logger = logging.getLogger(__name__)
+
+MAX_PIPELINE = int(os.environ.get('SPIN_CHANNEL_MAX_PIPELINE', '32'))
+MAX_FRAME_BYTES = int(os.environ.get('SPIN_CHANNEL_MAX_FRAME_BYTES', '4096'))
+
+spin_latency = Histogram("spin_channel_spin_duration", "outcome",
+                         "Spin channel latency from frame received to result sent")
+
+
+class TokenBucket:
+    """Spins a connection may make: `rate` per second with bursts of up to `burst`"""
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[float] = None):
+        self.rate = rate if rate is not None else float(os.environ.get('SPIN_CHANNEL_RATE_PER_SECOND', '20'))
+        self.burst = burst if burst is not None else float(os.environ.get('SPIN_CHANNEL_BURST', '40'))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """0 when a spin may run now, otherwise seconds until it may (rate 0 disables the limit)"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class SpinWriter:
+    """Stores and publishes spin results in batches, in submission order, off the IOLoop"""
+
+    def __init__(self, store, profiler, publisher: Callable[[], Any], batch_size: Optional[int] = None,
+                 flush_ms: Optional[float] = None):
+        self.store = store
+        self.profiler = profiler
+        self.publisher = publisher
+        self.batch_size = batch_size or int(os.environ.get('SPIN_WRITE_BATCH_SIZE', '100'))
+        self.flush_delay = (flush_ms or float(os.environ.get('SPIN_WRITE_FLUSH_MS', '5'))) / 1000
+        # One thread: batches are written in the order they were flushed
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spin-writer")
+        self._pending: List[Tuple[Dict[str, Any], Dict[str, str], Future]] = []
+        self._timer = None
+        self.batches_in_flight = 0
+        self.batches = 0
+        self.records = 0
+        self.failed_batches = 0
+
+    def submit(self, record: Dict[str, Any], trace_headers: Dict[str, str]) -> Future:
+        """Queue a game record; the future resolves once it is stored (call on the IOLoop)"""
+        future: Future = Future()
+        self._pending.append((record, trace_headers, future))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = ioloop.IOLoop.current().call_later(self.flush_delay, self.flush)
+        return future
+
+    def flush(self):
+        io_loop = ioloop.IOLoop.current()
+        if self._timer is not None:
+            io_loop.remove_timeout(self._timer)
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        self.batches_in_flight += 1
+        written = io_loop.run_in_executor(self._executor, self._write, [(record, headers) for record, headers, _ in batch])
+        written.add_done_callback(lambda done: self._resolve(batch, done))
+
+    def _write(self, items: List[Tuple[Dict[str, Any], Dict[str, str]]]):
+        documents = [self.store.to_document(record) for record, _ in items]
+        result = self.profiler.insert_many(self.store.collection, documents, name="games.insert_spins")
+        for (record, _), game_id in zip(items, result.inserted_ids):
+            record['_id'] = str(game_id)
+        # Stored is what the player is told; a failed publish only costs analytics
+        self.publisher().publish_game_results(items)
+        batch_sizes.observe("spin_writes", len(items))
+
+    def _resolve(self, batch: List[Tuple[Dict[str, Any], Dict[str, str], Future]], done):
+        self.batches_in_flight -= 1
+        error = done.exception()
+        if error is None:
+            self.batches += 1
+            self.records += len(batch)
+        else:
+            self.failed_batches += 1
+            logger.error("Failed to store %d spin results: %s", len(batch), error)
+            sentry_sdk.capture_exception(error)
+        for _, _, future in batch:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batch_size": self.batch_size,
+            "flush_ms": self.flush_delay * 1000,
+            "pending": len(self._pending),
+            "batches_in_flight": self.batches_in_flight,
+            "batches": self.batches,
+            "records": self.records,
+            "failed_batches": self.failed_batches,
+        }
@@ -0,0 +1,255 @@
+"""
+On-demand wall-clock stack sampler for the Python services.
+
+    from stack_sampler import stack_sampler
+    profile = stack_sampler.run(seconds=10, hz=100, match=codes_of([handler.post]))
+    print(profile.collapsed())
+
+A sampling thread reads every other thread's current frame with
+``sys._current_frames()`` at ``hz`` and counts the stacks, so the profiled
+code is not touched and nothing runs between profiles. The output is the
+"collapsed" format (``thread;outer;...;inner count`` per line) understood by
+flamegraph.pl, inferno, speedscope and Pyroscope.
+
+``match`` restricts the profile to stacks that pass through one of the given
+code objects - the handler of one route, typically - and ``names`` to work
+done for one of the given Sentry transactions. Coroutines only count while
+they are running on the loop, not while they await. Work handed to a thread
+pool keeps its attribution when it is submitted through
+``attributed(capture_origin(), call)``: the submitting stack is counted as the
+outer part of the worker's stack and the submitting transaction name is kept,
+which also covers work started from tasks the handler spawned.
+"""
+import os
+import sys
+import time
+import inspect
+import logging
+import threading
+from contextlib import contextmanager
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, Optional, Set, Tuple
+
+import sentry_sdk
+
+logger = logging.getLogger(__name__)
+
+MAX_SECONDS = float(os.environ.get('STACK_SAMPLER_MAX_SECONDS', '60'))
+MAX_HZ = float(os.environ.get('STACK_SAMPLER_MAX_HZ', '1000'))
+DEFAULT_HZ = float(os.environ.get('STACK_SAMPLER_HZ', '100'))
+MAX_DEPTH = 128
+
+# Leaf frames of threads that are parked rather than working
+_IDLE_LEAVES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("socket.py", "accept"),
+    ("socket.py", "readinto"),
+}
+
+
+def _transaction_name() -> Optional[str]:
+    """Name of the Sentry transaction of the current context, sampled or not"""
+    try:
+        if hasattr(sentry_sdk, "get_current_scope"):
+            transaction = sentry_sdk.get_current_scope().transaction
+        else:
+            transaction = sentry_sdk.Hub.current.scope.transaction
+    except Exception:
+        return None
+    return getattr(transaction, "name", None)
+
+
+class SamplerBusy(Exception):
+    """Another profile is already being collected"""
+
+
+def codes_of(functions: Iterable[Callable]) -> Set[Any]:
+    """Code objects of `functions`, looking through decorators and bound methods"""
+    codes = set()
+    for function in functions:
+        function = inspect.unwrap(getattr(function, "__func__", function))
+        code = getattr(function, "__code__", None)
+        if code is not None:
+            codes.add(code)
+    return codes
+
+
+class Profile:
+    """Stack counts collected by one StackSampler.run"""
+
+    def __init__(self, hz: float, transaction: Optional[str] = None):
+        self.hz = hz
+        self.transaction = transaction
+        self.stacks: Counter = Counter()
+        self.ticks = 0
+        self.samples = 0
+        self.started = time.time()
+        self.duration = 0.0
+        self.sampling_time = 0.0
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self, top: int = 20) -> Dict[str, Any]:
+        """Counts, sampler cost and the hottest leaf functions"""
+        leaves: Counter = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return {
+            "transaction": self.transaction,
+            "hz": self.hz,
+            "duration_seconds": round(self.duration, 3),
+            "ticks": self.ticks,
+            "samples": self.samples,
+            "unique_stacks": len(self.stacks),
+            # Share of one core the sampling thread used
+            "sampler_overhead_percent": round(100 * self.sampling_time / self.duration, 2) if self.duration else 0.0,
+            "top_leaves": [
+                {"frame": frame, "samples": count, "percent": round(100 * count / self.samples, 1)}
+                for frame, count in leaves.most_common(top)
+            ],
+        }
+
+
+class StackSampler:
+    """Collects one profile at a time from a background sampling thread"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._labels: Dict[Any, str] = {}
+        self.profiles_taken = 0
+        self.last: Optional[Dict[str, Any]] = None
+        self._filtering = False
+        # thread ident -> (stack, transaction name) that submitted its current work
+        self._origins: Dict[int, Tuple[tuple, Optional[str]]] = {}
+
+    def capture_origin(self) -> Optional[Tuple[tuple, Optional[str]]]:
+        """The caller's stack (innermost first) and transaction while a filtered profile runs, else None"""
+        if not self._filtering:
+            return None
+        codes = []
+        frame = sys._getframe(1)
+        while frame is not None and len(codes) < MAX_DEPTH:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        return tuple(codes), _transaction_name()
+
+    def attributed(self, origin: Optional[Tuple[tuple, Optional[str]]], call: Callable, *args, **kwargs):
+        """Run `call` on this thread, counted under the `origin` stack"""
+        if origin is None:
+            return call(*args, **kwargs)
+        with self._origin(origin):
+            return call(*args, **kwargs)
+
+    @contextmanager
+    def _origin(self, origin: Tuple[tuple, Optional[str]]):
+        ident = threading.get_ident()
+        self._origins[ident] = origin
+        try:
+            yield
+        finally:
+            self._origins.pop(ident, None)
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            name = getattr(code, "co_qualname", code.co_name)
+            label = f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+            self._labels[code] = label
+        return label
+
+    def _sample(self, profile: Profile, own: int, threads: Dict[int, str], match: Set[Any],
+                names: Set[str], idle: bool):
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            leaf = frame.f_code
+            if not idle and (os.path.basename(leaf.co_filename), leaf.co_name) in _IDLE_LEAVES:
+                continue
+            codes = []
+            matched = not match and not names
+            while frame is not None and len(codes) < MAX_DEPTH:
+                code = frame.f_code
+                if not matched and code in match:
+                    matched = True
+                codes.append(code)
+                frame = frame.f_back
+            origin = self._origins.get(ident)
+            if origin is not None:
+                # Graft the work onto the submitting stack in place of the pool's own frames
+                if _ATTRIBUTED in codes:
+                    del codes[codes.index(_ATTRIBUTED):]
+                codes.extend(origin[0])
+                if not matched:
+                    matched = origin[1] in names or any(code in match for code in origin[0])
+            if not matched:
+                continue
+            codes.reverse()
+            thread = threads.get(ident, str(ident)).replace(";", ":").replace(" ", "_")
+            profile.stacks[";".join([thread] + [self._label(code) for code in codes])] += 1
+            profile.samples += 1
+
+    def run(self, seconds: float, hz: Optional[float] = None, match: Optional[Set[Any]] = None,
+            names: Optional[Set[str]] = None, transaction: Optional[str] = None, idle: bool = False) -> Profile:
+        """Sample for `seconds` on the calling thread (call it off the event loop)"""
+        match = match or set()
+        names = names or set()
+        seconds = min(max(seconds, 0.1), MAX_SECONDS)
+        hz = min(max(hz or DEFAULT_HZ, 1.0), MAX_HZ)
+        if not self._lock.acquire(blocking=False):
+            raise SamplerBusy("A profile is already running")
+        self._filtering = bool(match or names)
+        try:
+            profile = Profile(hz, transaction)
+            own = threading.get_ident()
+            interval = 1.0 / hz
+            started = time.monotonic()
+            deadline = started + seconds
+            next_tick = started
+            threads: Dict[int, str] = {}
+            threads_refreshed = 0.0
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if now - threads_refreshed > 1.0:
+                    threads = {thread.ident: thread.name for thread in threading.enumerate()}
+                    threads_refreshed = now
+                self._sample(profile, own, threads, match, names, idle)
+                profile.ticks += 1
+                profile.sampling_time += time.monotonic() - now
+                next_tick += interval
+                delay = next_tick - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Fell behind (a slow tick or a GIL-heavy process) - skip missed ticks
+                    next_tick = time.monotonic()
+            profile.duration = time.monotonic() - started
+            self.profiles_taken += 1
+            self.last = profile.summary(top=5)
+            logger.info("Stack profile: %d samples in %.1fs at %.0f Hz", profile.samples, profile.duration, hz)
+            return profile
+        finally:
+            self._filtering = False
+            self._origins.clear()
+            self._lock.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._lock.locked(),
+            "profiles_taken": self.profiles_taken,
+            "default_hz": DEFAULT_HZ,
+            "max_hz": MAX_HZ,
+            "max_seconds": MAX_SECONDS,
+            "last": self.last,
+        }
+
+
+_ATTRIBUTED = StackSampler.attributed.__code__
+
+stack_sampler = StackSampler()
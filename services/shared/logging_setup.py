@@ -0,0 +1,242 @@
+"""
+Logging setup shared by the Python services.
+
+    from logging_setup import configure_logging
+    configure_logging("game-engine")        # instead of logging.basicConfig
+
+- Records go through a bounded queue to a ``QueueListener`` thread that
+  formats and writes them, so a request thread never waits on stdout. When
+  the queue is full the record is dropped and counted instead of blocking
+  (LOG_QUEUE_SIZE, 10000).
+- Records are queued unformatted: ``logger.info("user %s", user_id)`` costs a
+  tuple on the hot path and the string is built on the listener thread.
+  Arguments are formatted later, so do not mutate them after logging.
+- Messages below WARNING are rate limited per logger and message template
+  (LOG_RATE_LIMIT_PER_SECOND, 10; per-logger overrides in LOG_RATE_LIMITS as
+  ``rabbitmq_consumer=2,main=50``; 0 disables). A template logged once in a
+  while is never affected; one logged on every spin is cut to the limit,
+  and the next record let through notes how many similar ones were skipped.
+  Loggers given their own limit are filtered on the logger itself, before
+  Sentry's logging integration turns the record into a breadcrumb; the
+  others are filtered on the output handler.
+- LOG_FORMAT=json writes one JSON object per line.
+- Emitted, rate-limited and dropped records are counted per level and
+  reported per second on /metrics (log_records, log_records_dropped).
+
+LOG_ASYNC=false keeps the rate limits but writes synchronously, for scripts
+and debugging.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+from typing import Any, Dict, Optional
+
+from sampling import parse_budgets
+from telemetry import log_records, log_dropped
+
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "suppressed", "_rate_checked"}
+# Templates remembered for rate limiting; f-string messages make every record its own template
+_MAX_TEMPLATES = 2000
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with any ``extra=`` fields"""
+
+    def __init__(self, service: str):
+        super().__init__()
+        self.service = service
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "service": self.service,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The basicConfig layout, plus the number of similar records rate limiting skipped"""
+
+    def __init__(self):
+        super().__init__(logging.BASIC_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text = f"{text} [{suppressed} similar suppressed]"
+        return text
+
+
+class RateLimitFilter(logging.Filter):
+    """Caps records below WARNING per (logger, template) and second, and counts log volume"""
+
+    def __init__(self, default_limit: float, limits: Dict[str, float]):
+        super().__init__()
+        self.default_limit = default_limit
+        self.limits = limits
+        self._lock = threading.Lock()
+        # (logger, template) -> [second, records this second, suppressed since last emitted]
+        self._windows: Dict[tuple, list] = {}
+        self._logger_limits: Dict[str, float] = {}
+
+    def _limit(self, name: str) -> float:
+        limit = self._logger_limits.get(name)
+        if limit is None:
+            # Longest configured prefix wins: "rabbitmq_consumer" covers "rabbitmq_consumer.x"
+            limit = self.default_limit
+            best = -1
+            for prefix, value in self.limits.items():
+                if (name == prefix or name.startswith(prefix + ".")) and len(prefix) > best:
+                    limit, best = value, len(prefix)
+            self._logger_limits[name] = limit
+        return limit
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Already let through by the same filter on its logger
+        if getattr(record, "_rate_checked", False):
+            return True
+        record._rate_checked = True
+        if record.levelno < logging.WARNING:
+            limit = self._limit(record.name)
+            if limit > 0:
+                key = (record.name, record.msg if isinstance(record.msg, str) else id(type(record.msg)))
+                second = int(time.monotonic())
+                with self._lock:
+                    window = self._windows.get(key)
+                    if window is None:
+                        if len(self._windows) >= _MAX_TEMPLATES:
+                            self._windows.clear()
+                        window = self._windows[key] = [second, 0, 0]
+                    if window[0] != second:
+                        window[0], window[1] = second, 0
+                    if window[1] >= limit:
+                        window[2] += 1
+                        log_dropped.mark("rate_limited")
+                        return False
+                    window[1] += 1
+                    if window[2]:
+                        record.suppressed, window[2] = window[2], 0
+        log_records.mark(record.levelname)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = sorted(
+                ((count, name, template) for (name, template), (_, _, count) in self._windows.items() if count),
+                reverse=True,
+            )[:10]
+        return {
+            "rate_limit_per_second": self.default_limit,
+            "rate_limits": self.limits,
+            "templates_tracked": len(self._windows),
+            "most_suppressed": [
+                {"logger": name, "template": template, "suppressed": count} for count, name, template in pending
+            ],
+        }
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the logging thread, and leaves formatting to the listener"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stock prepare() formats the message here, on the hot path
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_dropped.mark("queue_full")
+
+
+_state: Dict[str, Any] = {}
+
+
+def configure_logging(service: str, level: Optional[str] = None,
+                      rate_limits: Optional[Dict[str, float]] = None) -> logging.Logger:
+    """
+    Replace the root logger's handlers; safe to call again (e.g. in a forked worker).
+
+    `rate_limits` are the service's defaults for its hot loggers, overridden by LOG_RATE_LIMITS.
+    """
+    shutdown_logging()
+    level = (level or os.environ.get('LOG_LEVEL', 'INFO')).upper()
+    formatter = JsonFormatter(service) if os.environ.get('LOG_FORMAT', 'text').lower() == 'json' else TextFormatter()
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(formatter)
+
+    rate_filter = RateLimitFilter(
+        float(os.environ.get('LOG_RATE_LIMIT_PER_SECOND', '10')),
+        {**(rate_limits or {}), **parse_budgets(os.environ.get('LOG_RATE_LIMITS'))},
+    )
+    previous = _state.get("filter")
+    for name in set(rate_filter.limits) | set(previous.limits if previous else ()):
+        if previous is not None:
+            logging.getLogger(name).removeFilter(previous)
+        if name in rate_filter.limits:
+            logging.getLogger(name).addFilter(rate_filter)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(level)
+
+    if os.environ.get('LOG_ASYNC', 'true').lower() in ('1', 'true', 'yes'):
+        records: queue.Queue = queue.Queue(int(os.environ.get('LOG_QUEUE_SIZE', '10000')))
+        handler = _DroppingQueueHandler(records)
+        listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+        listener.start()
+        _state["listener"] = listener
+        _state["queue"] = records
+    else:
+        handler = output
+    handler.addFilter(rate_filter)
+    root.addHandler(handler)
+    _state["filter"] = rate_filter
+    _state["service"] = service
+    if not _state.get("atexit"):
+        # Flush what is still queued when the process exits
+        atexit.register(shutdown_logging)
+        _state["atexit"] = True
+    return root
+
+
+def shutdown_logging():
+    listener = _state.pop("listener", None)
+    if listener is not None:
+        listener.stop()
+    _state.pop("queue", None)
+
+
+def logging_stats() -> Dict[str, Any]:
+    records = _state.get("queue")
+    rate_filter = _state.get("filter")
+    return {
+        "service": _state.get("service"),
+        "async": records is not None,
+        "queue_depth": records.qsize() if records is not None else 0,
+        "queue_size": records.maxsize if records is not None else 0,
+        "records_per_second": log_records.rates(),
+        "dropped_per_second": log_dropped.rates(),
+        **(rate_filter.stats() if rate_filter is not None else {}),
+    }
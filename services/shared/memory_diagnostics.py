@@ -0,0 +1,247 @@
+"""
+tracemalloc snapshots and diffs for memory growth investigations.
+
+    memory_diagnostics.start(frames=10)
+    first = memory_diagnostics.snapshot("before")
+    ...                                     # let the process grow
+    second = memory_diagnostics.snapshot("after")
+    memory_diagnostics.diff(first["id"], second["id"], group_by="lineno")
+
+Tracing is off until ``start`` is called (or MEMORY_TRACE_FRAMES is set at
+boot), so a process that never uses the routes pays nothing. While it is
+on, every allocation records ``frames`` frames of traceback: expect
+noticeably more memory and slower allocation-heavy code. Stop it when done.
+
+Each snapshot also records live object counts by type from ``gc`` (container
+objects only - ``str``, ``int`` and ``bytes`` are not tracked by the GC), so a
+diff shows which allocation sites grew and which kinds of objects pile up.
+"""
+import gc
+import os
+import time
+import logging
+import threading
+import tracemalloc
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Optional
+
+import sentry_sdk
+
+logger = logging.getLogger(__name__)
+
+MAX_FRAMES = 50
+GROUP_BY = ("lineno", "filename", "traceback")
+
+# Allocations made by tracemalloc, this module and imports are noise in a diff
+_IGNORED = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__, all_frames=True),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+class MemoryDiagnosticsError(ValueError):
+    """Invalid request: tracing off, unknown snapshot or bad parameters"""
+
+
+def _kib(size: int) -> float:
+    return round(size / 1024, 1)
+
+
+def _type_name(obj) -> str:
+    cls = type(obj)
+    module = cls.__module__
+    return cls.__qualname__ if module == "builtins" else f"{module}.{cls.__qualname__}"
+
+
+class MemoryDiagnostics:
+    """Keeps up to MEMORY_SNAPSHOT_LIMIT snapshots and compares them"""
+
+    def __init__(self, limit: Optional[int] = None):
+        self.limit = limit or int(os.environ.get('MEMORY_SNAPSHOT_LIMIT', '5'))
+        self._lock = threading.Lock()
+        self._snapshots: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._next_id = 1
+
+    # --- tracing --------------------------------------------------------
+
+    def start(self, frames: Optional[int] = None) -> Dict[str, Any]:
+        frames = frames or int(os.environ.get('MEMORY_TRACE_FRAMES', '10') or 10)
+        if not 1 <= frames <= MAX_FRAMES:
+            raise MemoryDiagnosticsError(f"frames must be between 1 and {MAX_FRAMES}")
+        if tracemalloc.is_tracing():
+            if tracemalloc.get_traceback_limit() != frames:
+                raise MemoryDiagnosticsError(
+                    f"Already tracing with {tracemalloc.get_traceback_limit()} frames, stop first"
+                )
+        else:
+            tracemalloc.start(frames)
+            logger.warning("tracemalloc started with %d frames", frames)
+        return self.status()
+
+    def start_from_env(self):
+        """Trace from boot when MEMORY_TRACE_FRAMES is set, to catch growth that starts early"""
+        if os.environ.get('MEMORY_TRACE_FRAMES'):
+            self.start()
+
+    def stop(self) -> Dict[str, Any]:
+        """Stop tracing; snapshots already taken stay available until cleared"""
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            logger.warning("tracemalloc stopped")
+        return self.status()
+
+    def clear(self) -> Dict[str, Any]:
+        with self._lock:
+            self._snapshots.clear()
+        return self.status()
+
+    # --- snapshots ------------------------------------------------------
+
+    def snapshot(self, label: Optional[str] = None) -> Dict[str, Any]:
+        """Take a snapshot (slow: seconds on a big heap - call it off the event loop)"""
+        if not tracemalloc.is_tracing():
+            raise MemoryDiagnosticsError("tracemalloc is not tracing, start it first")
+        started = time.monotonic()
+        snapshot = tracemalloc.take_snapshot().filter_traces(_IGNORED)
+        current, peak = tracemalloc.get_traced_memory()
+        objects = Counter(_type_name(obj) for obj in gc.get_objects())
+        entry = {
+            "id": 0,
+            "label": label,
+            "taken_at": time.time(),
+            "frames": snapshot.traceback_limit,
+            "traced_kb": _kib(current),
+            "peak_kb": _kib(peak),
+            "gc_objects": sum(objects.values()),
+            "gc_counts": gc.get_count(),
+        }
+        with self._lock:
+            entry["id"] = self._next_id
+            self._next_id += 1
+            self._snapshots[entry["id"]] = {"info": entry, "snapshot": snapshot, "objects": objects}
+            while len(self._snapshots) > self.limit:
+                self._snapshots.popitem(last=False)
+        entry["took_seconds"] = round(time.monotonic() - started, 3)
+        return entry
+
+    def _get(self, snapshot_id: int) -> Dict[str, Any]:
+        with self._lock:
+            stored = self._snapshots.get(snapshot_id)
+        if stored is None:
+            raise MemoryDiagnosticsError(f"Unknown snapshot {snapshot_id}")
+        return stored
+
+    @staticmethod
+    def _check_group(group_by: str):
+        if group_by not in GROUP_BY:
+            raise MemoryDiagnosticsError(f"group_by must be one of {', '.join(GROUP_BY)}")
+
+    @staticmethod
+    def _site(traceback: tracemalloc.Traceback, group_by: str) -> Dict[str, Any]:
+        # Frames run from the outermost call to the allocation, like a Python traceback
+        frame = traceback[-1]
+        site: Dict[str, Any] = {"file": frame.filename}
+        if group_by != "filename":
+            site["line"] = frame.lineno
+        if group_by == "traceback":
+            site["traceback"] = [f"{f.filename}:{f.lineno}" for f in traceback]
+        return site
+
+    def top(self, snapshot_id: int, group_by: str = "lineno", limit: int = 20) -> Dict[str, Any]:
+        """Largest allocation sites of one snapshot"""
+        self._check_group(group_by)
+        stored = self._get(snapshot_id)
+        stats = stored["snapshot"].statistics(group_by)
+        return {
+            "snapshot": stored["info"],
+            "group_by": group_by,
+            "sites": [
+                {**self._site(stat.traceback, group_by), "size_kb": _kib(stat.size), "count": stat.count}
+                for stat in stats[:limit]
+            ],
+            "objects": [{"type": name, "count": count} for name, count in stored["objects"].most_common(limit)],
+        }
+
+    def diff(self, first_id: int, second_id: int, group_by: str = "lineno", limit: int = 20) -> Dict[str, Any]:
+        """Allocation sites and object types that grew the most from `first_id` to `second_id`"""
+        self._check_group(group_by)
+        first, second = self._get(first_id), self._get(second_id)
+        stats = second["snapshot"].compare_to(first["snapshot"], group_by)
+        objects = Counter(second["objects"])
+        objects.subtract(first["objects"])
+        return {
+            "from": first["info"],
+            "to": second["info"],
+            "group_by": group_by,
+            "size_diff_kb": _kib(sum(stat.size_diff for stat in stats)),
+            "count_diff": sum(stat.count_diff for stat in stats),
+            # compare_to sorts by absolute growth, so freed memory shows up here too
+            "sites": [
+                {
+                    **self._site(stat.traceback, group_by),
+                    "size_diff_kb": _kib(stat.size_diff),
+                    "size_kb": _kib(stat.size),
+                    "count_diff": stat.count_diff,
+                    "count": stat.count,
+                }
+                for stat in stats[:limit]
+            ],
+            "objects": [
+                {"type": name, "count_diff": count, "count": second["objects"][name]}
+                for name, count in objects.most_common(limit) if count > 0
+            ],
+        }
+
+    def report(self, first_id: int, second_id: Optional[int] = None, group_by: str = "lineno",
+               limit: int = 10) -> Optional[str]:
+        """Send a snapshot (or diff) summary to Sentry, returns the event id"""
+        if second_id is None:
+            summary = self.top(first_id, group_by, limit)
+            message = f"Memory snapshot {first_id}: {summary['snapshot']['traced_kb']} KiB traced"
+            sites = [f"{self._where(site)} {site['size_kb']} KiB ({site['count']} blocks)" for site in summary["sites"]]
+        else:
+            summary = self.diff(first_id, second_id, group_by, limit)
+            message = f"Memory growth of {summary['size_diff_kb']} KiB between snapshots {first_id} and {second_id}"
+            sites = [
+                f"{self._where(site)} {site['size_diff_kb']:+} KiB ({site['count_diff']:+} blocks)"
+                for site in summary["sites"]
+            ]
+        objects = [
+            f"{item['type']} {item['count_diff']:+}" if "count_diff" in item else f"{item['type']} {item['count']}"
+            for item in summary["objects"]
+        ]
+        with sentry_sdk.push_scope() as scope:
+            scope.set_tag("memory.diagnostics", "true")
+            scope.set_context("memory_snapshot", {
+                "snapshots": [first_id] if second_id is None else [first_id, second_id],
+                "group_by": group_by,
+                "top_sites": sites,
+                "top_objects": objects,
+            })
+            return sentry_sdk.capture_message(message, level="warning")
+
+    @staticmethod
+    def _where(site: Dict[str, Any]) -> str:
+        return f"{site['file']}:{site['line']}" if "line" in site else site["file"]
+
+    def status(self) -> Dict[str, Any]:
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        with self._lock:
+            snapshots = [stored["info"] for stored in self._snapshots.values()]
+        return {
+            "tracing": tracing,
+            "frames": tracemalloc.get_traceback_limit() if tracing else None,
+            "traced_kb": _kib(current),
+            "peak_kb": _kib(peak),
+            # What tracemalloc's own bookkeeping costs
+            "overhead_kb": _kib(tracemalloc.get_tracemalloc_memory()) if tracing else 0.0,
+            "snapshot_limit": self.limit,
+            "snapshots": snapshots,
+        }
+
+
+memory_diagnostics = MemoryDiagnostics()
@@ -0,0 +1,277 @@
+"""
+Load-aware trace and profile sampling shared by the Python services.
+
+    sampler = AdaptiveSampler(service="game-engine")
+    sentry_sdk.init(..., traces_sampler=sampler, profiles_sampler=sampler.profiles_sampler,
+                    before_send=sampler.before_send)
+
+Decision order for a new transaction:
+
+1. an upstream decision (``sentry-trace`` sampled flag, or ``sentry-sampled`` /
+   ``sentry-sample_rate`` in ``baggage``) is kept, so a trace is never cut in half
+2. ``business_critical`` transactions, and routes that raised an error in the
+   last SENTRY_ERROR_BOOST_SECONDS, are always sampled
+3. otherwise the head rate (SENTRY_TRACES_SAMPLE_RATE) is capped so every
+   route or transaction name gets at most its budget of traces per second
+   (SENTRY_TRACES_PER_SECOND, per-route overrides in SENTRY_TRACE_BUDGETS as
+   ``/health=0.2,/calculate=50``), then scaled down while process CPU or
+   event-loop lag is above its limit
+
+Error events are not affected: ``sample_rate`` for errors stays at 1.0.
+Decisions and effective rates are recorded through the metric aggregator and
+show up on ``/metrics``.
+"""
+import os
+import re
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from metrics import aggregator
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGETS = {
+    "/health": 0.2,
+    "/ready": 0.2,
+    "/metrics": 0.2,
+}
+
+# Path segments that look like IDs ("/u123", "/42", ObjectIds, UUIDs) but not "/v1" or "/player-details-n1"
+_ID_SEGMENT = re.compile(r"/(?:\d+|[0-9a-fA-F-]{32,36}|(?=[^/-]*\d)[^/-]{4,})(?=/|$)")
+
+
+def _float_env(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logger.warning("Ignoring invalid %s=%r", name, os.environ.get(name))
+        return default
+
+
+def parse_budgets(value: Optional[str]) -> Dict[str, float]:
+    """``/health=0.2,calculate_game_result=50`` -> {key: traces per second}"""
+    budgets: Dict[str, float] = {}
+    for item in (value or "").split(","):
+        key, sep, budget = item.strip().rpartition("=")
+        if not sep or not key:
+            continue
+        try:
+            budgets[key.strip()] = float(budget)
+        except ValueError:
+            logger.warning("Ignoring invalid trace budget %r", item)
+    return budgets
+
+
+def parse_baggage(header: Optional[str]) -> Dict[str, str]:
+    """The ``sentry-*`` entries of a W3C baggage header"""
+    values: Dict[str, str] = {}
+    for item in (header or "").split(","):
+        key, sep, value = item.strip().partition("=")
+        if sep and key.startswith("sentry-"):
+            values[key[len("sentry-"):]] = value.strip()
+    return values
+
+
+class LoadMonitor:
+    """
+    Process CPU and event-loop lag, refreshed in the background so sampling
+    decisions only read two floats.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.cpu_percent = 0.0
+        self.loop_lag_ms = 0.0
+        self._process = None
+        self._thread: Optional[threading.Thread] = None
+        try:
+            import psutil
+            self._process = psutil.Process()
+            self._process.cpu_percent(None)
+        except Exception as e:
+            logger.warning("CPU load unavailable for sampling: %s", e)
+
+    def _sample_cpu(self):
+        if self._process is not None:
+            try:
+                self.cpu_percent = self._process.cpu_percent(None)
+            except Exception:
+                pass
+
+    async def _watch_loop(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            # How late the loop woke us up is how long ready callbacks waited
+            self.loop_lag_ms = max((time.monotonic() - started - self.interval) * 1000, 0.0)
+            self._sample_cpu()
+
+    def start_loop(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """Watch the running (or given) asyncio loop - Tornado 6 runs on one too"""
+        loop = loop or asyncio.get_event_loop()
+        return loop.create_task(self._watch_loop())
+
+    def start_thread(self):
+        """CPU only, for processes without an event loop (the consumer workers)"""
+        if self._thread is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.interval)
+                self._sample_cpu()
+
+        self._thread = threading.Thread(target=run, name="sampling-load", daemon=True)
+        self._thread.start()
+
+
+class AdaptiveSampler:
+    """``traces_sampler`` with per-route budgets, upstream decisions and load shedding"""
+
+    def __init__(self, service: str, monitor: Optional[LoadMonitor] = None):
+        self.service = service
+        self.monitor = monitor or LoadMonitor()
+        self.base_rate = _float_env('SENTRY_TRACES_SAMPLE_RATE', 1.0)
+        self.profiles_rate = _float_env('SENTRY_PROFILES_SAMPLE_RATE', 0.1)
+        self.default_budget = _float_env('SENTRY_TRACES_PER_SECOND', 20.0)
+        self.budgets = {**DEFAULT_BUDGETS, **parse_budgets(os.environ.get('SENTRY_TRACE_BUDGETS'))}
+        self.cpu_limit = _float_env('SENTRY_SAMPLING_CPU_PERCENT', 85.0)
+        self.lag_limit_ms = _float_env('SENTRY_SAMPLING_LOOP_LAG_MS', 100.0)
+        self.min_load_factor = _float_env('SENTRY_SAMPLING_MIN_FACTOR', 0.05)
+        self.error_boost_seconds = _float_env('SENTRY_ERROR_BOOST_SECONDS', 60.0)
+        self._lock = threading.Lock()
+        # key -> [window start (whole second), count this window, count last window]
+        self._arrivals: Dict[str, list] = {}
+        self._boosted: Dict[str, float] = {}
+
+    # --- inputs ---------------------------------------------------------
+
+    @staticmethod
+    def _request(sampling_context: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+        """(path, baggage header) of the HTTP request behind a transaction, if any"""
+        scope = sampling_context.get("asgi_scope")
+        if scope:
+            baggage = None
+            for name, value in scope.get("headers", []):
+                if name == b"baggage":
+                    baggage = value.decode("latin-1")
+                    break
+            return scope.get("path"), baggage
+        request = sampling_context.get("tornado_request")
+        if request is not None:
+            return request.path, request.headers.get("baggage")
+        return None, None
+
+    @staticmethod
+    def _key(path: Optional[str], name: Optional[str]) -> str:
+        # IDs in the path would make a budget (and a metric series) per player
+        if path:
+            return _ID_SEGMENT.sub("/:id", path)
+        return name or "unknown"
+
+    def _budget(self, key: str) -> float:
+        budget = self.budgets.get(key)
+        if budget is None:
+            for prefix, value in self.budgets.items():
+                if prefix.startswith("/") and key.startswith(prefix):
+                    return value
+            return self.default_budget
+        return budget
+
+    def _arrival_rate(self, key: str) -> float:
+        """Transactions per second for `key` over the last full second (this one counted)"""
+        now = int(time.monotonic())
+        with self._lock:
+            window = self._arrivals.get(key)
+            if window is None:
+                window = self._arrivals[key] = [now, 0, 0]
+            if window[0] != now:
+                window[2] = window[1] if now - window[0] == 1 else 0
+                window[0], window[1] = now, 0
+            window[1] += 1
+            return float(max(window[1], window[2]))
+
+    def load_factor(self) -> float:
+        """1.0 when healthy, shrinking as CPU or loop lag exceed their limits"""
+        factor = 1.0
+        if self.monitor.cpu_percent > self.cpu_limit:
+            factor = min(factor, self.cpu_limit / self.monitor.cpu_percent)
+        if self.monitor.loop_lag_ms > self.lag_limit_ms:
+            factor = min(factor, self.lag_limit_ms / self.monitor.loop_lag_ms)
+        if factor < 1.0:
+            factor = max(factor ** 2, self.min_load_factor)
+        return factor
+
+    # --- sentry hooks ---------------------------------------------------
+
+    def __call__(self, sampling_context: Dict[str, Any]) -> float:
+        try:
+            rate, key, reason = self._decide(sampling_context)
+        except Exception as e:
+            # Never let sampling break a request
+            logger.warning("Trace sampler failed: %s", e)
+            rate, key, reason = self.base_rate, "unknown", "error"
+        aggregator.increment("sentry.traces.decision", tags={"service": self.service, "reason": reason})
+        aggregator.gauge("sentry.traces.effective_rate", rate, tags={"service": self.service, "key": key})
+        return rate
+
+    def _decide(self, sampling_context: Dict[str, Any]) -> Tuple[float, str, str]:
+        transaction_context = sampling_context.get("transaction_context") or {}
+        path, baggage = self._request(sampling_context)
+        key = self._key(path, transaction_context.get("name"))
+
+        parent_sampled = sampling_context.get("parent_sampled")
+        if parent_sampled is not None:
+            return (1.0 if parent_sampled else 0.0), key, "parent"
+        upstream = parse_baggage(baggage)
+        if upstream.get("sampled") in ("true", "false"):
+            return (1.0 if upstream["sampled"] == "true" else 0.0), key, "baggage"
+        if "sample_rate" in upstream:
+            try:
+                return min(max(float(upstream["sample_rate"]), 0.0), 1.0), key, "baggage"
+            except ValueError:
+                pass
+
+        if sampling_context.get("business_critical"):
+            return 1.0, key, "business_critical"
+        boosted_until = self._boosted.get(key)
+        if boosted_until is not None:
+            if time.monotonic() < boosted_until:
+                return 1.0, key, "error_boost"
+            self._boosted.pop(key, None)
+
+        rate = min(self.base_rate, self._budget(key) / self._arrival_rate(key))
+        factor = self.load_factor()
+        if factor < 1.0:
+            return rate * factor, key, "load_shed"
+        return rate, key, "budget" if rate < self.base_rate else "base"
+
+    def profiles_sampler(self, sampling_context: Dict[str, Any]) -> float:
+        """Share of sampled transactions to profile - none while overloaded"""
+        if self.load_factor() < 1.0:
+            return 0.0
+        return self.profiles_rate
+
+    def before_send(self, event: Dict[str, Any], hint: Dict[str, Any]) -> Dict[str, Any]:
+        """Trace every request of a route for a while after it raised an error"""
+        if event.get("level") in ("error", "fatal") and self.error_boost_seconds > 0:
+            url = (event.get("request") or {}).get("url")
+            path = re.sub(r"^[a-z]+://[^/]+", "", url).split("?", 1)[0] if url else None
+            self._boosted[self._key(path, event.get("transaction"))] = time.monotonic() + self.error_boost_seconds
+        return event
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "base_rate": self.base_rate,
+            "profiles_rate": self.profiles_rate,
+            "default_budget_per_second": self.default_budget,
+            "budgets_per_second": self.budgets,
+            "cpu_percent": self.monitor.cpu_percent,
+            "loop_lag_ms": round(self.monitor.loop_lag_ms, 1),
+            "load_factor": round(self.load_factor(), 3),
+            "error_boosted": sorted(key for key, until in self._boosted.items() if until > now),
+        }